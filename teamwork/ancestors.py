@@ -0,0 +1,323 @@
+"""
+Loading of ancestor chains for objects in permission hierarchies.
+
+Walking ``obj.parent`` one lazy ForeignKey fetch at a time costs a query per
+level. Models that name the ForeignKey their ``get_permission_parents()``
+follows, with ``permission_parent_field``, can instead have whole chains
+loaded with ``select_related()``, many levels to a query::
+
+    class Document(models.Model):
+        parent = models.ForeignKey('self', blank=True, null=True)
+
+        permission_parent_field = 'parent'
+
+        def get_permission_parents(self):
+            return get_ancestors(self)
+"""
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields import FieldDoesNotExist
+
+
+# Number of ancestor levels fetched by each query
+LEVELS_PER_QUERY = 16
+
+
+def get_ancestors(obj):
+    """List an object's ancestors, from its parent up to the root"""
+    return get_ancestors_bulk([obj])[0]
+
+
+def get_ancestors_bulk(objects):
+    """
+    List the ancestors of each of a list of objects, from parent to root, in
+    one query per model for every LEVELS_PER_QUERY levels of the deepest
+    chain. Objects sharing an ancestor share the same instance of it.
+    """
+    chains = [[] for obj in objects]
+    seen = [set([_key(obj)]) for obj in objects]
+    loaded = dict()
+
+    pending = list(enumerate(objects))
+    while pending:
+        # Follow parents already loaded, then fetch whatever comes next
+        wanted = defaultdict(list)
+        for idx, obj in pending:
+            tail = _follow_loaded(obj, chains[idx], seen[idx], loaded)
+            if tail is not None:
+                field = get_parent_field(tail.__class__)
+                wanted[field.rel.to].append(
+                    (idx, getattr(tail, field.attname)))
+
+        pending = []
+        for model, items in wanted.items():
+            path = '__'.join(_get_path(model, LEVELS_PER_QUERY - 1))
+            queryset = model._default_manager.all()
+            if path:
+                queryset = queryset.select_related(path)
+            fetched = queryset.in_bulk(list(set(pk for idx, pk in items)))
+            for idx, pk in items:
+                parent = fetched.get(pk, None)
+                if parent is None:
+                    continue
+                parent = loaded.setdefault(_key(parent), parent)
+                if _key(parent) in seen[idx]:
+                    continue
+                seen[idx].add(_key(parent))
+                chains[idx].append(parent)
+                pending.append((idx, parent))
+
+    return chains
+
+
+def get_children_bulk(objects):
+    """
+    List the children of each of a list of objects, as found by
+    get_children(). Where permission_parent_field is a ForeignKey to the
+    model itself, children of all the objects are fetched in one query.
+    """
+    children = [[] for obj in objects]
+    idxs_by_model = defaultdict(list)
+    for idx, obj in enumerate(objects):
+        if not hasattr(obj, 'get_children'):
+            continue
+        field = get_parent_field(obj.__class__)
+        if field is not None and field.rel.to is obj.__class__:
+            idxs_by_model[obj.__class__].append(idx)
+        else:
+            children[idx] = list(obj.get_children())
+
+    for model, idxs in idxs_by_model.items():
+        field = get_parent_field(model)
+        idxs_by_pk = dict((objects[idx].pk, idx) for idx in idxs)
+        rows = model._default_manager.filter(
+            **{'%s__in' % field.name: list(idxs_by_pk.keys())})
+        for child in rows:
+            children[idxs_by_pk[getattr(child, field.attname)]].append(child)
+
+    return children
+
+
+def get_parent_field(model):
+    """
+    Get the ForeignKey named by a model's permission_parent_field, or None
+    if the model doesn't name one.
+    """
+    name = getattr(model, 'permission_parent_field', None)
+    if not name:
+        return None
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if getattr(field, 'rel', None) is None:
+        return None
+    return field
+
+
+def _follow_loaded(obj, chain, seen, loaded):
+    """
+    Add an object's already-loaded ancestors to its chain, returning the
+    last ancestor whose parent still needs fetching, or None at the root.
+    """
+    while True:
+        field = get_parent_field(obj.__class__)
+        if field is None or getattr(obj, field.attname) is None:
+            return None
+        parent = getattr(obj, field.get_cache_name(), None)
+        if parent is None:
+            return obj
+        parent = loaded.setdefault(_key(parent), parent)
+        if _key(parent) in seen:
+            # Guard against cycles in the hierarchy
+            return None
+        seen.add(_key(parent))
+        chain.append(parent)
+        obj = parent
+
+
+def _get_path(model, levels):
+    """List parent field names for up to a number of levels above a model"""
+    path = []
+    for level in range(0, levels):
+        field = get_parent_field(model)
+        if field is None:
+            break
+        path.append(field.name)
+        model = field.rel.to
+    return path
+
+
+def _key(obj):
+    return (obj.__class__, obj.pk)
+
+
+# Index of nearest permission ancestors
+#
+# Models with a ForeignKey to themselves in permission_parent_field can set
+# permission_ancestor_index = True, to have the nearest ancestor carrying a
+# Policy or belonging to a Team recorded for each object. Permission checks
+# then jump from an object straight to that ancestor, rather than visiting
+# every ancestor in between. That would skip filter_permissions() for the
+# ancestors in between, so models defining it can't be indexed.
+
+NO_ANCESTOR = (None, None)
+
+
+def uses_ancestor_index(model):
+    """Determine whether a model's nearest permission ancestors are indexed"""
+    if not getattr(model, 'permission_ancestor_index', False):
+        return False
+    if hasattr(model, 'filter_permissions'):
+        raise ImproperlyConfigured(
+            "%s defines filter_permissions(), which the ancestor index would "
+            "skip for ancestors, so it can't set permission_ancestor_index" %
+            model.__name__)
+    field = get_parent_field(model)
+    return field is not None and field.rel.to is model
+
+
+def get_nearest_ancestor(obj):
+    """
+    Get the nearest ancestor of an object that carries a Policy or belongs to
+    a Team, according to the index. Returns a pair of (found, ancestor), where
+    found is False if the object is missing from the index.
+    """
+    from .models import PermissionAncestor
+    ct = ContentType.objects.get_for_model(obj)
+    entries = PermissionAncestor.objects.get_entries(ct.id, (obj.pk,))
+    if obj.pk not in entries:
+        return False, None
+    a_type, a_id = entries[obj.pk]
+    if a_id is None:
+        return True, None
+    model = ContentType.objects.get_for_id(a_type).model_class()
+    try:
+        return True, model._default_manager.get(pk=a_id)
+    except model.DoesNotExist:
+        return False, None
+
+
+def update_ancestor_index(obj):
+    """
+    Update the index entries for an object and for those of its descendants
+    that inherit through it. Returns a list of (content type ID, object ID)
+    for the objects whose entries changed.
+    """
+    model = obj.__class__
+    ct = ContentType.objects.get_for_model(model)
+
+    # Find the nearest ancestor from scratch, so it doesn't matter whether
+    # the rest of the tree has been indexed yet.
+    ancestor = NO_ANCESTOR
+    ancestors = get_ancestors(obj)
+    if ancestors:
+        carriers = _get_carriers(model, ancestors)
+        for parent in ancestors:
+            if parent.pk in carriers:
+                ancestor = (ct.id, parent.pk)
+                break
+
+    changed = _update_entries(ct.id, {obj.pk: ancestor})
+    if obj.pk in _get_carriers(model, [obj]):
+        ancestor = (ct.id, obj.pk)
+    changed.extend(_update_descendants(model, {obj.pk: ancestor}))
+    return changed
+
+
+def remove_from_ancestor_index(obj):
+    """
+    Remove an object from the index, handing its descendants down to the
+    object's own nearest ancestor.
+    """
+    from .models import PermissionAncestor
+    ct = ContentType.objects.get_for_model(obj)
+    entries = PermissionAncestor.objects.get_entries(ct.id, (obj.pk,))
+    a_type, a_id = entries.get(obj.pk, NO_ANCESTOR)
+    inheritors = PermissionAncestor.objects.filter(ancestor_type=ct,
+                                                   ancestor_id=obj.pk)
+    changed = [(ct.id, obj_id) for obj_id in
+               inheritors.values_list('object_id', flat=True)]
+    inheritors.update(ancestor_type=a_type, ancestor_id=a_id)
+    (PermissionAncestor.objects.filter(content_type=ct, object_id=obj.pk)
+                               .delete())
+    return changed
+
+
+def rebuild_ancestor_index(model):
+    """Rebuild the index for all objects of a model, a level at a time"""
+    from .models import PermissionAncestor
+    ct = ContentType.objects.get_for_model(model)
+    PermissionAncestor.objects.filter(content_type=ct).delete()
+    field = get_parent_field(model)
+    roots = list(model._default_manager.filter(
+        **{'%s__isnull' % field.name: True}))
+    _update_entries(ct.id, dict((root.pk, NO_ANCESTOR) for root in roots))
+    carriers = _get_carriers(model, roots)
+    _update_descendants(model, dict(
+        (root.pk, (ct.id, root.pk) if root.pk in carriers else NO_ANCESTOR)
+        for root in roots), full=True)
+
+
+def _update_descendants(model, inherited, full=False):
+    """
+    Walk down from a set of objects a level at a time, given a dict mapping
+    their IDs to the ancestor their children inherit. Unless full is True,
+    as for a rebuild, stops wherever an entry is already up to date, since
+    everything below it must be, too.
+    """
+    ct = ContentType.objects.get_for_model(model)
+    field = get_parent_field(model)
+    seen = set(inherited.keys())
+    changed = []
+    while inherited:
+        level = model._default_manager.filter(
+            **{'%s__in' % field.name: list(inherited.keys())})
+        children = [child for child in level if child.pk not in seen]
+        seen.update(child.pk for child in children)
+        entries = dict((child.pk, inherited[getattr(child, field.attname)])
+                       for child in children)
+        updated = set(obj_id for ct_id, obj_id in
+                      _update_entries(ct.id, entries))
+        changed.extend((ct.id, obj_id) for obj_id in updated)
+
+        # Children that carry permissions are the nearest ancestor of their
+        # own descendants.
+        if not full:
+            children = [child for child in children if child.pk in updated]
+        carriers = _get_carriers(model, children)
+        inherited = dict(
+            (child.pk, (ct.id, child.pk) if child.pk in carriers
+             else entries[child.pk])
+            for child in children)
+    return changed
+
+
+def _update_entries(ct_id, entries):
+    """Record index entries that differ, returning those that did"""
+    from .models import PermissionAncestor
+    if not entries:
+        return []
+    current = PermissionAncestor.objects.get_entries(ct_id, entries.keys())
+    updates = dict((obj_id, ancestor) for obj_id, ancestor in entries.items()
+                   if current.get(obj_id, None) != ancestor)
+    if updates:
+        PermissionAncestor.objects.set_entries(ct_id, updates)
+    return [(ct_id, obj_id) for obj_id in updates.keys()]
+
+
+def _get_carriers(model, objects):
+    """Get the IDs of objects which carry a Policy or belong to a Team"""
+    from .models import Policy
+    if not objects:
+        return set()
+    carriers = set(obj.pk for obj in objects
+                   if getattr(obj, 'team_id', None))
+    ct = ContentType.objects.get_for_model(model)
+    carriers.update(Policy.objects
+                          .filter(content_type=ct,
+                                  object_id__in=[obj.pk for obj in objects])
+                          .values_list('object_id', flat=True))
+    return carriers
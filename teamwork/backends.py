@@ -1,13 +1,28 @@
 import logging
+import time
+from collections import OrderedDict
 from itertools import chain
 
 from django.conf import settings
 from django.contrib.auth.models import Permission, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site, get_current_site
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+from django.test.utils import CaptureQueriesContext
 
 from . import DEFAULT_ANONYMOUS_USER_PK
+from .ancestors import (get_ancestors_bulk, get_children_bulk,
+                        get_parent_field, get_nearest_ancestor,
+                        uses_ancestor_index)
+from .base_policy import get_base_policy
+from .cache import (ScopeSet, get_permission_cache, get_request_cache,
+                    object_scope, snapshot_scopes, team_scope, user_scope)
+from .instrumentation import get_request_stats
+from .metrics import get_metrics, metrics_suppressed, timed
 from .models import Team, Role, Policy
+from .registry import registry
+from .site_policy import get_site_policy
 
 
 class TeamworkBackend(object):
@@ -15,104 +30,822 @@ class TeamworkBackend(object):
     supports_anonymous_user = True
     supports_inactive_user = True
 
-    perms_cache = dict()
-
     def authenticate(self, username, password):
         return None
 
     def get_all_permissions(self, user, obj=None):
+        stats = get_request_stats()
+        if stats is None:
+            return self._get_all_permissions(user, obj)
+        return self._instrument(stats.record_check,
+                                self._get_all_permissions, user, obj)
+
+    def _instrument(self, record, method, *args):
+        """
+        Call a method with an info dict for it to fill in, and pass its
+        duration, query count, and info to record, for the request being
+        recorded.
+        """
+        info = dict()
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            result = method(*(args + (info,)))
+            duration = time.time() - start
+        record(duration, len(context.captured_queries), info)
+        return result
+
+    def _get_all_permissions(self, user, obj=None, info=None):
+        """
+        Get all permissions for a user and object. If an info dict is
+        supplied, it's filled with whether the permissions were cached, and
+        if not, with the stage of resolution that decided them.
+        """
+        if info is None:
+            info = dict()
 
         if not obj:
             # If there's no obj, then much can be shortcircuited
+            request_cache = get_request_cache()
+            key = (self._get_user_pk(user), None, None)
+            if request_cache is not None and key in request_cache:
+                info['cached'] = True
+                _count_cache_lookups(1, 0)
+                return request_cache[key]
+            info['cached'] = False
+            _count_cache_lookups(0, 1)
+            info['stage'] = 'site'
             perms = self._get_site_permissions(user)
             if perms is None:
+                info['stage'] = 'settings'
                 perms = self._get_settings_permissions(user)
             if perms is None:
+                info['stage'] = 'none'
                 perms = set()
+            if request_cache is not None:
+                request_cache[key] = perms
             return perms
 
-        if user.is_anonymous():
-            user_pk = DEFAULT_ANONYMOUS_USER_PK
+        user_pk = self._get_user_pk(user)
+        perms = self._get_cached_permissions(user_pk, obj)
+        info['cached'] = perms is not None
+        if perms is None:
+            _count_cache_lookups(0, 1)
         else:
-            user_pk = user.pk
+            _count_cache_lookups(1, 0)
 
-        # TODO: Stash this in the global django cache (ie. memcache)?
-        if not hasattr(obj, '_teamwork_perms_cache'):
-            obj._teamwork_perms_cache = dict()
+        if perms is None:
+            cache = get_permission_cache()
+            scopes = None if cache is None else ScopeSet(cache)
+            perms = self._resolve_permissions(user, obj, scopes, info)
+            self._cache_permissions(user_pk, obj, perms, scopes)
+
+        return perms
 
-        if not user_pk in obj._teamwork_perms_cache:
+    def get_all_permissions_bulk(self, user, objects):
+        """
+        Get all permissions for a user on each of a list of objects, as a list
+        of sets in the same order as the objects.
+
+        Where get_all_permissions costs several queries per object, this
+        resolves the whole list in a fixed number of queries for each stage.
+        Results are cached on the objects, so later has_perm() calls on them
+        are free.
+        """
+        stats = get_request_stats()
+        if stats is None:
+            return self._get_all_permissions_bulk(user, objects)
+        return self._instrument(stats.record_bulk_checks,
+                                self._get_all_permissions_bulk, user, objects)
 
-            # Try getting perms for the current object
-            perms = self._get_obj_permissions(user, obj)
+    def _get_all_permissions_bulk(self, user, objects, info=None):
+        """
+        Get all permissions for a user on each of a list of objects. If an
+        info dict is supplied, it's filled with the number of cache 'hits'
+        and 'misses'.
+        """
+        if info is None:
+            info = dict()
+        objects = list(objects)
+        user_pk = self._get_user_pk(user)
+
+        results = self._get_cached_permissions_bulk(user_pk, objects)
+        pending = [idx for idx, perms in enumerate(results) if perms is None]
+        info['hits'] = len(objects) - len(pending)
+        info['misses'] = len(pending)
+        _count_cache_lookups(info['hits'], info['misses'])
+        if not pending:
+            return results
+
+        cache = get_permission_cache()
+        if cache is None:
+            scopes = [None for idx in pending]
+        else:
+            scopes = [ScopeSet(cache) for idx in pending]
+        resolved = self._resolve_permissions_bulk(
+            user, [objects[idx] for idx in pending], scopes)
+
+        for idx, perms in zip(pending, resolved):
+            results[idx] = perms
+        self._cache_permissions_bulk(user_pk,
+                                     [objects[idx] for idx in pending],
+                                     resolved, scopes)
+
+        return results
+
+    def filter_permitted(self, user, perm, objects):
+        """
+        Filter a list of objects down to those for which the user has the
+        named permission, resolving them all in bulk.
+        """
+        objects = list(objects)
+        all_perms = self.get_all_permissions_bulk(user, objects)
+        return [obj for obj, perms in zip(objects, all_perms)
+                if perm in perms]
+
+    def resolve_subtree(self, user, root, perm):
+        """
+        Check a permission for a user on an object and all of its
+        descendants, as found by get_children(), as a list of (obj, allowed)
+        pairs with parents ahead of their children.
+
+        The tree is walked once from the top, and children with no opinion
+        of their own inherit from their parents rather than resolving their
+        ancestors all over again. So, the work done is a fixed number of
+        queries per level of the tree. Results are cached on the objects,
+        so later has_perm() calls on them are free.
+        """
+        stats = get_request_stats()
+        if stats is None:
+            return self._resolve_subtree(user, root, perm)
+        return self._instrument(stats.record_bulk_checks,
+                                self._resolve_subtree, user, root, perm)
+
+    def _resolve_subtree(self, user, root, perm, info=None):
+        """
+        Check a permission on an object and its descendants. If an info dict
+        is supplied, it's filled with the number of cache 'hits' and
+        'misses', all of which are misses since the tree is resolved afresh.
+        """
+        if info is None:
+            info = dict()
+        user_pk = self._get_user_pk(user)
+        cache = get_permission_cache()
+        use_scopes = cache is not None
+        seen = set([_obj_key(root)])
+        results = []
+
+        # Start from whatever the root has, or inherits from its ancestors.
+        # Alongside each object, track what its children inherit, and the
+        # cache scopes that came from.
+        if use_scopes:
+            user_scopes = ScopeSet(cache, (user_scope(user),))
+            chain_scopes = ScopeSet(cache)
+            self._add_obj_scopes(chain_scopes, root)
+        else:
+            chain_scopes = set()
+        inherited = self._get_obj_permissions(user, root)
+        if inherited is None and hasattr(root, 'get_permission_parents'):
+            parents = list(root.get_permission_parents())
+            if use_scopes:
+                chain_scopes.snapshot(self._get_objs_scopes(parents))
+            parent_perms = self._get_obj_permissions_bulk(user, parents)
+            for parent, perms in zip(parents, parent_perms):
+                if use_scopes:
+                    self._add_obj_scopes(chain_scopes, parent)
+                if perms is not None:
+                    inherited = perms
+                    break
+        level = [(root, inherited, chain_scopes)]
+
+        while level:
+            objects = [obj for obj, perms, obj_scopes in level]
+            if use_scopes:
+                scopes = [ScopeSet(cache, obj_scopes)
+                          for obj, perms, obj_scopes in level]
+                for obj_scopes in scopes:
+                    obj_scopes.update(user_scopes)
+            else:
+                scopes = [None for obj in objects]
+            resolved = self._finish_permissions_bulk(
+                user, objects,
+                [None if perms is None else set(perms)
+                 for obj, perms, obj_scopes in level],
+                scopes)
+            for obj, perms, obj_scopes in zip(objects, resolved, scopes):
+                self._cache_permissions(user_pk, obj, perms, obj_scopes)
+                results.append((obj, perm in perms))
+
+            # Gather up the next level down, resolving it all in one batch
+            next_level = []
+            for (obj, perms, obj_scopes), children in zip(
+                    level, get_children_bulk(objects)):
+                for child in children:
+                    if _obj_key(child) not in seen:
+                        seen.add(_obj_key(child))
+                        next_level.append((child, perms, obj_scopes))
+            if not next_level:
+                break
+            children = [child for child, perms, obj_scopes in next_level]
+            if use_scopes:
+                children_scopes = [ScopeSet(cache) for child in children]
+                self._add_objs_scopes(children_scopes, children)
+            else:
+                children_scopes = [set() for child in children]
+            child_perms = self._get_obj_permissions_bulk(user, children)
+
+            level = []
+            for (child, perms, obj_scopes), own_perms, child_scopes in zip(
+                    next_level, child_perms, children_scopes):
+                if own_perms is None:
+                    # No opinion here, so inherit from the parent
+                    child_scopes.update(obj_scopes)
+                    own_perms = perms
+                level.append((child, own_perms, child_scopes))
+
+        info['hits'], info['misses'] = 0, len(results)
+        return results
+
+    def explain(self, user, perm, obj=None):
+        """
+        Explain how a permission is decided for a user and object, for
+        debugging slow or surprising checks. Permissions are resolved from
+        scratch, bypassing all caches.
+
+        Returns a dict with the 'perm', whether it's 'allowed', the resolved
+        'permissions', the 'stage' that decided them, the 'ancestor' that
+        answered (if any), and the total 'time' and 'queries'. Under 'steps'
+        is a list of dicts, one per stage consulted, each with its 'stage',
+        'object', resulting 'permissions' (None for no opinion), 'time', and
+        'queries'. Object steps also list the matching 'policies' or 'roles'
+        and 'team', and the permissions 'added' and 'removed' by
+        filter_permissions(). Site steps list the matching 'policies'.
+        Parent lookups record whether they went 'via' the ancestor index,
+        and the 'nearest' ancestor or the 'parents' found.
+
+        Steps are resolved one object at a time, so parents may cost more
+        queries here than in a real check, which loads them in batches.
+        Nothing is reported to the metrics backend, so that debugging
+        doesn't skew production metrics.
+        """
+        with metrics_suppressed():
+            return self._explain(user, perm, obj)
 
-            # If the object yielded no perms, try traversing parents
-            if perms is None and hasattr(obj, 'get_permission_parents'):
-                parents = obj.get_permission_parents()
+    def _explain(self, user, perm, obj=None):
+        steps = []
+        perms = None
+        ancestor = None
+
+        if obj:
+            perms = self._explain_obj(steps, user, obj, 'object')
+
+            # Work up through the ancestors, via the index if the model has
+            # one and it's up to date, and otherwise from the parents.
+            found = False
+            if perms is None and uses_ancestor_index(obj.__class__):
+                curr = obj
+                while True:
+                    step = self._explain_step(steps, 'parent', curr)
+                    with step:
+                        found, curr = get_nearest_ancestor(curr)
+                    step.info['via'] = 'index'
+                    step.info['nearest'] = curr
+                    if not found or curr is None:
+                        break
+                    perms = self._explain_obj(steps, user, curr, 'parent')
+                    if perms is not None:
+                        ancestor = curr
+                        break
+            if (perms is None and not found and
+                    hasattr(obj, 'get_permission_parents')):
+                step = self._explain_step(steps, 'parent', obj)
+                with step:
+                    parents = list(obj.get_permission_parents())
+                step.info['via'] = 'get_permission_parents'
+                step.info['parents'] = parents
                 for parent in parents:
-                    perms = self._get_obj_permissions(user, parent)
+                    perms = self._explain_obj(steps, user, parent, 'parent')
                     if perms is not None:
+                        ancestor = parent
                         break
 
-            # Check for policies attached to the current Site object, if any.
-            if perms is None:
-                perms = self._get_site_permissions(user, obj)
+        if perms is None:
+            step = self._explain_step(steps, 'site', None)
+            with step:
+                site = self._get_site(obj)
+                perms = self._get_permissions_for_site(user, site)
+            step.info['object'] = site
+            step.info['permissions'] = perms
+            if site is not None:
+                step.info['policies'] = list(
+                    Policy.objects.get_matching_policies(user, site))
 
-            # Consult settings for a baseline policy.
-            if perms is None:
+        if perms is None:
+            step = self._explain_step(steps, 'settings', None)
+            with step:
                 perms = self._get_settings_permissions(user, obj)
+            step.info['permissions'] = perms
 
-            # If none of the above came up with permissions (even an empty
-            # set), then we have an empty set.
-            if perms is None:
-                perms = set()
+        stage = steps[-1]['stage']
+        if stage == 'object':
+            # Objects answer for themselves as superuser, team, or object
+            stage = steps[-1]['source']
+        if perms is None:
+            stage = 'none'
+            perms = set()
+
+        return dict(perm=perm, allowed=perm in perms, permissions=perms,
+                    stage=stage, ancestor=ancestor, steps=steps,
+                    time=sum(step['time'] for step in steps),
+                    queries=sum(step['queries'] for step in steps))
+
+    def _explain_obj(self, steps, user, obj, stage):
+        """
+        Add a step to an explanation for permissions from an object itself,
+        returning the permissions.
+        """
+        info = dict(trace=True)
+        step = self._explain_step(steps, stage, obj)
+        with step:
+            perms = self._get_obj_permissions(user, obj, info)
+        step.info['permissions'] = perms
+        step.info['source'] = info.get('stage')
+
+        # Look up what matched, outside of the step's time and queries
+        if info.get('stage') == 'team':
+            team_pk = _get_related_pk(obj, 'team')
+            step.info['team'] = Team.objects.get(pk=team_pk)
+            step.info['roles'] = list(Role.objects.filter(team=team_pk,
+                                                          users=user))
+        if info.get('stage') == 'object':
+            step.info['policies'] = list(
+                Policy.objects.get_matching_policies(user, obj))
+
+        if 'unfiltered' in info:
+            before = info['unfiltered'] or set()
+            after = perms or set()
+            step.info['added'] = set(after) - set(before)
+            step.info['removed'] = set(before) - set(after)
+        return perms
+
+    def _explain_step(self, steps, stage, obj):
+        """Start a timed step of an explanation"""
+        step = _ExplainStep(stage, obj)
+        steps.append(step.info)
+        return step
+
+    def _get_user_pk(self, user):
+        if user.is_anonymous():
+            return DEFAULT_ANONYMOUS_USER_PK
+        return user.pk
+
+    def _get_cached_permissions(self, user_pk, obj):
+        """
+        Get previously resolved permissions from the object itself, the
+        request-scoped cache, or the shared cache, if one is configured.
+        """
+        if not hasattr(obj, '_teamwork_perms_cache'):
+            obj._teamwork_perms_cache = dict()
+
+        if user_pk in obj._teamwork_perms_cache:
+            return obj._teamwork_perms_cache[user_pk]
+
+        if obj.pk is None:
+            # Unsaved objects would all share one key, so only the object
+            # itself can cache their permissions.
+            return None
+
+        ct = ContentType.objects.get_for_model(obj)
+        key = (user_pk, ct.id, obj.pk)
+        request_cache = get_request_cache()
+        if request_cache is not None and key in request_cache:
+            perms = request_cache[key]
+            obj._teamwork_perms_cache[user_pk] = perms
+            return perms
+
+        cache = get_permission_cache()
+        if cache is None:
+            return None
 
-            # Cache all this work...
+        perms = cache.get(*key)
+        if perms is not None:
             obj._teamwork_perms_cache[user_pk] = perms
+            if request_cache is not None:
+                request_cache[key] = perms
+        return perms
 
-        return obj._teamwork_perms_cache[user_pk]
+    def _get_cached_permissions_bulk(self, user_pk, objects):
+        """
+        Get previously resolved permissions for each of a list of objects,
+        as _get_cached_permissions does, but fetching from the shared cache
+        all at once. Returns a list with None for each object not found.
+        """
+        results = [None for obj in objects]
+        request_cache = get_request_cache()
+        shared_keys = dict()
+        for idx, obj in enumerate(objects):
+            perms_cache = obj.__dict__.setdefault('_teamwork_perms_cache', {})
+            if user_pk in perms_cache:
+                results[idx] = perms_cache[user_pk]
+                continue
+            if obj.pk is None:
+                continue
+            ct = ContentType.objects.get_for_model(obj)
+            key = (user_pk, ct.id, obj.pk)
+            if request_cache is not None and key in request_cache:
+                results[idx] = perms_cache[user_pk] = request_cache[key]
+            else:
+                shared_keys.setdefault(key, []).append(idx)
+
+        cache = get_permission_cache()
+        if cache is None or not shared_keys:
+            return results
+
+        for key, perms in cache.get_many(list(shared_keys.keys())).items():
+            if request_cache is not None:
+                request_cache[key] = perms
+            for idx in shared_keys[key]:
+                results[idx] = perms
+                objects[idx]._teamwork_perms_cache[user_pk] = perms
+        return results
+
+    def _cache_permissions(self, user_pk, obj, perms, scopes=None):
+        """Cache all this work on the object, the request, and shared cache"""
+        obj.__dict__.setdefault('_teamwork_perms_cache', {})[user_pk] = perms
+        if obj.pk is None:
+            return
+        ct = ContentType.objects.get_for_model(obj)
+        request_cache = get_request_cache()
+        if request_cache is not None:
+            request_cache[(user_pk, ct.id, obj.pk)] = perms
+        cache = get_permission_cache()
+        if cache is not None and scopes is not None:
+            cache.set(user_pk, ct.id, obj.pk, perms, scopes)
+
+    def _cache_permissions_bulk(self, user_pk, objects, results, scopes):
+        """
+        Cache permissions for a list of objects, as _cache_permissions does,
+        but writing to the shared cache all at once.
+        """
+        request_cache = get_request_cache()
+        entries = []
+        for obj, perms, obj_scopes in zip(objects, results, scopes):
+            obj.__dict__.setdefault('_teamwork_perms_cache',
+                                    {})[user_pk] = perms
+            if obj.pk is None:
+                continue
+            ct = ContentType.objects.get_for_model(obj)
+            if request_cache is not None:
+                request_cache[(user_pk, ct.id, obj.pk)] = perms
+            if obj_scopes is not None:
+                entries.append((user_pk, ct.id, obj.pk, perms, obj_scopes))
+        cache = get_permission_cache()
+        if cache is not None and entries:
+            cache.set_many(entries)
+
+    def _resolve_permissions(self, user, obj, scopes=None, info=None):
+        """
+        Resolve permissions for a user and object, working through the
+        object, its parents, the Site, and the settings base policy.
+
+        If a set of scopes is supplied, it's filled with the cache scopes
+        consulted along the way. If an info dict is supplied, its 'stage' is
+        set to the stage that decided the permissions: 'superuser', 'team',
+        'object', 'parent', 'site', 'settings', or 'none'.
+        """
+        if info is None:
+            info = dict()
+        if scopes is not None:
+            scopes.update([user_scope(user)] + self._get_obj_scopes(obj))
+
+        # Try getting perms for the current object
+        perms = self._get_obj_permissions(user, obj, info)
+
+        # If the object yielded no perms, try jumping to the nearest ancestors
+        # that could have an opinion, if the model has them indexed.
+        found = False
+        if perms is None and uses_ancestor_index(obj.__class__):
+            info['stage'] = 'parent'
+            found, perms = self._get_indexed_ancestor_permissions(user, obj,
+                                                                  scopes)
+
+        # Otherwise, try traversing parents. Look them up all at once, and the
+        # nearest one with an opinion wins.
+        if (perms is None and not found and
+                hasattr(obj, 'get_permission_parents')):
+            info['stage'] = 'parent'
+            parents = list(obj.get_permission_parents())
+            if scopes is not None:
+                scopes.snapshot(self._get_objs_scopes(parents))
+            parent_perms = self._get_obj_permissions_bulk(user, parents)
+            depth = 0
+            for parent, perms in zip(parents, parent_perms):
+                depth += 1
+                if scopes is not None:
+                    self._add_obj_scopes(scopes, parent)
+                if perms is not None:
+                    break
+            _observe_parent_depth(depth)
+
+        # Check for policies attached to the current Site object, if any.
+        if perms is None:
+            info['stage'] = 'site'
+            if scopes is not None:
+                site = self._get_site(obj)
+                if site is not None:
+                    self._add_obj_scopes(scopes, site)
+            perms = self._get_site_permissions(user, obj)
+
+        # Consult settings for a baseline policy.
+        if perms is None:
+            info['stage'] = 'settings'
+            perms = self._get_settings_permissions(user, obj)
+
+        # If none of the above came up with permissions (even an empty
+        # set), then we have an empty set.
+        if perms is None:
+            info['stage'] = 'none'
+            perms = set()
+
+        return perms
+
+    def _get_indexed_ancestor_permissions(self, user, obj, scopes=None):
+        """
+        Look up permissions from the nearest ancestors of an object carrying
+        a Policy or belonging to a Team, per the ancestor index. Returns a
+        pair of (found, perms), where found is False if the index was missing
+        an entry needed along the way.
+        """
+        curr = obj
+        depth = 0
+        while True:
+            found, curr = get_nearest_ancestor(curr)
+            if not found:
+                return False, None
+            if curr is None:
+                _observe_parent_depth(depth)
+                return True, None
+            depth += 1
+            if scopes is not None:
+                self._add_obj_scopes(scopes, curr)
+            perms = self._get_obj_permissions(user, curr)
+            if perms is not None:
+                _observe_parent_depth(depth)
+                return True, perms
+
+    def _resolve_permissions_bulk(self, user, objects, scopes):
+        """
+        Resolve permissions for a user and a list of objects, with the same
+        semantics as _resolve_permissions but batching queries for each stage.
+
+        scopes is a list of sets (or Nones) parallel to objects, filled with
+        the cache scopes consulted for each object.
+        """
+        self._add_objs_scopes(scopes, objects, (user_scope(user),))
+        results = self._get_obj_permissions_bulk(user, objects)
+
+        # Gather up the parents of every object that yielded no perms, and
+        # resolve all of the parents in one batch. Chains that follow a
+        # permission_parent_field are loaded together, too.
+        parents_by_idx = dict()
+        chain_idxs = []
+        for idx, obj in enumerate(objects):
+            if (results[idx] is None and
+                    hasattr(obj, 'get_permission_parents')):
+                if get_parent_field(obj.__class__) is not None:
+                    chain_idxs.append(idx)
+                else:
+                    parents_by_idx[idx] = list(obj.get_permission_parents())
+        if chain_idxs:
+            chains = get_ancestors_bulk([objects[idx] for idx in chain_idxs])
+            parents_by_idx.update(zip(chain_idxs, chains))
+
+        unique_parents = OrderedDict()
+        for idx, parents in parents_by_idx.items():
+            for parent in parents:
+                unique_parents.setdefault(_obj_key(parent), parent)
+
+        if unique_parents:
+            snapshot_scopes([(scopes[idx], self._get_objs_scopes(parents))
+                             for idx, parents in parents_by_idx.items()])
+            parent_perms = dict(zip(
+                unique_parents.keys(),
+                self._get_obj_permissions_bulk(user,
+                                               list(unique_parents.values()))))
+            for idx, parents in parents_by_idx.items():
+                depth = 0
+                for parent in parents:
+                    depth += 1
+                    if scopes[idx] is not None:
+                        self._add_obj_scopes(scopes[idx], parent)
+                    perms = parent_perms[_obj_key(parent)]
+                    if perms is not None:
+                        results[idx] = set(perms)
+                        break
+                _observe_parent_depth(depth)
+
+        return self._finish_permissions_bulk(user, objects, results, scopes)
+
+    def _finish_permissions_bulk(self, user, objects, results, scopes):
+        """
+        Fill in permissions for objects that neither they nor their parents
+        had an opinion about, from the Site and then the settings base
+        policy. results and scopes are lists parallel to objects, with None
+        in results where permissions are yet to be resolved.
+        """
+        self._get_site_permissions_bulk(user, objects, results, scopes)
+        self._get_settings_permissions_bulk(user, objects, results)
+        return [set() if perms is None else perms for perms in results]
+
+    @timed('teamwork.site_bulk')
+    def _get_site_permissions_bulk(self, user, objects, results, scopes):
+        """
+        Fill in permissions from policies attached to the Site for each
+        object yet to be resolved, resolving each distinct Site just once.
+        """
+        site_idxs = [idx for idx, perms in enumerate(results) if perms is None]
+        if not site_idxs:
+            return
+        sites = self._get_sites_bulk([objects[idx] for idx in site_idxs])
+        site_scopes = [(scopes[idx], site)
+                       for idx, site in zip(site_idxs, sites)
+                       if site is not None]
+        self._add_objs_scopes([obj_scopes for obj_scopes, site
+                               in site_scopes],
+                              [site for obj_scopes, site in site_scopes])
+        site_perms = dict()
+        for idx, site in zip(site_idxs, sites):
+            if site is None:
+                continue
+            if site.pk not in site_perms:
+                site_perms[site.pk] = self._get_permissions_for_site(
+                    user, site)
+            if site_perms[site.pk] is not None:
+                results[idx] = set(site_perms[site.pk])
+
+    @timed('teamwork.settings_bulk')
+    def _get_settings_permissions_bulk(self, user, objects, results):
+        """
+        Fill in permissions from the settings base policy for each object
+        yet to be resolved.
+        """
+        settings_idxs = [idx for idx, perms in enumerate(results)
+                         if perms is None]
+        if not settings_idxs:
+            return
+        policy = get_base_policy()
+        if policy is not None:
+            base_perms = policy.get_user_permissions(user)
+            for idx in settings_idxs:
+                results[idx] = set(policy.add_owner_permissions(
+                    user, objects[idx], base_perms))
+
+    def _get_obj_scopes(self, obj):
+        """Get the cache scopes that a single object's permissions rely on"""
+        ct = ContentType.objects.get_for_model(obj)
+        scopes = [object_scope(ct.id, obj.pk)]
+        team_pk = _get_related_pk(obj, 'team')
+        if team_pk:
+            scopes.append(team_scope(team_pk))
+        return scopes
+
+    def _get_objs_scopes(self, objects):
+        """Get the cache scopes that a list of objects' permissions rely on"""
+        return list(chain.from_iterable(self._get_obj_scopes(obj)
+                                        for obj in objects))
+
+    def _add_obj_scopes(self, scopes, obj):
+        """Add the cache scopes that a single object's permissions rely on"""
+        scopes.update(self._get_obj_scopes(obj))
+
+    def _add_objs_scopes(self, scopes, objects, extra=()):
+        """
+        Add the cache scopes that each of a list of objects' permissions rely
+        on, plus any extra scopes, to a parallel list of sets (or Nones),
+        snapshotting their versions all at once.
+        """
+        obj_scopes = [list(extra) + self._get_obj_scopes(obj)
+                      for obj in objects]
+        snapshot_scopes(zip(scopes, obj_scopes))
+        for scope_set, new_scopes in zip(scopes, obj_scopes):
+            if scope_set is not None:
+                scope_set.update(new_scopes)
 
     def has_perm(self, user, perm, obj=None):
         return perm in self.get_all_permissions(user, obj)
 
-    def _perms_to_names(self, perms):
-        return set([u"%s.%s" % (p.content_type.app_label, p.codename)
-                    for p in perms])
-
-    def _get_obj_permissions(self, user, obj):
-        """Look up permissions for a single user / team / object"""
+    @timed('teamwork.object')
+    def _get_obj_permissions(self, user, obj, info=None):
+        """
+        Look up permissions for a single user / team / object. If an info
+        dict is supplied and the object has an opinion, its 'stage' is set
+        to 'superuser', 'team', or 'object'. If its 'trace' is set, the
+        permissions before filter_permissions() are kept as 'unfiltered'.
+        """
+        if info is None:
+            info = dict()
         ct = ContentType.objects.get_for_model(obj)
 
         # TODO: Consider multiple-team ownership of a content object
-        team = getattr(obj, 'team', None)
+        team_pk = _get_related_pk(obj, 'team')
 
         if user.is_superuser:
             # Superuser is super, gets all object permissions
-            perms = Permission.objects.filter(content_type=ct).all()
-        elif user.is_anonymous() or not team or not team.has_user(user):
-            # Policies apply to anonymous users and non-team members
-            perms = Policy.objects.get_all_permissions(user, obj)
+            info['stage'] = 'superuser'
+            named_perms = set(registry.get_content_type_names(ct.id))
         else:
-            # Team permissions apply to team members
-            perms = team.get_all_permissions(user)
-
-        # Map the permissions down to a set of app.codename strings
-        if perms is None:
-            named_perms = None
-        else:
-            named_perms = self._perms_to_names(perms)
+            perm_ids = None
+            if team_pk and not user.is_anonymous():
+                # Team permissions apply to team members
+                info['stage'] = 'team'
+                perm_ids = Team.objects.get_member_permission_ids(user,
+                                                                  team_pk)
+            if perm_ids is None:
+                # Policies apply to anonymous users and non-team members
+                info['stage'] = 'object'
+                perm_ids = Policy.objects.get_all_permission_ids(user, obj)
+
+            # Map the permissions down to a set of app.codename strings
+            if perm_ids is None:
+                named_perms = None
+            else:
+                named_perms = set(registry.get_names(perm_ids))
 
         if hasattr(obj, 'filter_permissions'):
             # Allow the object to filter the permissions
+            if info.get('trace'):
+                # Keep a copy, since filters may change the set in place
+                info['unfiltered'] = (None if named_perms is None
+                                      else set(named_perms))
             named_perms = obj.filter_permissions(user, named_perms)
 
         return named_perms
 
+    @timed('teamwork.object_bulk')
+    def _get_obj_permissions_bulk(self, user, objects):
+        """
+        Look up permissions for a user on each of a list of objects, with the
+        same semantics as _get_obj_permissions
+        """
+        if user.is_superuser:
+            # Superuser is super, gets all object permissions
+            results = [
+                set(registry.get_content_type_names(
+                    ContentType.objects.get_for_model(obj).id))
+                for obj in objects]
+
+        else:
+            # Team permissions apply to team members, so work out which of
+            # the objects' teams have the user as a member.
+            if user.is_anonymous():
+                team_pks = [None for obj in objects]
+            else:
+                team_pks = [_get_related_pk(obj, 'team') for obj in objects]
+            member_perms = dict()
+            candidate_pks = set(pk for pk in team_pks if pk)
+            if candidate_pks:
+                member_perms = Team.objects.get_member_permissions_bulk(
+                    user, candidate_pks)
+
+            # Policies apply to anonymous users and non-team members
+            policy_objs = [obj for obj, team_pk in zip(objects, team_pks)
+                           if team_pk not in member_perms]
+            policy_perms = Policy.objects.get_all_permissions_bulk(
+                user, policy_objs)
+
+            results = []
+            for obj, team_pk in zip(objects, team_pks):
+                if team_pk in member_perms:
+                    results.append(set(member_perms[team_pk]))
+                else:
+                    perms = policy_perms.get(_obj_key(obj), None)
+                    results.append(None if perms is None else set(perms))
+
+        for idx, obj in enumerate(objects):
+            if hasattr(obj, 'filter_permissions'):
+                # Allow the object to filter the permissions
+                results[idx] = obj.filter_permissions(user, results[idx])
+
+        return results
+
+    @timed('teamwork.site')
     def _get_site_permissions(self, user, obj=None):
         """
         Get policy permissions attached to the current Site, or the Site
         specified by an object, if any.
         """
-        perms = None
+        perms = self._get_permissions_for_site(user, self._get_site(obj))
+        # Compiled policies hand out shared frozensets, but callers expect a
+        # set of their own, as from every other stage.
+        return None if perms is None else set(perms)
+
+    def _get_permissions_for_site(self, user, site):
+        """Get policy permissions attached to a specific Site"""
+        if site is None:
+            return None
+        return get_site_policy(site).get_permissions(user)
+
+    def _get_site(self, obj=None):
+        """Get the Site specified by an object, or the current Site"""
         # TODO: Abstract this hardcoded 'site' field name
         curr_site = getattr(obj, 'site', None)
         if not curr_site:
@@ -122,41 +855,92 @@ class TeamworkBackend(object):
         # out Site.objects.get_current() for some tests and doesn't result in a
         # real Site object.
         if curr_site and isinstance(curr_site, Site):
-            raw_perms = Policy.objects.get_all_permissions(
-                user, curr_site)
-            if raw_perms is not None:
-                perms = self._perms_to_names(raw_perms)
-        return perms
+            return curr_site
+        return None
 
+    def _get_sites_bulk(self, objects):
+        """
+        Get the Site specified by each of a list of objects, or the current
+        Site, with the same semantics as _get_site
+        """
+        current = self._get_site()
+        site_pks = [_get_related_pk(obj, 'site') for obj in objects]
+        other_pks = set(pk for pk in site_pks
+                        if pk and (current is None or pk != current.pk))
+        sites = dict()
+        if other_pks:
+            sites = Site.objects.in_bulk(list(other_pks))
+        if current is not None:
+            sites[current.pk] = current
+        return [sites.get(pk, None) if pk else current for pk in site_pks]
+
+    @timed('teamwork.settings')
     def _get_settings_permissions(self, user, obj=None):
         """
         Get permissions based on a baseline policy specified in settings.
         """
-        policy = getattr(settings, 'TEAMWORK_BASE_POLICIES', None)
-        if not policy:
+        policy = get_base_policy()
+        if policy is None:
             return None
+        # The compiled policy hands out shared frozensets, but callers expect
+        # a set of their own, as from every other stage.
+        return set(policy.get_permissions(user, obj))
+
+
+class _ExplainStep(object):
+    """Context manager timing a step of an explanation, and its queries"""
+
+    def __init__(self, stage, obj):
+        self.info = dict(stage=stage, object=obj, permissions=None,
+                         time=0.0, queries=0)
+
+    def __enter__(self):
+        self.context = CaptureQueriesContext(connection)
+        self.context.__enter__()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.info['time'] = time.time() - self.start
+        self.context.__exit__(exc_type, exc_value, traceback)
+        self.info['queries'] = len(self.context.captured_queries)
+
+
+def _obj_key(obj):
+    """Key that distinguishes an object from objects of other models"""
+    ct = ContentType.objects.get_for_model(obj)
+    return (ct.id, obj.pk)
+
+
+def _get_related_pk(obj, name):
+    """
+    Get the primary key of an object's related object by name, without
+    fetching it if the relation is a ForeignKey.
+    """
+    try:
+        field = obj._meta.get_field(name)
+    except FieldDoesNotExist:
+        field = None
+    if field is not None and getattr(field, 'rel', None) is not None:
+        return getattr(obj, field.attname)
+    related = getattr(obj, name, None)
+    if not related:
+        return None
+    return related.pk
 
-        if user.is_anonymous():
-            return policy.get('anonymous', set())
-
-        perms = set()
-
-        if user.is_authenticated():
-            perms.update(policy.get('authenticated', set()))
-
-        users_perms = policy.get('users', dict())
-        if user.username in users_perms:
-            perms.update(users_perms[user.username])
 
-        group_perms = policy.get('groups', None)
-        if group_perms:
-            for group in user.groups.all():
-                if group.name in group_perms:
-                    perms.update(group_perms[group.name])
+def _count_cache_lookups(hits, misses):
+    """Report cache hits and misses to the metrics backend, if any"""
+    metrics = get_metrics()
+    if metrics is not None:
+        if hits:
+            metrics.incr('teamwork.cache.hit', hits)
+        if misses:
+            metrics.incr('teamwork.cache.miss', misses)
 
-        if (obj and 'apply_to_owners' in policy and
-                    hasattr(obj, 'get_owner_user') and
-                    user == obj.get_owner_user()):
-            perms.update(policy['apply_to_owners'])
 
-        return perms
+def _observe_parent_depth(depth):
+    """Report the number of parents consulted to the metrics backend"""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.observe('teamwork.parent_depth', depth)
@@ -0,0 +1,132 @@
+"""
+Compiled form of the base policy in ``settings.TEAMWORK_BASE_POLICIES``.
+
+The base policy is the fallback for nearly every check that no object, parent,
+or Site has an opinion about, so it's compiled once into frozen structures and
+only recompiled when the setting itself changes.
+"""
+from django.conf import settings
+from django.db.models.fields import FieldDoesNotExist
+from django.test.signals import setting_changed
+
+from .cache import get_user_groups
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+EMPTY_PERMS = frozenset()
+
+_compiled = None
+
+
+class BasePolicy(object):
+    """Permissions from a base policy, compiled into frozensets"""
+
+    def __init__(self, source):
+        self.source = source
+        self.anonymous = compile_perms(source.get('anonymous', ()))
+        self.authenticated = compile_perms(source.get('authenticated', ()))
+        self.owners = compile_perms(source.get('apply_to_owners', ()))
+        self.applies_to_owners = 'apply_to_owners' in source
+        self.users = dict(
+            (name, compile_perms(perms))
+            for name, perms in source.get('users', dict()).items())
+        self.groups = dict(
+            (name, compile_perms(perms))
+            for name, perms in (source.get('groups', None) or dict()).items())
+
+    def get_user_permissions(self, user):
+        """Get permissions granted to a user, regardless of object"""
+        if user.is_anonymous():
+            return self.anonymous
+
+        perms = EMPTY_PERMS
+        if user.is_authenticated():
+            perms = self.authenticated
+
+        extra = []
+        if user.username in self.users:
+            extra.append(self.users[user.username])
+        if self.groups:
+            for name in get_user_group_names(user):
+                if name in self.groups:
+                    extra.append(self.groups[name])
+
+        if extra:
+            perms = perms.union(*extra)
+        return perms
+
+    def get_permissions(self, user, obj=None):
+        """Get permissions granted to a user, including owner permissions"""
+        return self.add_owner_permissions(user, obj,
+                                          self.get_user_permissions(user))
+
+    def add_owner_permissions(self, user, obj, perms):
+        """Add owner permissions to a set of perms, if the user owns obj"""
+        if self.applies_to_owners and is_owner(user, obj):
+            return perms | self.owners
+        return perms
+
+
+def get_base_policy():
+    """
+    Get the compiled base policy from settings, or None if there isn't one.
+    """
+    global _compiled
+    source = getattr(settings, 'TEAMWORK_BASE_POLICIES', None)
+    if not source:
+        return None
+    if _compiled is None or _compiled.source is not source:
+        _compiled = BasePolicy(source)
+    return _compiled
+
+
+def is_owner(user, obj):
+    """
+    Determine whether a user owns an object, per its get_owner_user(). If
+    permission_owner_field names a ForeignKey, the IDs are compared without
+    fetching the owner.
+    """
+    if (not obj or user.is_anonymous() or
+            not hasattr(obj, 'get_owner_user')):
+        return False
+    field_name = getattr(obj, 'permission_owner_field', None)
+    if field_name:
+        try:
+            field = obj._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            field = None
+        if field is not None and getattr(field, 'rel', None) is not None:
+            owner_pk = getattr(obj, field.attname)
+            return owner_pk is not None and owner_pk == user.pk
+    return user == obj.get_owner_user()
+
+
+def get_user_group_names(user):
+    """Get the names of a user's groups"""
+    return frozenset(name for group_id, name in get_user_groups(user))
+
+
+def compile_perms(perms):
+    return frozenset(intern_name(perm) for perm in perms)
+
+
+def intern_name(name):
+    try:
+        return intern(str(name))
+    except (TypeError, UnicodeError):
+        # Python 2 can only intern byte strings
+        return name
+
+
+def _reset_base_policy(**kwargs):
+    global _compiled
+    if kwargs.get('setting', None) == 'TEAMWORK_BASE_POLICIES':
+        _compiled = None
+
+
+setting_changed.connect(_reset_base_policy,
+                        dispatch_uid='teamwork_reset_base_policy')
@@ -0,0 +1,326 @@
+"""
+Optional storage of resolved permissions in Django's cache framework, so
+that work done by one worker process can be shared by all of them.
+
+Enable it in ``settings.py`` by naming a configured cache alias::
+
+    TEAMWORK_CACHE = 'default'
+    TEAMWORK_CACHE_TIMEOUT = 300
+    TEAMWORK_CACHE_PREFIX = 'teamwork'
+
+Within a request, ``teamwork.middleware.RequestCacheMiddleware`` keeps
+resolved permissions in a thread-local cache keyed by (user, content type,
+object), so that re-fetched instances of the same object are only resolved
+once.
+
+Each cached set of permissions records the versions of the scopes it was
+resolved from - the user, the objects consulted along the way, and the teams
+owning them. Signal handlers in ``teamwork.signals`` bump those versions when
+Teams, Roles, and Policies change, which invalidates exactly the affected
+entries.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    from django.core.cache import caches
+
+    def _get_django_cache(alias):
+        return caches[alias]
+
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache as _get_django_cache
+
+from . import DEFAULT_ANONYMOUS_USER_PK
+
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_PREFIX = 'teamwork'
+
+# Per-thread storage for the request-scoped cache.
+_local = threading.local()
+
+# Cache instances, indexed by alias; get_cache() builds a new one per call on
+# older versions of Django, so hang onto them here.
+_django_caches = dict()
+
+
+class PermissionCache(object):
+    """
+    Stores sets of permission names under (user, content type, object) keys
+    """
+    def __init__(self, cache, timeout=DEFAULT_TIMEOUT, prefix=DEFAULT_PREFIX):
+        self.cache = cache
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def make_key(self, user_pk, ct_id, obj_pk):
+        return '%s:mask:%s:%s:%s' % (self.prefix, user_pk, ct_id, obj_pk)
+
+    def make_scope_key(self, scope):
+        return '%s:ver:%s' % (self.prefix, ':'.join(str(p) for p in scope))
+
+    def get(self, user_pk, ct_id, obj_pk):
+        """
+        Fetch a cached set of permission names, or None on a miss, if any
+        of the scopes it depends on has changed since it was stored, or if
+        Permissions have been added or deleted since.
+        """
+        entry = self.cache.get(self.make_key(user_pk, ct_id, obj_pk))
+        if entry is None:
+            return None
+        current = dict()
+        if entry[1]:
+            current = self.cache.get_many(list(entry[1].keys()))
+        return self._decode(entry, current)
+
+    def get_many(self, keys):
+        """
+        Fetch many cached sets of permission names at once, given a list of
+        (user_pk, ct_id, obj_pk) keys. Returns a dict of the keys found, and
+        still current, to sets of names. Costs two round trips to the cache,
+        however many keys are given: one for the entries, and one for the
+        versions of their scopes.
+        """
+        cache_keys = dict((self.make_key(*key), key) for key in keys)
+        entries = self.cache.get_many(list(cache_keys.keys()))
+        version_keys = set()
+        for entry in entries.values():
+            version_keys.update(entry[1].keys())
+        current = dict()
+        if version_keys:
+            current = self.cache.get_many(list(version_keys))
+        results = dict()
+        for cache_key, entry in entries.items():
+            perms = self._decode(entry, current)
+            if perms is not None:
+                results[cache_keys[cache_key]] = perms
+        return results
+
+    def _decode(self, entry, current):
+        """
+        Decode a stored entry into a set of names, or None if any of its
+        scope versions differs from the current versions given.
+        """
+        mask, versions = entry
+        for key, version in versions.items():
+            if current.get(key) != version:
+                return None
+        from .registry import registry
+        return registry.get_names_for_mask(*mask)
+
+    def set(self, user_pk, ct_id, obj_pk, perms, scopes=()):
+        """
+        Store a set of permission names, along with scope versions: those
+        snapshotted by a ScopeSet, or else the current ones. Names are
+        stored as a bitmask, which is much smaller than the set.
+        """
+        from .registry import registry
+        if isinstance(scopes, ScopeSet):
+            versions = scopes.get_versions()
+        else:
+            versions = self.get_versions(scopes)
+        self.cache.set(self.make_key(user_pk, ct_id, obj_pk),
+                       (registry.get_mask(perms), versions), self.timeout)
+
+    def set_many(self, entries):
+        """
+        Store many sets of permission names at once, given a list of
+        (user_pk, ct_id, obj_pk, perms, scopes) tuples.
+        """
+        from .registry import registry
+        scopes = set()
+        for user_pk, ct_id, obj_pk, perms, obj_scopes in entries:
+            if not isinstance(obj_scopes, ScopeSet):
+                scopes.update(obj_scopes)
+        versions = self.get_versions(scopes) if scopes else dict()
+
+        def get_entry_versions(obj_scopes):
+            if isinstance(obj_scopes, ScopeSet):
+                return obj_scopes.get_versions()
+            return dict((key, versions[key]) for key in
+                        (self.make_scope_key(scope) for scope in obj_scopes))
+
+        self.cache.set_many(dict(
+            (self.make_key(user_pk, ct_id, obj_pk),
+             (registry.get_mask(perms), get_entry_versions(obj_scopes)))
+            for user_pk, ct_id, obj_pk, perms, obj_scopes in entries),
+            self.timeout)
+
+    def delete(self, user_pk, ct_id, obj_pk):
+        self.cache.delete(self.make_key(user_pk, ct_id, obj_pk))
+
+    def get_entry(self, name, versions):
+        """
+        Fetch a named value stored along with scope versions, or None if
+        it's missing or was stored with different versions.
+        """
+        entry = self.cache.get('%s:%s' % (self.prefix, name))
+        if entry is None or entry[1] != versions:
+            return None
+        return entry[0]
+
+    def set_entry(self, name, value, versions):
+        """Store a named value along with scope versions"""
+        self.cache.set('%s:%s' % (self.prefix, name), (value, versions),
+                       self.timeout)
+
+    def get_versions(self, scopes):
+        """
+        Get current versions for a set of scopes, starting a fresh version
+        for any scope not yet seen.
+        """
+        keys = [self.make_scope_key(scope) for scope in scopes]
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                self.cache.add(key, _new_version(), self.timeout)
+                versions[key] = self.cache.get(key)
+        return versions
+
+    def invalidate(self, scope):
+        """Bump the version of a scope, orphaning entries that depend on it"""
+        key = self.make_scope_key(scope)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # No version yet, or it expired. Either way, start a fresh one
+            # that won't match anything stored earlier.
+            self.cache.set(key, _new_version(), self.timeout)
+
+
+class ScopeSet(set):
+    """
+    Set of the cache scopes that a set of permissions relies on, which
+    snapshots the version of each scope as it's added. Scopes are added
+    before the data they cover is read, so an invalidation that lands while
+    permissions are being resolved leaves the stored entry stale, rather
+    than being stamped onto it.
+    """
+    def __init__(self, cache, scopes=()):
+        super(ScopeSet, self).__init__()
+        self.cache = cache
+        self.versions = dict()
+        self.update(scopes)
+
+    def add(self, scope):
+        self.update((scope,))
+
+    def update(self, scopes):
+        if isinstance(scopes, ScopeSet):
+            for key, version in scopes.versions.items():
+                self.versions.setdefault(key, version)
+        scopes = list(scopes)
+        snapshot_scopes([(self, scopes)])
+        super(ScopeSet, self).update(scopes)
+
+    def snapshot(self, scopes):
+        """Snapshot versions for scopes that may be added later on"""
+        snapshot_scopes([(self, scopes)])
+
+    def get_versions(self):
+        """Get the snapshotted versions of the scopes in this set"""
+        return dict((key, self.versions[key]) for key in
+                    (self.cache.make_scope_key(scope) for scope in self))
+
+
+def snapshot_scopes(pairs):
+    """
+    Snapshot versions for many ScopeSets at once, reading all of the missing
+    versions in one go, given a list of (scope_set, scopes) pairs. Pairs
+    with None in place of a ScopeSet are skipped.
+    """
+    pairs = [(scope_set, dict((scope_set.cache.make_scope_key(scope), scope)
+                              for scope in scopes))
+             for scope_set, scopes in pairs if scope_set is not None]
+    missing = dict()
+    for scope_set, scopes in pairs:
+        for key, scope in scopes.items():
+            if key not in scope_set.versions:
+                missing[key] = scope
+    if not missing:
+        return
+    versions = pairs[0][0].cache.get_versions(list(missing.values()))
+    for scope_set, scopes in pairs:
+        for key in scopes:
+            scope_set.versions.setdefault(key, versions.get(key))
+
+
+def _new_version():
+    return int(time.time() * 1000000)
+
+
+def object_scope(ct_id, obj_pk):
+    """Scope covering permissions granted by a single content object"""
+    return ('obj', ct_id, obj_pk)
+
+
+def team_scope(team_pk):
+    """Scope covering permissions granted by a Team and its Roles"""
+    return ('team', team_pk)
+
+
+def user_scope(user):
+    """Scope covering details of a user, such as group memberships"""
+    if user.is_anonymous():
+        return ('user', DEFAULT_ANONYMOUS_USER_PK)
+    return ('user', user.pk)
+
+
+def get_permission_cache():
+    """
+    Get the PermissionCache configured in settings, or None if caching is
+    disabled.
+    """
+    alias = getattr(settings, 'TEAMWORK_CACHE', None)
+    if not alias:
+        return None
+    if alias not in _django_caches:
+        _django_caches[alias] = _get_django_cache(alias)
+    return PermissionCache(
+        _django_caches[alias],
+        timeout=getattr(settings, 'TEAMWORK_CACHE_TIMEOUT', DEFAULT_TIMEOUT),
+        prefix=getattr(settings, 'TEAMWORK_CACHE_PREFIX', DEFAULT_PREFIX))
+
+
+def start_request_cache():
+    """Start a fresh request-scoped cache for the current thread"""
+    _local.perms = dict()
+
+
+def end_request_cache():
+    """Discard the request-scoped cache for the current thread"""
+    _local.perms = None
+
+
+def get_request_cache():
+    """
+    Get the request-scoped cache dict for the current thread, or None if no
+    request is in progress.
+    """
+    return getattr(_local, 'perms', None)
+
+
+def clear_request_cache():
+    """Empty the request-scoped cache, if any, after a change in perms"""
+    perms = get_request_cache()
+    if perms is not None:
+        perms.clear()
+
+
+def get_user_groups(user):
+    """
+    Get (id, name) pairs for a user's groups, fetched at most once per
+    request when the request-scoped cache is active.
+    """
+    request_cache = get_request_cache()
+    key = ('groups', user.pk)
+    if request_cache is not None and key in request_cache:
+        return request_cache[key]
+    groups = frozenset(user.groups.values_list('id', 'name'))
+    if request_cache is not None:
+        request_cache[key] = groups
+    return groups
@@ -0,0 +1,89 @@
+"""
+Per-request instrumentation of permission checks, for finding the views that
+spend their time on authorization.
+
+Add the middleware in ``settings.py`` to record each request::
+
+    MIDDLEWARE_CLASSES = (
+        # ...
+        'teamwork.middleware.InstrumentationMiddleware',
+        # ...
+    )
+
+While a request is being recorded, every check through
+``TeamworkBackend.get_all_permissions()`` counts its time, queries, whether
+it was answered from a cache, and which stage of resolution decided it.
+Checks in bulk, through ``get_all_permissions_bulk()``, ``filter_permitted()``,
+and ``resolve_subtree()``, count the same except for the stage.
+"""
+import threading
+
+
+STAGES = ('superuser', 'team', 'object', 'parent', 'site', 'settings',
+          'none')
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """Counts of the permission checks made during one request"""
+
+    def __init__(self):
+        self.checks = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.queries = 0
+        self.time = 0.0
+        self.stages = dict((stage, 0) for stage in STAGES)
+
+    def record_check(self, duration, queries, info):
+        """Record one check, with the info filled in by the backend"""
+        self.checks += 1
+        self.queries += queries
+        self.time += duration
+        if info.get('cached'):
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            stage = info.get('stage')
+            if stage in self.stages:
+                self.stages[stage] += 1
+
+    def record_bulk_checks(self, duration, queries, info):
+        """
+        Record a batch of checks, with the numbers of cache 'hits' and
+        'misses' filled in by the backend. Batches aren't counted by stage.
+        """
+        self.checks += info.get('hits', 0) + info.get('misses', 0)
+        self.cache_hits += info.get('hits', 0)
+        self.cache_misses += info.get('misses', 0)
+        self.queries += queries
+        self.time += duration
+
+    def as_dict(self):
+        return dict(checks=self.checks, cache_hits=self.cache_hits,
+                    cache_misses=self.cache_misses, queries=self.queries,
+                    time=self.time, stages=dict(self.stages))
+
+    def server_timing(self):
+        """Describe the checks as a Server-Timing header value"""
+        return 'teamwork;dur=%.1f;desc="%s checks, %s queries"' % (
+            self.time * 1000.0, self.checks, self.queries)
+
+
+def start_stats():
+    """Start recording checks for the current thread"""
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def end_stats():
+    """Stop recording checks for the current thread, returning the stats"""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def get_request_stats():
+    """Get the stats being recorded for the current thread, if any"""
+    return getattr(_local, 'stats', None)
@@ -0,0 +1,49 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from teamwork.cache import get_permission_cache
+from teamwork.precompute import run_precompute
+
+from .teamwork_warm import USER_OPTIONS, get_users, get_content_type
+
+
+class Command(BaseCommand):
+    args = '<app_label.model app_label.model ...>'
+    help = ('Resolve permissions for all objects of some content types into '
+            'the shared cache, in parallel worker processes')
+
+    option_list = BaseCommand.option_list + USER_OPTIONS + (
+        make_option('--processes', dest='processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Worker processes, or 0 to work in this process '
+                         '(default %s)' % multiprocessing.cpu_count()),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=1000, help='Range of object IDs per chunk'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100, help='Objects resolved per batch'),
+        make_option('--state', dest='state', default=None,
+                    help='Record finished chunks in this file, and skip '
+                         'those already recorded there'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: teamwork_precompute %s' % self.args)
+        if get_permission_cache() is None:
+            raise CommandError('TEAMWORK_CACHE is not configured')
+        cts = [get_content_type(name) for name in args]
+        users = get_users(options)
+
+        def progress(done, total, rate):
+            self.stdout.write('%s of %s chunks done, %.0f pairs/sec\n' % (
+                done, total, rate))
+
+        pairs = run_precompute(cts, users,
+                               chunk_size=options['chunk_size'],
+                               batch_size=options['batch_size'],
+                               processes=options['processes'],
+                               state_path=options['state'],
+                               progress=progress)
+        self.stdout.write('Precomputed %s (user, object) pairs\n' % pairs)
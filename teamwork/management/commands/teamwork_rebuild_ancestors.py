@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:
+    # Django < 1.7
+    from django.db.models import get_models
+
+from teamwork.ancestors import uses_ancestor_index, rebuild_ancestor_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the nearest permission ancestor index for all models '
+            'that set permission_ancestor_index')
+
+    def handle(self, *args, **options):
+        for model_cls in get_models():
+            if uses_ancestor_index(model_cls):
+                rebuild_ancestor_index(model_cls)
+                self.stdout.write('Rebuilt ancestor index for %s.%s\n' % (
+                    model_cls._meta.app_label, model_cls._meta.object_name))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from teamwork.models import MemberPermissions
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the materialized permissions of all Team members from '
+            'their Roles')
+
+    def handle(self, *args, **options):
+        MemberPermissions.objects.rebuild()
+        self.stdout.write('Rebuilt permissions for %s Team members\n' %
+                          MemberPermissions.objects.count())
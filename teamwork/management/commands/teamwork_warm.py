@@ -0,0 +1,101 @@
+import json
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from teamwork.cache import get_permission_cache
+from teamwork.warming import get_warm_users, warm_permissions
+
+
+# Options choosing users, shared with teamwork_precompute
+USER_OPTIONS = (
+    make_option('--user', dest='usernames', action='append',
+                default=[], help='Username to warm (repeatable)'),
+    make_option('--team', dest='teams', action='append', default=[],
+                help='Warm for members of this Team (repeatable)'),
+    make_option('--anonymous', dest='anonymous', action='store_true',
+                default=False, help='Warm for anonymous users'),
+    make_option('--authenticated', dest='authenticated',
+                action='store_true', default=False,
+                help='Warm for all active users'),
+)
+
+
+def get_users(options):
+    """Get the users chosen by USER_OPTIONS, or complain if there are none"""
+    users = get_warm_users(usernames=options['usernames'],
+                           anonymous=options['anonymous'],
+                           authenticated=options['authenticated'],
+                           teams=options['teams'])
+    if not users:
+        raise CommandError('No users to warm; use --user, --team, '
+                           '--anonymous, or --authenticated')
+    return users
+
+
+class Command(BaseCommand):
+    args = '<app_label.model>'
+    help = ('Resolve permissions for objects of a content type into the '
+            'shared cache, for a set of users')
+
+    option_list = BaseCommand.option_list + USER_OPTIONS + (
+        make_option('--ids', dest='ids', default=None,
+                    help='Comma-separated IDs of the objects to warm'),
+        make_option('--filter', dest='filters', action='append',
+                    default=[],
+                    help='QuerySet filter for the objects to warm, as '
+                         'lookup=value, with JSON values (repeatable)'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100, help='Objects resolved per batch'),
+        make_option('--rate', dest='rate', type='float', default=None,
+                    help='Maximum (user, object) pairs resolved per second'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: teamwork_warm %s' % self.args)
+        if get_permission_cache() is None:
+            raise CommandError('TEAMWORK_CACHE is not configured')
+
+        ct = get_content_type(args[0])
+        queryset = ct.model_class()._default_manager.all()
+
+        if options['ids']:
+            queryset = queryset.filter(
+                pk__in=[pk.strip() for pk in options['ids'].split(',')])
+        for spec in options['filters']:
+            queryset = queryset.filter(**dict([parse_filter(spec)]))
+
+        users = get_users(options)
+
+        def progress(done, total):
+            self.stdout.write('Warmed %s of %s objects for %s users\n' % (
+                done, total, len(users)))
+
+        pairs = warm_permissions(users, queryset,
+                                 batch_size=options['batch_size'],
+                                 rate=options['rate'], progress=progress)
+        self.stdout.write('Warmed %s (user, object) pairs\n' % pairs)
+
+
+def parse_filter(spec):
+    """Parse a lookup=value filter, with the value as JSON if possible"""
+    if '=' not in spec:
+        raise CommandError('Filters should look like lookup=value: %s' %
+                           spec)
+    lookup, value = spec.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return str(lookup), value
+
+
+def get_content_type(name):
+    """Get a ContentType by app_label.model name"""
+    try:
+        app_label, model = name.lower().split('.')
+        return ContentType.objects.get_by_natural_key(app_label, model)
+    except (ValueError, ContentType.DoesNotExist):
+        raise CommandError('Unknown content type %s' % name)
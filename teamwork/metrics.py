@@ -0,0 +1,181 @@
+"""
+Pluggable metrics for production monitoring of permission checks.
+
+Name a metrics backend class in ``settings.py`` to enable them::
+
+    TEAMWORK_METRICS_BACKEND = 'teamwork.metrics.LoggingMetrics'
+
+Backends receive these metrics:
+
+* ``teamwork.object``, ``teamwork.site``, ``teamwork.settings`` - seconds
+  taken by each stage of resolution for a single object, passed to
+  ``timing()``;
+* ``teamwork.object_bulk``, ``teamwork.site_bulk``,
+  ``teamwork.settings_bulk`` - seconds taken by each stage of resolution for
+  a batch of objects, passed to ``timing()``;
+* ``teamwork.cache.hit``, ``teamwork.cache.miss`` - checks answered from a
+  cache or not, passed to ``incr()``;
+* ``teamwork.parent_depth`` - number of parents consulted for an object
+  without an opinion of its own, passed to ``observe()``.
+
+With no backend configured, ``get_metrics()`` returns None and every hook is
+skipped after a single check. It also returns None within
+``metrics_suppressed()``, which keeps debugging tools such as
+``TeamworkBackend.explain()`` out of the metrics.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+try:
+    from django.utils.module_loading import import_string
+except ImportError:
+    # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
+
+
+_backend = None
+_backend_source = None
+
+# Per-thread count of metrics_suppressed() blocks entered.
+_local = threading.local()
+
+
+class BaseMetrics(object):
+    """Metrics backend that discards everything; subclasses override"""
+
+    def timing(self, name, seconds):
+        """Record a duration, in seconds"""
+        self.observe(name, seconds)
+
+    def observe(self, name, value):
+        """Record a sample of a distribution"""
+        pass
+
+    def incr(self, name, count=1):
+        """Increment a counter"""
+        pass
+
+
+class NullMetrics(BaseMetrics):
+    """Metrics backend that discards everything"""
+
+
+class MemoryMetrics(BaseMetrics):
+    """
+    Metrics backend that keeps counters and samples in memory, for tests and
+    for poking at from a shell.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.samples = dict()
+
+    def observe(self, name, value):
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def get_histogram(self, name, buckets):
+        """
+        Count samples into buckets, given their ascending upper bounds. The
+        last count is of samples above the last bound.
+        """
+        counts = [0 for bound in buckets] + [0]
+        for value in self.samples.get(name, ()):
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+    def get_cache_hit_ratio(self):
+        """Get the ratio of checks answered from a cache, or None"""
+        hits = self.counters.get('teamwork.cache.hit', 0)
+        misses = self.counters.get('teamwork.cache.miss', 0)
+        if not hits + misses:
+            return None
+        return float(hits) / (hits + misses)
+
+
+class LoggingMetrics(BaseMetrics):
+    """Metrics backend that logs each metric to the teamwork.metrics logger"""
+
+    def __init__(self):
+        self.log = logging.getLogger('teamwork.metrics')
+
+    def timing(self, name, seconds):
+        self.log.debug('%s: %.2fms', name, seconds * 1000.0)
+
+    def observe(self, name, value):
+        self.log.debug('%s: %s', name, value)
+
+    def incr(self, name, count=1):
+        self.log.debug('%s: +%s', name, count)
+
+
+def get_metrics():
+    """
+    Get the metrics backend from settings, or None if there isn't one or
+    metrics are suppressed.
+    """
+    global _backend, _backend_source
+    source = getattr(settings, 'TEAMWORK_METRICS_BACKEND', None)
+    if not source or getattr(_local, 'suppressed', 0):
+        return None
+    if _backend is None or _backend_source != source:
+        _backend = import_string(source)()
+        _backend_source = source
+    return _backend
+
+
+@contextmanager
+def metrics_suppressed():
+    """Report nothing to the metrics backend from this thread, for a while"""
+    _local.suppressed = getattr(_local, 'suppressed', 0) + 1
+    try:
+        yield
+    finally:
+        _local.suppressed -= 1
+
+
+def timed(name):
+    """Decorate a function to report its duration to the metrics backend"""
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            metrics = get_metrics()
+            if metrics is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.timing(name, time.time() - start)
+        return inner
+    return decorator
+
+
+def _reset_metrics(**kwargs):
+    global _backend, _backend_source
+    if kwargs.get('setting', None) == 'TEAMWORK_METRICS_BACKEND':
+        _backend = _backend_source = None
+
+
+setting_changed.connect(_reset_metrics,
+                        dispatch_uid='teamwork_reset_metrics')
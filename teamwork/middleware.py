@@ -0,0 +1,44 @@
+from django.conf import settings
+
+from .cache import start_request_cache, end_request_cache
+from .instrumentation import start_stats, end_stats
+
+
+class RequestCacheMiddleware(object):
+    """
+    Keeps resolved permissions for the duration of each request, so that an
+    object fetched more than once is only resolved once.
+    """
+    def process_request(self, request):
+        start_request_cache()
+        return None
+
+    def process_response(self, request, response):
+        end_request_cache()
+        return response
+
+    def process_exception(self, request, exception):
+        end_request_cache()
+        return None
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records the permission checks made during each request. The stats are
+    left on ``request.teamwork_stats``, and are described in a
+    ``Server-Timing`` header if ``TEAMWORK_SERVER_TIMING`` is True.
+    """
+    def process_request(self, request):
+        request.teamwork_stats = start_stats()
+        return None
+
+    def process_response(self, request, response):
+        stats = end_stats()
+        if stats is not None and getattr(settings, 'TEAMWORK_SERVER_TIMING',
+                                         False):
+            response['Server-Timing'] = stats.server_timing()
+        return response
+
+    def process_exception(self, request, exception):
+        end_stats()
+        return None
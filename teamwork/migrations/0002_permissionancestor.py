@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('teamwork', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PermissionAncestor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('ancestor_id', models.PositiveIntegerField(db_index=True, null=True, blank=True)),
+                ('ancestor_type', models.ForeignKey(related_name='+', blank=True, to='contenttypes.ContentType', null=True)),
+                ('content_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='permissionancestor',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('teamwork', '0002_permissionancestor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberPermissions',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('permission_ids', models.TextField(blank=True)),
+                ('team', models.ForeignKey(related_name='+', to='teamwork.Team')),
+                ('user', models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Member permissions',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='memberpermissions',
+            unique_together=set([('user', 'team')]),
+        ),
+    ]
@@ -10,6 +10,9 @@ from django.db import models, transaction
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 
+from .base_policy import is_owner
+from .registry import registry
+
 
 class TeamManager(models.Manager):
     """
@@ -22,6 +25,45 @@ class TeamManager(models.Manager):
         teams = self.filter(id__in=member_teams)
         return teams
 
+    def get_member_permission_ids(self, user, team_id):
+        """
+        Get IDs of the Permissions granted to a user by Roles on a Team, or
+        None if the user is not a member of the Team.
+        """
+        if use_member_permissions_table():
+            return MemberPermissions.objects.get_permission_ids(user, team_id)
+        # One row per Role and Permission, or a None Permission for a Role
+        # without any, so that membership and Permissions come at once.
+        rows = list(Role.objects.filter(team=team_id, users=user)
+                                .values_list('permissions', flat=True))
+        if not rows:
+            return None
+        return [perm_id for perm_id in rows if perm_id is not None]
+
+    def get_member_permissions_bulk(self, user, team_ids):
+        """
+        Get the names of Permissions granted to a user by Roles on each of a
+        set of Teams, in two queries at most. Returns a dict of sets indexed
+        by Team ID, omitting Teams of which the user is not a member.
+        """
+        if use_member_permissions_table():
+            perm_ids = MemberPermissions.objects.get_permission_ids_bulk(
+                user, team_ids)
+            return dict((team_id, set(registry.get_names(ids)))
+                        for team_id, ids in perm_ids.items())
+        memberships = (Role.users.through.objects
+                           .filter(user=user, role__team__in=list(team_ids))
+                           .values_list('role', 'role__team'))
+        role_teams = dict(memberships)
+        perms = dict((team_id, set()) for team_id in role_teams.values())
+        if role_teams:
+            rows = (Role.permissions.through.objects
+                        .filter(role__in=list(role_teams.keys()))
+                        .values_list('role', 'permission'))
+            for role_id, perm_id in rows:
+                perms[role_teams[role_id]].add(registry.get_name(perm_id))
+        return perms
+
     def get_team_roles_managed_by(self, manager_user, managed_user):
         """
         Assemble a list of roles collated by team, for which the manager_user
@@ -84,6 +126,9 @@ class Team(models.Model):
     def has_user(self, user):
         """Determine whether the given user is a member of this team"""
         # TODO: founder is not considered a member without an associated role
+        if use_member_permissions_table():
+            return MemberPermissions.objects.filter(
+                user=user, team=self).exists()
         hits = (Role.users.through.objects
                     .filter(role__team=self, user=user)).count()
         return hits > 0
@@ -108,12 +153,32 @@ class Team(models.Model):
                     .filter(role__in=role_ids)
                     .select_related())
 
+    def get_all_permission_ids(self, user):
+        """Get IDs of all Permissions applied to this User by Roles"""
+        if use_member_permissions_table():
+            return (MemberPermissions.objects.get_permission_ids(user, self.pk)
+                    or [])
+        role_ids = (Role.users.through.objects
+                        .filter(user=user, role__team=self)
+                        .values('role'))
+        return (Role.permissions.through.objects
+                    .filter(role__in=role_ids)
+                    .values_list('permission', flat=True))
+
 
 class RoleManager(models.Manager):
     """
     Manager and utilities for Roles
     """
-    pass
+    def bulk_grant(self, role_ids, user_ids):
+        """Grant many Roles to many users at once"""
+        return change_relations(self.model, role_ids,
+                                users=(user_ids, ()))
+
+    def bulk_revoke(self, role_ids, user_ids):
+        """Revoke many Roles from many users at once"""
+        return change_relations(self.model, role_ids,
+                                users=((), user_ids))
 
 
 class Role(models.Model):
@@ -164,26 +229,217 @@ class Role(models.Model):
         return permissions
 
     def add_permissions_by_name(self, names, obj=None):
-        from .shortcuts import get_permission_by_name
-        self.permissions.add(*(get_permission_by_name(name, obj)
-                             for name in names))
+        from .shortcuts import get_permission_ids_by_names
+        self.permissions.add(*get_permission_ids_by_names(names, obj))
+
+    def sync_users(self, user_ids):
+        """Grant this Role to exactly the given users, and no others"""
+        return sync_relation(self, 'users', user_ids)
+
+
+class MemberPermissionsManager(models.Manager):
+    """
+    Manager and utilities for materialized Team member permissions
+    """
+    def get_permission_ids(self, user, team_id):
+        """
+        Get IDs of the Permissions granted to a user on a Team, or None if
+        the user is not a member of the Team.
+        """
+        rows = list(self.filter(user=user, team=team_id)
+                        .values_list('permission_ids', flat=True)[:1])
+        if not rows:
+            return None
+        return parse_permission_ids(rows[0])
+
+    def get_permission_ids_bulk(self, user, team_ids):
+        """
+        Get IDs of the Permissions granted to a user on each of a set of
+        Teams, as a dict of lists indexed by Team ID, omitting Teams of which
+        the user is not a member.
+        """
+        rows = (self.filter(user=user, team__in=list(team_ids))
+                    .values_list('team', 'permission_ids'))
+        return dict((team_id, parse_permission_ids(perm_ids))
+                    for team_id, perm_ids in rows)
+
+    def refresh(self, team_ids, user_ids=None):
+        """
+        Recompute the permissions of members of a set of Teams from their
+        Roles, optionally for just a set of users.
+        """
+        team_ids = list(set(team_ids))
+        if not team_ids:
+            return
+        memberships = Role.users.through.objects.filter(
+            role__team__in=team_ids)
+        existing = self.filter(team__in=team_ids)
+        if user_ids is not None:
+            user_ids = list(set(user_ids))
+            memberships = memberships.filter(user__in=user_ids)
+            existing = existing.filter(user__in=user_ids)
+
+        members = dict()
+        role_keys = dict()
+        for user_id, role_id, team_id in memberships.values_list(
+                'user', 'role', 'role__team'):
+            members.setdefault((user_id, team_id), set())
+            role_keys.setdefault(role_id, []).append((user_id, team_id))
+        if role_keys:
+            rows = (Role.permissions.through.objects
+                        .filter(role__in=list(role_keys.keys()))
+                        .values_list('role', 'permission'))
+            for role_id, perm_id in rows:
+                for key in role_keys[role_id]:
+                    members[key].add(perm_id)
+
+        with transaction.atomic():
+            existing.delete()
+            self.bulk_create([
+                self.model(user_id=user_id, team_id=team_id,
+                           permission_ids=format_permission_ids(perm_ids))
+                for (user_id, team_id), perm_ids in members.items()])
+
+    def rebuild(self):
+        """Recompute the permissions of all members of all Teams"""
+        with transaction.atomic():
+            self.all().delete()
+            self.refresh(Team.objects.values_list('pk', flat=True))
+
+
+class MemberPermissions(models.Model):
+    """
+    Permissions granted to a user by their Roles on a Team, materialized so
+    that a check on a Team's object needs a single lookup. There's a row for
+    every member of a Team, even those granted no permissions. Only
+    maintained when TEAMWORK_MEMBER_PERMISSIONS_TABLE is True.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    team = models.ForeignKey(Team, related_name='+')
+    permission_ids = models.TextField(blank=True)
+
+    objects = MemberPermissionsManager()
+
+    class Meta:
+        unique_together = (('user', 'team'),)
+        verbose_name_plural = _('Member permissions')
+
+    def __unicode__(self):
+        return u'MemberPermissions(%s, %s)' % (self.user_id, self.team_id)
+
+
+# Keep bulk deletes under the query parameter limits of some databases
+BULK_CHUNK_SIZE = 500
+
+
+def change_relations(model_cls, object_ids, **changes):
+    """
+    Add and remove rows in many-to-many relations of many objects at once,
+    in one transaction. Each keyword names a relation, with a pair of
+    (IDs to add, IDs to remove) for every one of the objects.
+
+    Rather than an m2m_changed signal for each object, one relations_changed
+    signal is sent for the lot. Returns a dict of sets of the related IDs
+    actually added or removed, indexed by relation name.
+    """
+    from .signals import relations_changed
+    object_ids = list(set(object_ids))
+    changed = dict()
+    with transaction.atomic():
+        for name, (add_ids, remove_ids) in changes.items():
+            field = model_cls._meta.get_field(name)
+            through = field.rel.through
+            src, dst = field.m2m_field_name(), field.m2m_reverse_field_name()
+            add_ids, remove_ids = set(add_ids), set(remove_ids)
+            if not object_ids or not (add_ids or remove_ids):
+                continue
+            existing = set(
+                through.objects.filter(**{'%s__in' % src: object_ids})
+                               .values_list(src, dst))
+
+            new_rows = [(src_id, dst_id)
+                        for src_id in object_ids for dst_id in add_ids
+                        if (src_id, dst_id) not in existing]
+            through.objects.bulk_create([
+                through(**{'%s_id' % src: src_id, '%s_id' % dst: dst_id})
+                for src_id, dst_id in new_rows])
+
+            gone_ids = set(dst_id for src_id, dst_id in existing
+                           if dst_id in remove_ids)
+            gone = list(gone_ids)
+            for start in range(0, len(gone), BULK_CHUNK_SIZE):
+                through.objects.filter(**{
+                    '%s__in' % src: object_ids,
+                    '%s__in' % dst: gone[start:start + BULK_CHUNK_SIZE],
+                }).delete()
+
+            ids = set(dst_id for src_id, dst_id in new_rows) | gone_ids
+            if ids:
+                changed[name] = ids
+
+    if changed:
+        relations_changed.send(sender=model_cls, object_ids=object_ids,
+                               relations=changed)
+    return changed
+
+
+def sync_relation(obj, name, related_ids):
+    """
+    Set a many-to-many relation of an object to exactly the given IDs,
+    adding and removing only the difference, via change_relations()
+    """
+    field = obj._meta.get_field(name)
+    current = set(field.rel.through.objects
+                       .filter(**{field.m2m_field_name(): obj.pk})
+                       .values_list(field.m2m_reverse_field_name(),
+                                    flat=True))
+    wanted = set(related_ids)
+    return change_relations(obj.__class__, (obj.pk,),
+                            **{name: (wanted - current, current - wanted)})
+
+
+def use_member_permissions_table():
+    """Determine whether member permissions are looked up by table"""
+    return getattr(settings, 'TEAMWORK_MEMBER_PERMISSIONS_TABLE', False)
+
+
+def parse_permission_ids(value):
+    return [int(perm_id) for perm_id in value.split(',') if perm_id]
+
+
+def format_permission_ids(perm_ids):
+    return ','.join(str(perm_id) for perm_id in sorted(perm_ids))
 
 
 class PolicyManager(models.Manager):
     """
     Manager and utilities for Policies
     """
-    def get_all_permissions(self, user, obj):
+    def get_user_filter(self, user):
+        """
+        Build a filter matching Policies that apply to a user, apart from
+        any that apply to owners of content objects.
+        """
         if user.is_anonymous():
-            user_filter = Q(anonymous=True)
-        else:
-            groups = user.groups.all().values('id')
-            user_filter = (Q(authenticated=True) |
-                           Q(users__pk=user.pk) |
-                           Q(groups__in=groups))
-            if (hasattr(obj, 'get_owner_user') and
-                    user == obj.get_owner_user()):
-                user_filter |= Q(apply_to_owners=True)
+            return Q(anonymous=True)
+        groups = user.groups.all().values('id')
+        return (Q(authenticated=True) |
+                Q(users__pk=user.pk) |
+                Q(groups__in=groups))
+
+    def get_matching_policies(self, user, obj):
+        """Get the Policies on an object that apply to a user"""
+        user_filter = self.get_user_filter(user)
+        if is_owner(user, obj):
+            user_filter |= Q(apply_to_owners=True)
+        ct = ContentType.objects.get_for_model(obj)
+        return self.filter(user_filter, content_type__pk=ct.id,
+                           object_id=obj.pk).distinct()
+
+    def get_all_permissions(self, user, obj):
+        user_filter = self.get_user_filter(user)
+        if is_owner(user, obj):
+            user_filter |= Q(apply_to_owners=True)
         ct = ContentType.objects.get_for_model(obj)
         policies = self.filter(user_filter,
                                content_type__pk=ct.id,
@@ -192,6 +448,81 @@ class PolicyManager(models.Manager):
             return None
         return chain(*(policy.permissions.all() for policy in policies))
 
+    def get_all_permission_ids(self, user, obj):
+        """
+        Get IDs of all Permissions granted to a user by Policies on an
+        object, or None if no Policies apply to the user.
+        """
+        # One row per Policy and Permission, or a None Permission for a
+        # Policy without any, so that Policies and Permissions come at once.
+        rows = list(self.get_matching_policies(user, obj)
+                        .values_list('id', 'permissions'))
+        if not rows:
+            return None
+        return [perm_id for policy_id, perm_id in rows if perm_id is not None]
+
+    def get_all_permissions_bulk(self, user, objects):
+        """
+        Get the names of Permissions granted by Policies to a user for each
+        of a list of objects, in a fixed number of queries per content type.
+        Returns a dict of sets indexed by (content type ID, object ID),
+        omitting objects with no Policies that apply to the user.
+        """
+        objs_by_ct = dict()
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj)
+            objs_by_ct.setdefault(ct.id, dict())[obj.pk] = obj
+
+        user_filter = self.get_user_filter(user)
+
+        # Find the IDs of policies that apply, mapped to their objects
+        policy_keys = dict()
+        for ct_id, objs in objs_by_ct.items():
+            rows = (self.filter(user_filter, content_type__pk=ct_id,
+                                object_id__in=list(objs.keys()))
+                        .values_list('id', 'object_id').distinct())
+            policy_keys.update((p_id, (ct_id, o_id)) for p_id, o_id in rows)
+
+            # Owner policies need a per-object check, so only look at the
+            # owners of objects that actually have such policies.
+            if user.is_anonymous():
+                continue
+            rows = (self.filter(apply_to_owners=True, content_type__pk=ct_id,
+                                object_id__in=list(objs.keys()))
+                        .exclude(id__in=list(policy_keys.keys()))
+                        .values_list('id', 'object_id'))
+            for p_id, o_id in rows:
+                obj = objs[o_id]
+                if is_owner(user, obj):
+                    policy_keys[p_id] = (ct_id, o_id)
+
+        perms = dict((key, set()) for key in policy_keys.values())
+        if policy_keys:
+            rows = (self.model.permissions.through.objects
+                        .filter(policy__in=list(policy_keys.keys()))
+                        .values_list('policy', 'permission'))
+            for p_id, perm_id in rows:
+                perms[policy_keys[p_id]].add(registry.get_name(perm_id))
+        return perms
+
+    def bulk_grant(self, policy_ids, users=(), groups=(), permissions=()):
+        """
+        Add users, groups, and Permissions to many Policies at once, given
+        their IDs
+        """
+        return change_relations(self.model, policy_ids,
+                                users=(users, ()), groups=(groups, ()),
+                                permissions=(permissions, ()))
+
+    def bulk_revoke(self, policy_ids, users=(), groups=(), permissions=()):
+        """
+        Remove users, groups, and Permissions from many Policies at once,
+        given their IDs
+        """
+        return change_relations(self.model, policy_ids,
+                                users=((), users), groups=((), groups),
+                                permissions=((), permissions))
+
 
 class Policy(models.Model):
     """
@@ -243,8 +574,89 @@ class Policy(models.Model):
         return u'Policy(%s)' % self.content_object
 
     def add_permissions_by_name(self, names, obj=None):
-        from .shortcuts import get_permission_by_name
+        from .shortcuts import get_permission_ids_by_names
         if obj is None:
-            obj = self.content_object
-        self.permissions.add(*(get_permission_by_name(name, obj)
-                             for name in names))
+            # Only the app_label is needed, so skip fetching the object
+            ct = ContentType.objects.get_for_id(self.content_type_id)
+            obj = ct.model_class() or self.content_object
+        self.permissions.add(*get_permission_ids_by_names(names, obj))
+
+    def sync_users(self, user_ids):
+        """Apply this Policy to exactly the given users, and no others"""
+        return sync_relation(self, 'users', user_ids)
+
+    def sync_groups(self, group_ids):
+        """Apply this Policy to exactly the given groups, and no others"""
+        return sync_relation(self, 'groups', group_ids)
+
+    def sync_permissions(self, permission_ids):
+        """Grant exactly the given Permissions with this Policy"""
+        return sync_relation(self, 'permissions', permission_ids)
+
+
+class PermissionAncestorManager(models.Manager):
+    """
+    Manager and utilities for the nearest permission ancestor index
+    """
+    def get_entries(self, ct_id, object_ids):
+        """
+        Get (content type ID, object ID) of the nearest ancestor for each of
+        a list of objects, as a dict indexed by object ID, omitting objects
+        not in the index. Objects without such an ancestor map to
+        (None, None).
+        """
+        rows = (self.filter(content_type__pk=ct_id,
+                            object_id__in=list(object_ids))
+                    .values_list('object_id', 'ancestor_type', 'ancestor_id'))
+        return dict((obj_id, (a_type, a_id)) for obj_id, a_type, a_id in rows)
+
+    def set_entries(self, ct_id, entries):
+        """
+        Record the nearest ancestor for each object ID in a dict, as
+        returned by get_entries
+        """
+        existing = set(self.filter(content_type__pk=ct_id,
+                                   object_id__in=list(entries.keys()))
+                           .values_list('object_id', flat=True))
+        by_ancestor = dict()
+        for obj_id, ancestor in entries.items():
+            if obj_id in existing:
+                by_ancestor.setdefault(ancestor, []).append(obj_id)
+        for (a_type, a_id), obj_ids in by_ancestor.items():
+            (self.filter(content_type__pk=ct_id, object_id__in=obj_ids)
+                 .update(ancestor_type=a_type, ancestor_id=a_id))
+        self.bulk_create([
+            self.model(content_type_id=ct_id, object_id=obj_id,
+                       ancestor_type_id=a_type, ancestor_id=a_id)
+            for obj_id, (a_type, a_id) in entries.items()
+            if obj_id not in existing])
+
+
+class PermissionAncestor(models.Model):
+    """
+    Nearest ancestor of a content object that carries a Policy or belongs to
+    a Team, maintained for models that set permission_ancestor_index, so that
+    permission checks can skip the ancestors in between.
+    """
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+
+    # Both empty, if no ancestor carries a Policy or belongs to a Team.
+    ancestor_type = models.ForeignKey(ContentType, related_name='+',
+                                      blank=True, null=True)
+    ancestor_id = models.PositiveIntegerField(blank=True, null=True,
+                                              db_index=True)
+
+    objects = PermissionAncestorManager()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    def __unicode__(self):
+        return u'PermissionAncestor(%s:%s -> %s:%s)' % (
+            self.content_type_id, self.object_id,
+            self.ancestor_type_id, self.ancestor_id)
+
+
+# Wire up cache invalidation, now that the models are defined.
+from . import signals
@@ -0,0 +1,42 @@
+"""
+A panel for django-debug-toolbar, showing the permission checks made during
+a request. Add it to the panels in ``settings.py``, if the toolbar is
+installed::
+
+    DEBUG_TOOLBAR_PANELS = (
+        # ...
+        'teamwork.panels.TeamworkPanel',
+    )
+"""
+from django.utils.translation import ugettext_lazy as _
+
+from debug_toolbar.panels import Panel
+
+from .instrumentation import start_stats, end_stats, STAGES
+
+
+class TeamworkPanel(Panel):
+    """Counts of teamwork permission checks, with their queries and time"""
+    title = _('Teamwork')
+    template = 'teamwork/debug_panel.html'
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        if not stats:
+            return ''
+        return _('%(checks)s checks in %(time).1fms') % dict(
+            checks=stats['checks'], time=stats['time'] * 1000.0)
+
+    def process_request(self, request):
+        start_stats()
+
+    def process_response(self, request, response):
+        stats = end_stats()
+        if stats is None:
+            return
+        data = stats.as_dict()
+        data['time_ms'] = data['time'] * 1000.0
+        data['stage_counts'] = [(stage, data['stages'][stage])
+                                for stage in STAGES]
+        self.record_stats(data)
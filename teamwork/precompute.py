@@ -0,0 +1,130 @@
+"""
+Precomputing permissions into the shared cache for many (user, object)
+pairs, in parallel worker processes.
+
+Work is split into chunks by content type and ranges of object IDs. Each
+chunk is resolved by a worker with its own database connection, and written
+to the shared cache in bulk. Finished chunks can be recorded in a state file,
+so that an interrupted run picks up where it left off.
+"""
+import json
+import multiprocessing
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+
+from .cache import get_permission_cache
+from .warming import warm_permissions
+
+
+def get_chunks(ct, chunk_size):
+    """
+    Split the objects of a content type into (ct_id, first_pk, last_pk)
+    chunks, covering fixed ranges of IDs so that they're stable between
+    runs. Ranges without objects are skipped.
+    """
+    model_cls = ct.model_class()
+    pks = model_cls._default_manager.values_list('pk', flat=True)
+    starts = sorted(set(pk - pk % chunk_size for pk in pks.iterator()))
+    return [(ct.id, start, start + chunk_size - 1) for start in starts]
+
+
+def chunk_key(chunk):
+    return '%s:%s-%s' % chunk
+
+
+def precompute_chunk(task):
+    """
+    Resolve permissions for a chunk of objects, for users given by a list
+    of user IDs, where None stands for anonymous users. Returns the chunk,
+    the number of (user, object) pairs resolved, and the seconds taken.
+    """
+    chunk, user_pks, batch_size = task
+    ct_id, first_pk, last_pk = chunk
+    start = time.time()
+
+    user_model = get_user_model()
+    users_by_pk = user_model.objects.in_bulk([pk for pk in user_pks
+                                              if pk is not None])
+    users = [AnonymousUser() if pk is None else users_by_pk[pk]
+             for pk in user_pks if pk is None or pk in users_by_pk]
+
+    model_cls = ContentType.objects.get_for_id(ct_id).model_class()
+    queryset = model_cls._default_manager.filter(pk__gte=first_pk,
+                                                 pk__lte=last_pk)
+    pairs = warm_permissions(users, queryset, batch_size=batch_size)
+    return chunk, pairs, time.time() - start
+
+
+def load_state(path):
+    """Load the keys of finished chunks from a state file, if any"""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as state_file:
+        return set(json.loads(line) for line in state_file if line.strip())
+
+
+def _init_worker():
+    """
+    Give each worker process its own database and cache connections,
+    rather than sharing those inherited from the parent.
+    """
+    for conn in connections.all():
+        conn.close()
+    cache = get_permission_cache()
+    if cache is not None and hasattr(cache.cache, 'close'):
+        cache.cache.close()
+
+
+def run_precompute(cts, users, chunk_size=1000, batch_size=100,
+                   processes=None, state_path=None, progress=None):
+    """
+    Precompute permissions for users on all objects of some content types.
+    Chunks are farmed out to a pool of processes, or run in this process
+    if processes is 0. Finished chunks are appended to the state file, if
+    given, and skipped if found there. After each chunk, progress is called
+    with the chunks done, the chunks to do, and the pairs per second so
+    far, if given. Returns the number of (user, object) pairs resolved.
+    """
+    if get_permission_cache() is None:
+        raise ValueError('TEAMWORK_CACHE is not configured')
+
+    user_pks = [None if user.is_anonymous() else user.pk for user in users]
+    done_keys = load_state(state_path)
+    chunks = [chunk for ct in cts for chunk in get_chunks(ct, chunk_size)
+              if chunk_key(chunk) not in done_keys]
+    tasks = [(chunk, user_pks, batch_size) for chunk in chunks]
+
+    pool = None
+    if processes == 0:
+        results = (precompute_chunk(task) for task in tasks)
+    else:
+        _init_worker()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        results = pool.imap_unordered(precompute_chunk, tasks)
+
+    state_file = open(state_path, 'a') if state_path else None
+    start = time.time()
+    done = total_pairs = 0
+    try:
+        for chunk, pairs, seconds in results:
+            done += 1
+            total_pairs += pairs
+            if state_file is not None:
+                state_file.write(json.dumps(chunk_key(chunk)) + '\n')
+                state_file.flush()
+            if progress is not None:
+                elapsed = time.time() - start
+                progress(done, len(tasks),
+                         total_pairs / elapsed if elapsed else 0.0)
+    finally:
+        if state_file is not None:
+            state_file.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return total_pairs
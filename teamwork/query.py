@@ -0,0 +1,299 @@
+"""
+Translation of teamwork's permission rules into QuerySet filters, so that the
+database can select (and paginate) only the objects a user may access::
+
+    class DocumentManager(PermittedManager):
+        pass
+
+    docs = Document.objects.permitted(request.user, 'wiki.view_document')
+
+Content models describe their permission hooks to the query builder with a
+few optional attributes:
+
+* ``permission_parent_field`` - name of the ForeignKey that
+  ``get_permission_parents()`` follows up the tree;
+
+* ``permission_owner_field`` - name of the ForeignKey to the user returned by
+  ``get_owner_user()``;
+
+* ``filter_permissions_q(user, perm, prefix, decided, granted)`` - a
+  classmethod mirroring ``filter_permissions()``, which adjusts a pair of Q
+  objects describing whether an object (with field names prefixed by
+  ``prefix``) settles the user's permissions, and whether it grants ``perm``.
+
+When a model uses one of the Python hooks without describing it, the rules
+can't be expressed exactly in SQL, so PermissionQueryUnsupported is raised
+rather than returning the wrong objects.
+"""
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import models
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+from .backends import TeamworkBackend
+from .base_policy import get_base_policy
+from .models import Team, Role, Policy
+
+
+DEFAULT_MAX_DEPTH = 8
+
+
+class PermissionQueryUnsupported(Exception):
+    """Permissions for a model can't be expressed exactly as a filter"""
+
+
+def get_permitted_q(user, perm_name, model):
+    """
+    Build a Q object selecting instances of a model for which the user has
+    the named permission, following the same rules as TeamworkBackend.
+    """
+    return PermittedQueryBuilder(user, perm_name, model).build()
+
+
+class PermittedQueryBuilder(object):
+    """Assembles a Q object for a user, permission, and model"""
+
+    def __init__(self, user, perm_name, model):
+        self.user = user
+        self.perm_name = perm_name
+        self.model = model
+        self.backend = TeamworkBackend()
+        try:
+            app_label, codename = perm_name.split('.', 1)
+        except ValueError:
+            raise ValueError("Permission name needs to be formatted as "
+                             "app_label.codename, not %s" % perm_name)
+        # An empty list, if there's no such Permission, which means only the
+        # base policy in settings can grant it.
+        self.perm_ids = list(Permission.objects
+                             .filter(content_type__app_label=app_label,
+                                     codename=codename)
+                             .values_list('id', flat=True))
+
+    def build(self):
+        # Superusers pass every has_perm() check, just as in User.has_perm()
+        if self.user.is_active and self.user.is_superuser:
+            return Q()
+
+        result = _nothing()
+        undecided = _everything()
+
+        # Each object settles permissions for itself, or hands off to its
+        # nearest ancestor that does.
+        for model, prefix in self._get_levels():
+            decided, granted = self._build_obj_q(model, prefix)
+            result |= undecided & decided & granted
+            undecided &= ~decided
+
+        result |= undecided & self._build_fallback_q()
+        return result
+
+    def _get_levels(self):
+        """
+        List (model, field prefix) pairs for an object and its ancestors,
+        stopping at the deepest level that any object actually reaches.
+        """
+        levels = [(self.model, '')]
+        if not hasattr(self.model, 'get_permission_parents'):
+            return levels
+
+        max_depth = getattr(settings, 'TEAMWORK_QUERY_MAX_DEPTH',
+                            DEFAULT_MAX_DEPTH)
+        model, prefix = self.model, ''
+        for depth in range(0, max_depth + 1):
+            field_name = getattr(model, 'permission_parent_field', None)
+            if not field_name:
+                if depth == 0:
+                    raise PermissionQueryUnsupported(
+                        "%s.get_permission_parents() cannot be expressed as "
+                        "a filter without permission_parent_field" %
+                        model.__name__)
+                break
+            field = _get_fk_field(model, field_name)
+            if field is None:
+                raise PermissionQueryUnsupported(
+                    "%s.permission_parent_field must name a ForeignKey" %
+                    model.__name__)
+            model = field.rel.to
+            prefix = '%s%s__' % (prefix, field_name)
+            # Each level costs a join for every subquery, so stop as soon as
+            # no object has an ancestor this far up.
+            lookup = '%spk__isnull' % prefix
+            if not self.model._default_manager.filter(
+                    **{lookup: False}).exists():
+                break
+            if depth == max_depth:
+                # Refuse to quietly ignore ancestors beyond the limit.
+                raise PermissionQueryUnsupported(
+                    "%s hierarchy is deeper than "
+                    "TEAMWORK_QUERY_MAX_DEPTH (%s)" %
+                    (self.model.__name__, max_depth))
+            levels.append((model, prefix))
+        return levels
+
+    def _build_obj_q(self, model, prefix):
+        """
+        Build a pair of Q objects for the objects at one level: whether they
+        settle the user's permissions, and whether they grant the permission.
+        This mirrors TeamworkBackend._get_obj_permissions.
+        """
+        user = self.user
+        ct = ContentType.objects.get_for_model(model)
+
+        # Team permissions apply to team members
+        team_path = self._get_team_path(model, prefix)
+        if team_path is None or user.is_anonymous():
+            member = _nothing(prefix)
+            team_granted = _nothing(prefix)
+        else:
+            member_teams = (Role.users.through.objects.filter(user=user)
+                                                      .values('role__team'))
+            granting_teams = (Role.objects
+                                  .filter(users=user,
+                                          permissions__in=self.perm_ids)
+                                  .values('team'))
+            member = Q(**{'%s__in' % team_path: member_teams})
+            team_granted = Q(**{'%s__in' % team_path: granting_teams})
+
+        # Policies apply to anonymous users and non-team members
+        policies = Policy.objects.filter(Policy.objects.get_user_filter(user),
+                                         content_type=ct)
+        pk_in = '%spk__in' % prefix
+        policy_decided = Q(**{pk_in: policies.values('object_id')})
+        policy_granted = Q(**{pk_in: policies.filter(
+            permissions__in=self.perm_ids).values('object_id')})
+
+        owner_policies = Policy.objects.filter(content_type=ct,
+                                               apply_to_owners=True)
+        if not user.is_anonymous() and owner_policies.exists():
+            owner = self._get_owner_q(model, prefix)
+            policy_decided |= owner & Q(**{
+                pk_in: owner_policies.values('object_id')})
+            policy_granted |= owner & Q(**{
+                pk_in: owner_policies.filter(
+                    permissions__in=self.perm_ids).values('object_id')})
+
+        decided = member | policy_decided
+        granted = (member & team_granted) | (~member & policy_granted)
+
+        if hasattr(model, 'filter_permissions'):
+            if not hasattr(model, 'filter_permissions_q'):
+                raise PermissionQueryUnsupported(
+                    "%s.filter_permissions() cannot be expressed as a "
+                    "filter without filter_permissions_q()" % model.__name__)
+            decided, granted = model.filter_permissions_q(
+                user, self.perm_name, prefix, decided, granted)
+
+        return decided, granted
+
+    def _build_fallback_q(self):
+        """
+        Build a Q object for objects whose permissions fall through to the
+        Site and then to the settings base policy.
+        """
+        site_ct = ContentType.objects.get_for_model(Site)
+        policies = Policy.objects.filter(
+            Policy.objects.get_user_filter(self.user), content_type=site_ct)
+        decided_sites = set(policies.values_list('object_id', flat=True))
+        granting_sites = set(policies.filter(permissions__in=self.perm_ids)
+                                     .values_list('object_id', flat=True))
+
+        current = self.backend._get_site()
+        current_pk = current and current.pk or None
+
+        if _get_fk_field(self.model, 'site') is not None:
+            site_decided = Q(site__in=decided_sites)
+            site_granted = Q(site__in=granting_sites)
+            if current_pk in decided_sites:
+                site_decided |= Q(site__isnull=True)
+            if current_pk in granting_sites:
+                site_granted |= Q(site__isnull=True)
+        elif hasattr(self.model, 'site'):
+            raise PermissionQueryUnsupported(
+                "%s.site must be a ForeignKey to Site" % self.model.__name__)
+        else:
+            site_decided = _constant(current_pk in decided_sites)
+            site_granted = _constant(current_pk in granting_sites)
+
+        return ((site_decided & site_granted) |
+                (~site_decided & self._build_settings_q()))
+
+    def _build_settings_q(self):
+        """Build a Q object for the base policy in settings"""
+        policy = get_base_policy()
+        if policy is None:
+            return _nothing()
+        if self.perm_name in policy.get_user_permissions(self.user):
+            return _everything()
+        if (not self.user.is_anonymous() and
+                hasattr(self.model, 'get_owner_user') and
+                self.perm_name in policy.owners):
+            return self._get_owner_q(self.model, '')
+        return _nothing()
+
+    def _get_team_path(self, model, prefix):
+        """Get the lookup path to the ID of the team owning an object"""
+        if issubclass(model, Team):
+            return '%spk' % prefix
+        field = _get_fk_field(model, 'team')
+        if field is not None and issubclass(field.rel.to, Team):
+            return '%steam' % prefix
+        if hasattr(model, 'team'):
+            raise PermissionQueryUnsupported(
+                "%s.team must be a ForeignKey to Team" % model.__name__)
+        return None
+
+    def _get_owner_q(self, model, prefix):
+        """Build a Q object matching objects owned by the user"""
+        if not hasattr(model, 'get_owner_user'):
+            return _nothing(prefix)
+        field_name = getattr(model, 'permission_owner_field', None)
+        if not field_name or _get_fk_field(model, field_name) is None:
+            raise PermissionQueryUnsupported(
+                "%s.get_owner_user() cannot be expressed as a filter "
+                "without permission_owner_field" % model.__name__)
+        return Q(**{'%s%s' % (prefix, field_name): self.user.pk})
+
+
+class PermittedQuerySet(models.query.QuerySet):
+    """QuerySet that can filter itself by object permission"""
+
+    def permitted(self, user, perm_name):
+        """Filter down to objects for which the user has the permission"""
+        return self.filter(get_permitted_q(user, perm_name, self.model))
+
+
+class PermittedManager(models.Manager):
+    """Manager offering permitted() on its QuerySets"""
+
+    def get_queryset(self):
+        return PermittedQuerySet(self.model, using=self._db)
+
+    def permitted(self, user, perm_name):
+        return self.get_queryset().permitted(user, perm_name)
+
+
+def _get_fk_field(model, name):
+    """Get a ForeignKey field from a model by name, if it exists"""
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if getattr(field, 'rel', None) is None:
+        return None
+    return field
+
+
+def _everything(prefix=''):
+    return Q(**{'%spk__isnull' % prefix: False})
+
+
+def _nothing(prefix=''):
+    return Q(**{'%spk__in' % prefix: []})
+
+
+def _constant(value):
+    return value and _everything() or _nothing()
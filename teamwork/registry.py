@@ -0,0 +1,205 @@
+"""
+In-memory registry of Permissions, mapping IDs to interned
+``app_label.codename`` names and back.
+
+Loading Permissions with their ContentTypes for every check is wasteful, when
+the whole set rarely changes. So, the backend fetches only Permission IDs and
+maps them through this registry, which is loaded once and refreshed by signal
+handlers when Permissions are saved or deleted, or after migrations.
+
+Names are only unique per app, not per model, so two models in one app may
+each have a Permission with the same codename. Looking up an ID for such a
+name raises MultipleObjectsReturned, as Permission.objects.get() would.
+
+Sets of names can also be encoded as integer bitmasks, with a bit for each
+Permission in order of ID. Masks are stored along with a fingerprint of that
+order, so they can be shared between processes through a cache, and masks
+from before Permissions were added or deleted are recognized as stale.
+"""
+import threading
+import zlib
+
+from django.contrib.auth.models import Permission
+
+from .base_policy import EMPTY_PERMS, intern_name
+
+
+class PermissionRegistry(object):
+    """Maps Permission IDs to names and back"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._ids = None
+        self._ambiguous = None
+        self._by_content_type = None
+        self._layout = None
+        self._stale_layouts = set()
+
+    def load(self):
+        """Load all Permissions, replacing anything previously loaded"""
+        names, ids, by_ct, ambiguous = dict(), dict(), dict(), set()
+        rows = Permission.objects.values_list(
+            'id', 'content_type', 'content_type__app_label', 'codename')
+        for perm_id, ct_id, app_label, codename in rows:
+            name = intern_name(u"%s.%s" % (app_label, codename))
+            names[perm_id] = name
+            if name in ids:
+                ambiguous.add(name)
+            ids[name] = perm_id
+            by_ct.setdefault(ct_id, set()).add(name)
+        by_ct = dict((ct_id, frozenset(ct_names))
+                     for ct_id, ct_names in by_ct.items())
+        perm_ids = sorted(names.keys())
+        bits = dict((perm_id, bit) for bit, perm_id in enumerate(perm_ids))
+        fingerprint = zlib.crc32(
+            ','.join(str(perm_id) for perm_id in perm_ids)) & 0xffffffff
+        layout = (fingerprint, bits, perm_ids, names)
+        ambiguous = frozenset(ambiguous)
+        with self._lock:
+            self._names, self._ids = names, ids
+            self._ambiguous = ambiguous
+            self._by_content_type = by_ct
+            self._layout = layout
+        return names, ids, by_ct, layout, ambiguous
+
+    def reset(self, **kwargs):
+        """Forget everything, to be loaded again on next use"""
+        with self._lock:
+            self._names, self._ids = None, None
+            self._ambiguous = None
+            self._by_content_type = None
+            self._layout = None
+
+    def get_name(self, perm_id):
+        """Get the app_label.codename name for a Permission ID"""
+        names = self._get_names()
+        if perm_id not in names:
+            # Possibly created by another process since loading
+            names = self.load()[0]
+        return names[perm_id]
+
+    def get_names(self, perm_ids):
+        """Get a frozenset of names for a sequence of Permission IDs"""
+        perm_ids = list(perm_ids)
+        names = self._get_names()
+        try:
+            return frozenset(names[perm_id] for perm_id in perm_ids)
+        except KeyError:
+            names = self.load()[0]
+            return frozenset(names[perm_id] for perm_id in perm_ids)
+
+    def get_id(self, name):
+        """
+        Get the Permission ID for an app_label.codename name, or None if
+        there's no such Permission. Names need not refer to Permissions (eg.
+        in the settings base policy), so a miss does not reload. Raises
+        MultipleObjectsReturned if more than one Permission has the name.
+        """
+        ids = self._get_ids()
+        self._check_unique((name,))
+        return ids.get(name, None)
+
+    def find_ids(self, names):
+        """
+        Get a list of Permission IDs for a sequence of names, with None for
+        any name that isn't a Permission. Unlike get_id(), a miss reloads,
+        in case the Permission was created by another process since loading.
+        Raises MultipleObjectsReturned if more than one Permission has any of
+        the names.
+        """
+        names = list(names)
+        ids = self._get_ids()
+        if any(name not in ids for name in names):
+            ids = self.load()[1]
+        self._check_unique(names)
+        return [ids.get(name, None) for name in names]
+
+    def get_content_type_names(self, ct_id):
+        """
+        Get a frozenset of names for all Permissions of a content type, such
+        as granted to superusers.
+        """
+        by_ct = self._by_content_type
+        if by_ct is None:
+            by_ct = self.load()[2]
+        return by_ct.get(ct_id, EMPTY_PERMS)
+
+    def get_mask(self, names):
+        """
+        Encode a set of names as an integer bitmask, with a bit for each
+        Permission in order of ID. Returns a tuple of (mask, extra, layout),
+        where extra is a frozenset of any names that aren't Permissions, and
+        layout is a fingerprint of the order of bits.
+        """
+        fingerprint, bits, perm_ids, perm_names = self._get_layout()
+        ids = self._get_ids()
+        mask, extra = 0, []
+        for name in names:
+            perm_id = ids.get(name, None)
+            if perm_id not in bits:
+                extra.append(name)
+            else:
+                mask |= 1 << bits[perm_id]
+        return mask, frozenset(extra), fingerprint
+
+    def get_names_for_mask(self, mask, extra=EMPTY_PERMS, layout=None):
+        """
+        Decode a bitmask from get_mask() back into a set of names, or None if
+        Permissions have been added or deleted since it was encoded. The
+        registry is reloaded at most once for each stale layout seen, in case
+        it's the registry that's out of date.
+        """
+        fingerprint, bits, perm_ids, names = self._get_layout()
+        if layout != fingerprint:
+            if layout is None or layout in self._stale_layouts:
+                return None
+            fingerprint, bits, perm_ids, names = self.load()[3]
+            if layout != fingerprint:
+                self._stale_layouts.add(layout)
+                return None
+        result = set(extra)
+        while mask:
+            bit = mask & -mask
+            result.add(names[perm_ids[bit.bit_length() - 1]])
+            mask ^= bit
+        return result
+
+    def has_bit(self, mask, name):
+        """
+        Test whether a bitmask, encoded with the current layout, includes
+        the named Permission
+        """
+        bits = self._get_layout()[1]
+        perm_id = self._get_ids().get(name, None)
+        return perm_id in bits and bool(mask & (1 << bits[perm_id]))
+
+    def _get_names(self):
+        names = self._names
+        if names is None:
+            names = self.load()[0]
+        return names
+
+    def _get_layout(self):
+        layout = self._layout
+        if layout is None:
+            layout = self.load()[3]
+        return layout
+
+    def _check_unique(self, names):
+        ambiguous = self._ambiguous
+        if ambiguous is None:
+            ambiguous = self.load()[4]
+        for name in names:
+            if name in ambiguous:
+                raise Permission.MultipleObjectsReturned(
+                    "More than one Permission matches %s" % name)
+
+    def _get_ids(self):
+        ids = self._ids
+        if ids is None:
+            ids = self.load()[1]
+        return ids
+
+
+registry = PermissionRegistry()
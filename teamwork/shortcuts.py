@@ -4,19 +4,23 @@ from django.core.exceptions import PermissionDenied
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import AnonymousUser, Permission, Group
 
+from .backends import TeamworkBackend
 from .models import Team, Role, Policy
+from .registry import registry
 
 
 def get_object_or_404_or_403(perm_name, user, model_cls, **kwargs):
     """
     Wrapper for get_object_or_404 that also tests a permission and throws a
     PermissionDenied if the user doesn't have the permission.
+
+    Permissions resolved for the check are kept on the object, so a later
+    user.get_all_permissions(obj) costs no queries.
     """
     obj = get_object_or_404(model_cls, **kwargs)
-    parts = perm_name.split('.', 1)
-    if len(parts) == 1:
-        ct = ContentType.objects.get_for_model(obj)
-        perm_name = '%s.%s' % (ct.app_label, perm_name)
+    if '.' not in perm_name:
+        app_label = obj._meta.concrete_model._meta.app_label
+        perm_name = '%s.%s' % (app_label, perm_name)
     if not user.has_perm(perm_name, obj):
         raise PermissionDenied
     return obj
@@ -27,19 +31,43 @@ def get_permission_by_name(perm_name, obj=None):
     Fetch a Permission by app_label.codename, or codename when an optional
     Model or object is supplied
     """
+    return get_permissions_by_names((perm_name,), obj)[0]
+
+
+def get_permissions_by_names(perm_names, obj=None):
+    """
+    Fetch a list of Permissions by app_label.codename, or codename when an
+    optional Model or object is supplied, in one query
+    """
+    perm_ids = get_permission_ids_by_names(perm_names, obj)
+    perms = Permission.objects.in_bulk(perm_ids)
+    return [perms[perm_id] for perm_id in perm_ids]
+
+
+def get_permission_ids_by_names(perm_names, obj=None):
+    """
+    Look up a list of Permission IDs by app_label.codename, or codename
+    when an optional Model or object is supplied. Names are resolved through
+    the registry, so this costs no queries once it's loaded.
+    """
     if obj:
         ct = ContentType.objects.get_for_model(obj)
-        codename = perm_name.split('.')[-1]
-        return Permission.objects.get(content_type__app_label=ct.app_label,
-                                      codename=codename)
-    try:
-        app_label, codename = perm_name.split('.', 1)
-    except ValueError:
-        raise ValueError("With no object supplied, first parameter needs "
-                         "to be formatted as app_label.codename, not %s" %
-                         perm_name)
-    return Permission.objects.get(content_type__app_label=app_label,
-                                  codename=codename)
+        names = ['%s.%s' % (ct.app_label, perm_name.split('.')[-1])
+                 for perm_name in perm_names]
+    else:
+        names = []
+        for perm_name in perm_names:
+            if '.' not in perm_name:
+                raise ValueError("With no object supplied, first parameter "
+                                 "needs to be formatted as "
+                                 "app_label.codename, not %s" % perm_name)
+            names.append(perm_name)
+    perm_ids = registry.find_ids(names)
+    for name, perm_id in zip(names, perm_ids):
+        if perm_id is None:
+            raise Permission.DoesNotExist(
+                "Permission matching %s does not exist" % name)
+    return perm_ids
 
 
 def build_policy_admin_links(user, obj):
@@ -56,12 +84,13 @@ def build_policy_admin_links(user, obj):
         links['add'] = '%s?content_type=%s&object_id=%s' % (
             reverse('admin:teamwork_policy_add'), ct.id, obj.id)
 
-    policies = [
-        p for p in
-        Policy.objects.filter(content_type__pk=ct.id,
-                              object_id=obj.id).all()
-        if user.has_perm('teamwork.change_policy', p)
-    ]
+    # Resolve permissions for all of the policies in one batch, which leaves
+    # them cached on each policy for the has_perm() checks that follow.
+    policies = list(Policy.objects.filter(content_type__pk=ct.id,
+                                          object_id=obj.id))
+    TeamworkBackend().get_all_permissions_bulk(user, policies)
+    policies = [p for p in policies
+                if user.has_perm('teamwork.change_policy', p)]
 
     policies_ct = len(policies)
     if policies_ct == 1:
@@ -0,0 +1,381 @@
+"""
+Signal handlers that invalidate cached permissions when the Teams, Roles,
+Policies, and group memberships they were resolved from change.
+
+Any change also empties the request-scoped cache for the current thread, so
+a view sees its own changes. Beyond that, these handlers do nothing unless
+``TEAMWORK_CACHE`` is configured, apart from maintaining the nearest
+permission ancestor index and the materialized member permissions table,
+where those are in use.
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db.models.signals import (post_save, post_delete, pre_save,
+                                      pre_delete, m2m_changed)
+from django.dispatch import Signal
+try:
+    from django.db.models.signals import post_migrate
+except ImportError:
+    # Django < 1.7
+    from django.db.models.signals import post_syncdb as post_migrate
+
+from .ancestors import (uses_ancestor_index, update_ancestor_index,
+                        remove_from_ancestor_index)
+from .cache import (get_permission_cache, clear_request_cache, object_scope,
+                    team_scope)
+from .models import (Team, Role, Policy, MemberPermissions,
+                     use_member_permissions_table)
+from .registry import registry
+
+
+# Sent once by change_relations() in place of m2m_changed, with the IDs of
+# the Roles or Policies changed, and the related IDs added or removed by
+# relation name.
+relations_changed = Signal(providing_args=['object_ids', 'relations'])
+
+# Attributes that mark a model as taking part in permission resolution, such
+# that changes to its instances can change the permissions they grant.
+PERMISSION_HOOKS = ('team', 'site', 'get_owner_user', 'filter_permissions',
+                    'get_permission_parents')
+
+_participating_models = dict()
+
+
+def is_participating_model(model_cls):
+    """Determine whether a model's instances can affect resolved perms"""
+    if model_cls not in _participating_models:
+        _participating_models[model_cls] = (
+            issubclass(model_cls, Site) or
+            any(hasattr(model_cls, name) for name in PERMISSION_HOOKS))
+    return _participating_models[model_cls]
+
+
+def invalidate_object(cache, obj):
+    ct = ContentType.objects.get_for_model(obj)
+    cache.invalidate(object_scope(ct.id, obj.pk))
+
+
+def invalidate_policy_targets(cache, policies):
+    """Invalidate the content objects that a set of Policies apply to"""
+    targets = set((p.content_type_id, p.object_id) for p in policies)
+    for ct_id, obj_pk in targets:
+        cache.invalidate(object_scope(ct_id, obj_pk))
+
+
+def invalidate_teams(cache, team_pks):
+    for team_pk in set(team_pks):
+        cache.invalidate(team_scope(team_pk))
+
+
+def invalidate_users(cache, user_pks):
+    for user_pk in set(user_pks):
+        cache.invalidate(('user', user_pk))
+
+
+def model_saved_or_deleted(sender, instance, **kwargs):
+    """Invalidate any object whose own permission hooks may have changed"""
+    is_user = isinstance(instance, get_user_model())
+    if is_user or is_participating_model(sender):
+        clear_request_cache()
+    cache = get_permission_cache()
+    if cache is None:
+        return
+    if isinstance(instance, Team):
+        invalidate_teams(cache, (instance.pk,))
+    elif isinstance(instance, Role):
+        invalidate_teams(cache, (instance.team_id,))
+    elif isinstance(instance, Policy):
+        invalidate_policy_targets(cache, (instance,))
+    elif is_user:
+        # eg. is_superuser or username may have changed
+        invalidate_users(cache, (instance.pk,))
+    if is_participating_model(sender):
+        invalidate_object(cache, instance)
+
+
+def ancestor_index_changed(sender, instance, signal, **kwargs):
+    """
+    Keep the nearest permission ancestor index up to date as objects move
+    around their trees, and as Policies and Teams come and go.
+    """
+    if kwargs.get('raw', False):
+        return
+    if isinstance(instance, Policy):
+        ct = ContentType.objects.get_for_id(instance.content_type_id)
+        model_cls = ct.model_class()
+        if model_cls is None or not uses_ancestor_index(model_cls):
+            return
+        changed = []
+        for obj in model_cls._default_manager.filter(pk=instance.object_id):
+            changed.extend(update_ancestor_index(obj))
+    elif not uses_ancestor_index(sender):
+        return
+    elif signal is post_delete:
+        changed = remove_from_ancestor_index(instance)
+    else:
+        changed = update_ancestor_index(instance)
+
+    # Objects now inheriting from elsewhere need their cached perms dropped
+    cache = get_permission_cache()
+    if cache is not None:
+        for ct_id, obj_pk in changed:
+            cache.invalidate(object_scope(ct_id, obj_pk))
+
+
+def model_pre_save(sender, instance, **kwargs):
+    """Invalidate the old team or target when a Role or Policy moves"""
+    cache = get_permission_cache()
+    if cache is None or not instance.pk:
+        return
+    if isinstance(instance, Role):
+        old = Role.objects.filter(pk=instance.pk).values_list('team',
+                                                              flat=True)
+        invalidate_teams(cache, old)
+    elif isinstance(instance, Policy):
+        old = Policy.objects.filter(pk=instance.pk)
+        invalidate_policy_targets(cache, old)
+
+
+def role_moved_or_deleted(sender, instance, signal, **kwargs):
+    """Refresh member permissions when a Role moves or leaves a Team"""
+    if not use_member_permissions_table() or kwargs.get('raw', False):
+        return
+    if signal is pre_save:
+        if instance.pk:
+            instance._teamwork_old_team_ids = list(
+                Role.objects.filter(pk=instance.pk)
+                            .values_list('team', flat=True))
+    elif signal is post_delete:
+        MemberPermissions.objects.refresh((instance.team_id,))
+    else:
+        old_team_ids = getattr(instance, '_teamwork_old_team_ids', None)
+        if old_team_ids and old_team_ids != [instance.team_id]:
+            MemberPermissions.objects.refresh(
+                old_team_ids + [instance.team_id])
+
+
+def permission_deleted(sender, instance, signal, **kwargs):
+    """Refresh member permissions that included a deleted Permission"""
+    if not use_member_permissions_table():
+        return
+    if signal is pre_delete:
+        instance._teamwork_team_ids = list(
+            Role.objects.filter(permissions=instance)
+                        .values_list('team', flat=True))
+    else:
+        MemberPermissions.objects.refresh(
+            getattr(instance, '_teamwork_team_ids', ()))
+
+
+def member_relation_changed(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """Refresh member permissions when Roles gain or lose users and perms"""
+    if not use_member_permissions_table():
+        return
+    refresh = MemberPermissions.objects.refresh
+    if sender is Role.users.through and not reverse:
+        if action in ('post_add', 'post_remove'):
+            refresh((instance.team_id,), pk_set)
+        elif action == 'post_clear':
+            refresh((instance.team_id,))
+    elif sender is Role.users.through:
+        # From the user side, refresh the Teams the user belonged to before
+        # the change, plus those of any Roles added.
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            team_ids = set(MemberPermissions.objects.filter(user=instance)
+                                            .values_list('team', flat=True))
+            if pk_set:
+                team_ids.update(Role.objects.filter(pk__in=pk_set)
+                                            .values_list('team', flat=True))
+            refresh(team_ids, (instance.pk,))
+    elif sender is Role.permissions.through and not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            refresh((instance.team_id,))
+    elif sender is Role.permissions.through:
+        # Clearing from the Permission side leaves no trace of the Roles
+        # involved, so note their Teams before the fact.
+        if action == 'pre_clear':
+            instance._teamwork_team_ids = list(
+                Role.objects.filter(permissions=instance)
+                            .values_list('team', flat=True))
+        elif action in ('post_add', 'post_remove'):
+            refresh(Role.objects.filter(pk__in=pk_set)
+                                .values_list('team', flat=True))
+        elif action == 'post_clear':
+            refresh(getattr(instance, '_teamwork_team_ids', ()))
+
+
+def bulk_relations_changed(sender, object_ids, relations, **kwargs):
+    """
+    Refresh member permissions and invalidate cached permissions after bulk
+    changes to the users, groups, and Permissions of Roles and Policies
+    """
+    clear_request_cache()
+    cache = get_permission_cache()
+    if sender is Role:
+        team_ids = set(Role.objects.filter(pk__in=object_ids)
+                                   .values_list('team', flat=True))
+        if use_member_permissions_table():
+            if 'permissions' in relations:
+                MemberPermissions.objects.refresh(team_ids)
+            elif 'users' in relations:
+                MemberPermissions.objects.refresh(team_ids,
+                                                  relations['users'])
+        if cache is not None:
+            invalidate_teams(cache, team_ids)
+    elif sender is Policy and cache is not None:
+        invalidate_policy_targets(cache,
+                                  Policy.objects.filter(pk__in=object_ids))
+
+
+def group_pre_delete(sender, instance, **kwargs):
+    """Group deletion quietly drops memberships and Policy grants"""
+    clear_request_cache()
+    cache = get_permission_cache()
+    if cache is None:
+        return
+    invalidate_users(cache, instance.user_set.values_list('pk', flat=True))
+    invalidate_policy_targets(cache, instance.policy_set.all())
+
+
+def group_renamed(sender, instance, signal, **kwargs):
+    """
+    The settings base policy grants permissions by Group name, so renaming
+    a Group changes its members' permissions
+    """
+    if kwargs.get('raw', False) or not instance.pk:
+        return
+    if signal is pre_save:
+        instance._teamwork_old_names = list(
+            Group.objects.filter(pk=instance.pk)
+                         .values_list('name', flat=True))
+        return
+    old_names = getattr(instance, '_teamwork_old_names', None)
+    if not old_names or old_names == [instance.name]:
+        return
+    clear_request_cache()
+    cache = get_permission_cache()
+    if cache is not None:
+        invalidate_users(cache, instance.user_set.values_list('pk',
+                                                              flat=True))
+
+
+def role_m2m_changed(cache, instance, reverse, pk_set):
+    # Reverse changes come from the User or Permission side of the relation
+    if not reverse:
+        invalidate_teams(cache, (instance.team_id,))
+    elif pk_set:
+        invalidate_teams(cache, Role.objects.filter(pk__in=pk_set)
+                                            .values_list('team', flat=True))
+    else:
+        invalidate_teams(cache, instance.role_set.values_list('team',
+                                                              flat=True))
+
+
+def policy_m2m_changed(cache, instance, reverse, pk_set):
+    if not reverse:
+        invalidate_policy_targets(cache, (instance,))
+    elif pk_set:
+        invalidate_policy_targets(cache, Policy.objects.filter(pk__in=pk_set))
+    else:
+        # HACK: The reverse accessor differs per relation, so just find
+        # Policies by whichever relation points at the instance.
+        invalidate_policy_targets(cache, Policy.objects.filter(
+            **{_policy_relation_for(instance): instance}))
+
+
+def _policy_relation_for(instance):
+    if isinstance(instance, Group):
+        return 'groups'
+    if isinstance(instance, get_user_model()):
+        return 'users'
+    return 'permissions'
+
+
+def user_groups_changed(cache, instance, reverse, pk_set):
+    if not reverse:
+        invalidate_users(cache, (instance.pk,))
+    elif pk_set:
+        invalidate_users(cache, pk_set)
+    else:
+        invalidate_users(cache, instance.user_set.values_list('pk',
+                                                              flat=True))
+
+
+def _m2m_handlers():
+    return {
+        Role.users.through: role_m2m_changed,
+        Role.permissions.through: role_m2m_changed,
+        Policy.users.through: policy_m2m_changed,
+        Policy.groups.through: policy_m2m_changed,
+        Policy.permissions.through: policy_m2m_changed,
+        get_user_model().groups.through: user_groups_changed,
+    }
+
+
+def relation_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Dispatch m2m changes on relations that feed into permissions"""
+    handler = _m2m_handlers().get(sender, None)
+    if handler is None:
+        return
+    clear_request_cache()
+    cache = get_permission_cache()
+    if cache is None:
+        return
+    # Clearing from the reverse side leaves no trace of what was cleared once
+    # it's done, so handle that before the fact. Everything else is handled
+    # once the change has happened.
+    if action == 'pre_clear' and reverse:
+        handler(cache, instance, reverse, None)
+    elif action in ('post_add', 'post_remove') or (
+            action == 'post_clear' and not reverse):
+        handler(cache, instance, reverse, pk_set)
+
+
+# Keep materialized member permissions in step with Roles, if enabled. These
+# go first, so that cached permissions are invalidated after the refresh.
+for model_signal in (pre_save, post_save, post_delete):
+    model_signal.connect(role_moved_or_deleted, sender=Role,
+                         dispatch_uid='teamwork_member_perms_role')
+for model_signal in (pre_delete, post_delete):
+    model_signal.connect(permission_deleted, sender=Permission,
+                         dispatch_uid='teamwork_member_perms_permission')
+m2m_changed.connect(member_relation_changed, sender=Role.users.through,
+                    dispatch_uid='teamwork_member_perms_users')
+m2m_changed.connect(member_relation_changed, sender=Role.permissions.through,
+                    dispatch_uid='teamwork_member_perms_permissions')
+
+post_save.connect(model_saved_or_deleted,
+                  dispatch_uid='teamwork_model_saved')
+post_delete.connect(model_saved_or_deleted,
+                    dispatch_uid='teamwork_model_deleted')
+post_save.connect(ancestor_index_changed,
+                  dispatch_uid='teamwork_ancestor_index_saved')
+post_delete.connect(ancestor_index_changed,
+                    dispatch_uid='teamwork_ancestor_index_deleted')
+pre_save.connect(model_pre_save, sender=Role,
+                 dispatch_uid='teamwork_role_pre_save')
+pre_save.connect(model_pre_save, sender=Policy,
+                 dispatch_uid='teamwork_policy_pre_save')
+pre_delete.connect(group_pre_delete, sender=Group,
+                   dispatch_uid='teamwork_group_pre_delete')
+for model_signal in (pre_save, post_save):
+    model_signal.connect(group_renamed, sender=Group,
+                         dispatch_uid='teamwork_group_renamed')
+m2m_changed.connect(relation_changed,
+                    dispatch_uid='teamwork_relation_changed')
+relations_changed.connect(bulk_relations_changed,
+                          dispatch_uid='teamwork_bulk_relations_changed')
+
+
+# Keep the registry of Permission names in step with the database
+for model_cls in (Permission, ContentType):
+    post_save.connect(registry.reset, sender=model_cls,
+                      dispatch_uid='teamwork_registry_%s_saved' %
+                                   model_cls.__name__)
+    post_delete.connect(registry.reset, sender=model_cls,
+                        dispatch_uid='teamwork_registry_%s_deleted' %
+                                     model_cls.__name__)
+post_migrate.connect(registry.reset, dispatch_uid='teamwork_registry_migrate')
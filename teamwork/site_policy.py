@@ -0,0 +1,151 @@
+"""
+Compiled bundles of the Policies attached to each Site.
+
+Every object-less permission check, and every object check that falls
+through to the Site, consults the Site's Policies. Rather than query for them
+each time, they're compiled into a bundle of frozensets indexed for
+dictionary lookups, held in process memory and the shared cache. Bundles are
+checked against the Site's cache scope version once per request, which
+signal handlers bump whenever a Site Policy changes.
+
+Without ``TEAMWORK_CACHE``, there's no way to hear about changes made by
+other processes, so bundles are only kept for the life of the request cache.
+With neither, as in management commands and task queues, each check loads
+the bundle again in four queries; start a request cache around batches of
+work with ``teamwork.cache.start_request_cache()`` to avoid that.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+
+from .base_policy import EMPTY_PERMS
+from .cache import (get_permission_cache, get_request_cache, get_user_groups,
+                    object_scope)
+from .models import Policy
+from .registry import registry
+
+
+# Bundles held in process memory, indexed by Site ID, as (versions, bundle)
+_site_policies = dict()
+
+
+class SitePolicy(object):
+    """Policies attached to a Site, compiled for dictionary lookups"""
+
+    def __init__(self, policies):
+        """
+        Compile from a list of dicts with the anonymous, authenticated,
+        users, groups, and permissions of each Policy.
+        """
+        self.has_anonymous = False
+        self.has_authenticated = False
+        anonymous, authenticated = [], []
+        users, groups = dict(), dict()
+
+        for policy in policies:
+            perms = policy['permissions']
+            if policy['anonymous']:
+                self.has_anonymous = True
+                anonymous.append(perms)
+            if policy['authenticated']:
+                self.has_authenticated = True
+                authenticated.append(perms)
+            for user_pk in policy['users']:
+                users.setdefault(user_pk, []).append(perms)
+            for group_pk in policy['groups']:
+                groups.setdefault(group_pk, []).append(perms)
+
+        self.anonymous = EMPTY_PERMS.union(*anonymous)
+        self.authenticated = EMPTY_PERMS.union(*authenticated)
+        self.users = dict((pk, EMPTY_PERMS.union(*perms))
+                          for pk, perms in users.items())
+        self.groups = dict((pk, EMPTY_PERMS.union(*perms))
+                           for pk, perms in groups.items())
+
+    @classmethod
+    def load(cls, site_pk):
+        """Load and compile the Policies for a Site, in four queries"""
+        ct = ContentType.objects.get_for_model(Site)
+        policies = dict(
+            (p_id, dict(anonymous=anonymous, authenticated=authenticated,
+                        users=[], groups=[], permissions=[]))
+            for p_id, anonymous, authenticated in
+            Policy.objects.filter(content_type=ct, object_id=site_pk)
+                          .values_list('id', 'anonymous', 'authenticated'))
+        if policies:
+            p_ids = list(policies.keys())
+            for p_id, user_pk in (Policy.users.through.objects
+                                        .filter(policy__in=p_ids)
+                                        .values_list('policy', 'user')):
+                policies[p_id]['users'].append(user_pk)
+            for p_id, group_pk in (Policy.groups.through.objects
+                                         .filter(policy__in=p_ids)
+                                         .values_list('policy', 'group')):
+                policies[p_id]['groups'].append(group_pk)
+            for p_id, perm_id in (Policy.permissions.through.objects
+                                        .filter(policy__in=p_ids)
+                                        .values_list('policy', 'permission')):
+                policies[p_id]['permissions'].append(perm_id)
+        for policy in policies.values():
+            policy['permissions'] = registry.get_names(policy['permissions'])
+        return cls(policies.values())
+
+    def get_permissions(self, user):
+        """
+        Get permissions granted to a user by the Site's Policies, or None if
+        none of them apply to the user.
+        """
+        if user.is_anonymous():
+            if not self.has_anonymous:
+                return None
+            return self.anonymous
+
+        matched = False
+        perms = []
+        if self.has_authenticated:
+            matched = True
+            perms.append(self.authenticated)
+        if user.pk in self.users:
+            matched = True
+            perms.append(self.users[user.pk])
+        if self.groups:
+            for group_pk, name in get_user_groups(user):
+                if group_pk in self.groups:
+                    matched = True
+                    perms.append(self.groups[group_pk])
+
+        if not matched:
+            return None
+        if len(perms) == 1:
+            return perms[0]
+        return EMPTY_PERMS.union(*perms)
+
+
+def get_site_policy(site):
+    """Get the compiled SitePolicy for a Site"""
+    request_cache = get_request_cache()
+    key = ('site_policy', site.pk)
+    if request_cache is not None and key in request_cache:
+        return request_cache[key]
+
+    cache = get_permission_cache()
+    if cache is None:
+        # Without a shared cache, there's no way to hear about changes made
+        # by other processes. So, just hang onto the bundle for the request.
+        bundle = SitePolicy.load(site.pk)
+    else:
+        ct = ContentType.objects.get_for_model(Site)
+        versions = cache.get_versions([object_scope(ct.id, site.pk)])
+        local = _site_policies.get(site.pk, None)
+        if local is not None and local[0] == versions:
+            bundle = local[1]
+        else:
+            name = 'site_policy:%s' % site.pk
+            bundle = cache.get_entry(name, versions)
+            if bundle is None:
+                bundle = SitePolicy.load(site.pk)
+                cache.set_entry(name, bundle, versions)
+            _site_policies[site.pk] = (versions, bundle)
+
+    if request_cache is not None:
+        request_cache[key] = bundle
+    return bundle
@@ -11,6 +11,7 @@ from django.utils.functional import wraps
 from teamwork_example.wiki.models import Document
 
 from ..models import Team, Role
+from ..registry import registry
 from ..shortcuts import get_permission_by_name
 
 
@@ -77,3 +78,9 @@ class TestCaseBase(TestCase):
         self.docs = dict((o.name, o) for o in Document.objects.all())
         self.doc_ct = ContentType.objects.get_by_natural_key(
             'wiki', 'document')
+
+    def tearDown(self):
+        # Permissions created during a test are rolled back without signals,
+        # so don't let the registry carry them over into the next test.
+        registry.reset()
+        super(TestCaseBase, self).tearDown()
@@ -0,0 +1,211 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from nose.tools import eq_, ok_, raises
+
+from teamwork_example.wiki.models import Document, Folder
+
+from ..ancestors import (get_ancestors, get_ancestors_bulk,
+                         get_nearest_ancestor, rebuild_ancestor_index,
+                         uses_ancestor_index, LEVELS_PER_QUERY)
+from ..backends import TeamworkBackend
+from ..models import Policy, PermissionAncestor
+
+from . import TestCaseBase
+
+
+class AncestorTests(TestCaseBase):
+
+    def setUp(self):
+        super(AncestorTests, self).setUp()
+        self.chain = []
+        parent = None
+        for idx in range(0, LEVELS_PER_QUERY + 4):
+            parent = Document.objects.create(name='ancestor_%s' % idx,
+                                             parent=parent)
+            self.chain.append(parent)
+
+    def test_ancestors_in_order(self):
+        """Ancestors should be listed from parent to root"""
+        leaf = Document.objects.get(pk=self.chain[-1].pk)
+        expected = [doc.pk for doc in reversed(self.chain[:-1])]
+        eq_(expected, [doc.pk for doc in get_ancestors(leaf)])
+        eq_([], get_ancestors(Document.objects.get(pk=self.chain[0].pk)))
+
+    def test_ancestors_in_few_queries(self):
+        """Ancestor chains should load many levels to a query"""
+        leaf = Document.objects.get(pk=self.chain[-1].pk)
+        with self.assertNumQueries(2):
+            get_ancestors(leaf)
+
+    def test_ancestors_bulk_share_instances(self):
+        """Objects sharing ancestors should share the loaded instances"""
+        leaves = [Document.objects.get(pk=self.chain[-1].pk),
+                  Document.objects.get(pk=self.chain[-2].pk),
+                  Document.objects.get(pk=self.chain[0].pk)]
+        with self.assertNumQueries(2):
+            chains = get_ancestors_bulk(leaves)
+        eq_(len(self.chain) - 1, len(chains[0]))
+        eq_([], chains[2])
+        ok_(chains[0][1] is chains[1][0])
+
+    def test_inherited_permissions(self):
+        """Deep objects should inherit from the nearest ancestor policy"""
+        policy = Policy.objects.create(content_object=self.chain[2],
+                                       anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+        policy = Policy.objects.create(content_object=self.chain[0],
+                                       anonymous=True)
+        policy.add_permissions_by_name(('xyzzy',))
+
+        anon = AnonymousUser()
+        leaf = Document.objects.get(pk=self.chain[-1].pk)
+        eq_(set(['wiki.frob']),
+            TeamworkBackend().get_all_permissions(anon, leaf))
+        doc = Document.objects.get(pk=self.chain[1].pk)
+        eq_(set(['wiki.xyzzy']),
+            TeamworkBackend().get_all_permissions(anon, doc))
+
+
+class AncestorIndexTests(TestCaseBase):
+
+    def setUp(self):
+        super(AncestorIndexTests, self).setUp()
+        self.chain = []
+        parent = None
+        for idx in range(0, 6):
+            parent = Folder.objects.create(name='indexed_%s' % idx,
+                                           parent=parent)
+            self.chain.append(parent)
+
+    def get_nearest(self, folder):
+        found, ancestor = get_nearest_ancestor(folder)
+        ok_(found)
+        return ancestor and ancestor.pk or None
+
+    def test_index_follows_policies(self):
+        """Policies created and deleted should update descendants"""
+        root, mid, leaf = self.chain[0], self.chain[2], self.chain[-1]
+        eq_(None, self.get_nearest(leaf))
+
+        policy = Policy.objects.create(content_object=root, anonymous=True)
+        eq_(root.pk, self.get_nearest(leaf))
+        eq_(root.pk, self.get_nearest(mid))
+
+        mid_policy = Policy.objects.create(content_object=mid)
+        eq_(mid.pk, self.get_nearest(leaf))
+        eq_(root.pk, self.get_nearest(mid))
+
+        mid_policy.delete()
+        eq_(root.pk, self.get_nearest(leaf))
+
+        policy.delete()
+        eq_(None, self.get_nearest(leaf))
+
+    def test_index_follows_reparenting(self):
+        """Moving an object should update it and its descendants"""
+        other = Folder.objects.create(name='indexed_other')
+        Policy.objects.create(content_object=other)
+        Policy.objects.create(content_object=self.chain[0])
+
+        moved = self.chain[3]
+        moved.parent = other
+        moved.save()
+        eq_(other.pk, self.get_nearest(moved))
+        eq_(other.pk, self.get_nearest(self.chain[-1]))
+        eq_(self.chain[0].pk, self.get_nearest(self.chain[2]))
+
+    def test_index_follows_teams(self):
+        """Objects belonging to Teams should count as ancestors"""
+        mid = self.chain[2]
+        mid.team = self.teams['Section 1 Team']
+        mid.save()
+        eq_(mid.pk, self.get_nearest(self.chain[-1]))
+
+    def test_rebuild(self):
+        """Rebuilding should index objects created outside of signals"""
+        Policy.objects.create(content_object=self.chain[1])
+        PermissionAncestor.objects.all().delete()
+        found, ancestor = get_nearest_ancestor(self.chain[-1])
+        ok_(not found)
+        rebuild_ancestor_index(Folder)
+        eq_(self.chain[1].pk, self.get_nearest(self.chain[-1]))
+        eq_(None, self.get_nearest(self.chain[1]))
+
+    def test_indexed_permissions(self):
+        """Checks should jump to the nearest ancestor that has an opinion"""
+        policy = Policy.objects.create(content_object=self.chain[0],
+                                       anonymous=True)
+        policy.add_permissions_by_name(('change_folder',))
+        unmatched_policy = Policy.objects.create(content_object=self.chain[3])
+        unmatched_policy.add_permissions_by_name(('delete_folder',))
+
+        anon = AnonymousUser()
+        leaf = Folder.objects.get(pk=self.chain[-1].pk)
+        eq_(set(['wiki.change_folder']),
+            TeamworkBackend().get_all_permissions(anon, leaf))
+
+    @raises(ImproperlyConfigured)
+    def test_refused_with_filter_permissions(self):
+        """Models that filter permissions shouldn't skip their ancestors"""
+        class FilteringFolder(object):
+            permission_ancestor_index = True
+            permission_parent_field = 'parent'
+
+            def filter_permissions(self, user, permissions):
+                return permissions
+
+        uses_ancestor_index(FilteringFolder)
+
+
+class SubtreeTests(TestCaseBase):
+
+    def setUp(self):
+        super(SubtreeTests, self).setUp()
+        self.root = Document.objects.create(name='subtree_root')
+        self.docs = [self.root]
+        for idx in range(0, 3):
+            branch = Document.objects.create(name='subtree_%s' % idx,
+                                             parent=self.root)
+            self.docs.append(branch)
+            for leaf_idx in range(0, 4):
+                self.docs.append(Document.objects.create(
+                    name='subtree_%s_%s' % (idx, leaf_idx), parent=branch))
+
+        policy = Policy.objects.create(content_object=self.root,
+                                       anonymous=True)
+        policy.add_permissions_by_name(('view_document',))
+        policy = Policy.objects.create(content_object=self.docs[1],
+                                       anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+    def test_subtree_matches_backend(self):
+        """Subtree results should agree with checks on each object"""
+        anon = AnonymousUser()
+        root = Document.objects.get(pk=self.root.pk)
+        results = TeamworkBackend().resolve_subtree(anon, root,
+                                                    'wiki.view_document')
+        eq_(len(self.docs), len(results))
+        eq_(root.pk, results[0][0].pk)
+        for obj, allowed in results:
+            doc = Document.objects.get(pk=obj.pk)
+            eq_(anon.has_perm('wiki.view_document', doc), allowed)
+
+    def test_subtree_queries_per_level(self):
+        """Work should grow with the depth of the tree, not its size"""
+        anon = AnonymousUser()
+        backend = TeamworkBackend()
+
+        def count_queries():
+            root = Document.objects.get(pk=self.root.pk)
+            with CaptureQueriesContext(connection) as context:
+                backend.resolve_subtree(anon, root, 'wiki.view_document')
+            return len(context.captured_queries)
+
+        before = count_queries()
+        for idx in range(0, 10):
+            Document.objects.create(name='subtree_extra_%s' % idx,
+                                    parent=self.docs[1])
+        eq_(before, count_queries())
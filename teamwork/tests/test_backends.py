@@ -4,18 +4,28 @@ import time
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Permission, Group
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.http import HttpResponse
 
 from django.test import TestCase
+from django.test.client import RequestFactory
 
 from django.contrib.sites.models import Site, get_current_site
 
 from nose.tools import assert_equal, with_setup, assert_false, eq_, ok_
 from nose.plugins.attrib import attr
 
-from teamwork_example.wiki.models import Document
+from teamwork_example.wiki.models import Document, Folder
 
 from ..models import Team, Role, Policy
 from ..backends import TeamworkBackend
+from ..base_policy import get_base_policy
+from ..site_policy import get_site_policy
+from ..cache import (ScopeSet, get_permission_cache, object_scope,
+                     start_request_cache, end_request_cache)
+from ..instrumentation import start_stats, end_stats
+from ..metrics import get_metrics, MemoryMetrics
+from ..middleware import InstrumentationMiddleware
 
 from . import TestCaseBase, override_settings
 
@@ -374,3 +384,640 @@ class TeamBackendTests(TestCaseBase):
             eq_(ex_disregard, perm2,
                 "manage_role_users on %s for %s should be %s, but is %s" % (
                     role_disregard, user, ex_disregard, perm2))
+
+
+class SharedCacheTests(TestCaseBase):
+
+    def setUp(self):
+        super(SharedCacheTests, self).setUp()
+        cache.clear()
+
+    def test_cached_perms_shared_between_instances(self):
+        """Resolved permissions should be shared via the Django cache"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='cached_doc_1')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+
+            # Sneak around the signals to change the policy, then check that
+            # a fresh instance of the document still yields the cached perms.
+            Policy.objects.filter(pk=policy.pk).update(anonymous=False)
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+
+        # Without the cache, the change should be visible
+        doc = Document.objects.get(pk=doc.pk)
+        eq_(set(), user.get_all_permissions(doc))
+
+    def test_cache_key_prefix(self):
+        """Cache keys should respect the configured prefix"""
+        with override_settings(TEAMWORK_CACHE='default',
+                               TEAMWORK_CACHE_PREFIX='tw-test'):
+            perm_cache = get_permission_cache()
+            ok_(perm_cache.make_key(1, 2, 3).startswith('tw-test:'))
+
+    def test_policy_change_invalidates_object(self):
+        """Changing a Policy should invalidate cached perms for its object"""
+        user = self.users['randomguy1']
+        doc = Document.objects.create(name='cached_doc_2')
+        other_doc = Document.objects.create(name='cached_doc_3')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.users.add(user)
+        policy.add_permissions_by_name(('frob',))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+            user.get_all_permissions(other_doc)
+            perm_cache = get_permission_cache()
+            other_key = perm_cache.make_key(user.pk, self.doc_ct.id,
+                                            other_doc.pk)
+            other_entry = cache.get(other_key)
+
+            policy.add_permissions_by_name(('hello',))
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.frob', 'wiki.hello')),
+                user.get_all_permissions(doc))
+
+            policy.users.remove(user)
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.add_document',)), user.get_all_permissions(doc))
+
+            # The unrelated document should not have been disturbed
+            eq_(other_entry, cache.get(other_key))
+            ok_(perm_cache.get(user.pk, self.doc_ct.id,
+                               other_doc.pk) is not None)
+
+    def test_invalidation_during_resolution(self):
+        """An invalidation landing mid-resolution should orphan the entry"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='cached_doc_6')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            perm_cache = get_permission_cache()
+            backend = TeamworkBackend()
+            user_pk = backend._get_user_pk(user)
+            scopes = ScopeSet(perm_cache)
+            perms = backend._resolve_permissions(user, doc, scopes)
+
+            # The policy changes after it was read, but before the perms
+            # resolved from it are stored.
+            perm_cache.invalidate(object_scope(self.doc_ct.id, doc.pk))
+            perm_cache.set(user_pk, self.doc_ct.id, doc.pk, perms, scopes)
+            ok_(perm_cache.get(user_pk, self.doc_ct.id, doc.pk) is None)
+
+    def test_bulk_lookups(self):
+        """Bulk checks should find shared cache entries all at once"""
+        user = AnonymousUser()
+        docs = [Document.objects.create(name='cached_bulk_%s' % idx)
+                for idx in range(0, 3)]
+        policy = Policy.objects.create(content_object=docs[0], anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+        backend = TeamworkBackend()
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            expected = backend.get_all_permissions_bulk(user, docs)
+            perm_cache = get_permission_cache()
+            user_pk = backend._get_user_pk(user)
+            keys = [(user_pk, self.doc_ct.id, doc.pk) for doc in docs]
+            eq_(dict(zip(keys, expected)), perm_cache.get_many(keys))
+
+            docs = [Document.objects.get(pk=doc.pk) for doc in docs]
+            with self.assertNumQueries(0):
+                eq_(expected, backend.get_all_permissions_bulk(user, docs))
+
+            policy.add_permissions_by_name(('hello',))
+            eq_([keys[1], keys[2]], sorted(perm_cache.get_many(keys).keys()))
+
+    def test_role_change_invalidates_team(self):
+        """Granting a Role should invalidate cached perms for team objects"""
+        user = self.users['randomguy1']
+        team = Team.objects.create(name='cached_team')
+        role = Role.objects.create(name='cached_role', team=team)
+        doc = Document.objects.create(name='cached_doc_4', team=team)
+        role.add_permissions_by_name(('xyzzy',), doc)
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.add_document',)), user.get_all_permissions(doc))
+            role.users.add(user)
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.xyzzy',)), user.get_all_permissions(doc))
+
+    def test_parent_change_invalidates_children(self):
+        """Policy changes on a parent should invalidate inheriting children"""
+        user = AnonymousUser()
+        parent = Document.objects.create(name='cached_parent')
+        child = Document.objects.create(name='cached_child', parent=parent)
+        policy = Policy.objects.create(content_object=parent, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.frob',)), user.get_all_permissions(child))
+            policy.delete()
+            child = Document.objects.get(pk=child.pk)
+            eq_(set(), user.get_all_permissions(child))
+
+    def test_group_change_invalidates_user(self):
+        """Group membership changes should invalidate cached perms for user"""
+        user = self.users['randomguy1']
+        group = Group.objects.create(name='cached_group')
+        doc = Document.objects.create(name='cached_doc_5')
+        policy = Policy.objects.create(content_object=doc)
+        policy.groups.add(group)
+        policy.add_permissions_by_name(('quux',))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.add_document',)), user.get_all_permissions(doc))
+            user.groups.add(group)
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.quux',)), user.get_all_permissions(doc))
+
+
+    def test_group_rename_invalidates_users(self):
+        """Renaming a Group should invalidate base policy perms by name"""
+        user = self.users['randomguy1']
+        group = Group.objects.create(name='cached_renamed_group')
+        user.groups.add(group)
+        # A Site without Policies, so that the base policy decides
+        site = Site.objects.create(domain='cached-site', name='cached-site')
+        doc = Document.objects.create(name='cached_doc_7', site=site)
+        policies = dict(groups={'cached_renamed_group': ['wiki.hello']})
+
+        with override_settings(TEAMWORK_CACHE='default',
+                               TEAMWORK_BASE_POLICIES=policies):
+            ok_('wiki.hello' in user.get_all_permissions(doc))
+            group.name = 'cached_renamed_group_2'
+            group.save()
+            doc = Document.objects.get(pk=doc.pk)
+            ok_('wiki.hello' not in user.get_all_permissions(doc))
+
+
+class BulkPermissionsTests(TestCaseBase):
+
+    def setUp(self):
+        super(BulkPermissionsTests, self).setUp()
+        self.backend = TeamworkBackend()
+
+    def _fresh_docs(self):
+        return list(Document.objects.order_by('pk'))
+
+    def test_bulk_matches_per_object(self):
+        """Bulk resolution should match per-object resolution exactly"""
+        owner = self.users['randomguy7']
+        doc = Document.objects.create(name='bulk_owned', creator=owner,
+                                      parent=self.docs['Section 1'])
+        policy = Policy.objects.create(content_object=doc,
+                                       apply_to_owners=True)
+        policy.add_permissions_by_name(('hello',))
+
+        quux_user = self.user_model.objects.create_user(
+            'quux2', 'quux2@example.com', 'quux2')
+        users = [AnonymousUser(), quux_user] + list(self.users.values())
+
+        for user in users:
+            expected = [self.backend.get_all_permissions(user, d)
+                        for d in self._fresh_docs()]
+            result = self.backend.get_all_permissions_bulk(
+                user, self._fresh_docs())
+            eq_(expected, result,
+                "Bulk permissions for %s should match per-object" % user)
+
+    def test_bulk_settings_and_owner(self):
+        """Bulk resolution should fall back to the settings base policy"""
+        Policy.objects.all().delete()
+        owner = self.users['randomguy7']
+        Document.objects.create(name='bulk_owned_2', creator=owner)
+        base_policies = dict(
+            authenticated=full_perms('wiki', ('frob',)),
+            apply_to_owners=full_perms('wiki', ('hello',)))
+        with override_settings(TEAMWORK_BASE_POLICIES=base_policies):
+            for user in (owner, self.users['randomguy1']):
+                expected = [self.backend.get_all_permissions(user, d)
+                            for d in self._fresh_docs()]
+                result = self.backend.get_all_permissions_bulk(
+                    user, self._fresh_docs())
+                eq_(expected, result)
+
+    def test_filter_permitted(self):
+        """filter_permitted should yield only the objects with the perm"""
+        user = self.users['section1_editor']
+        docs = self._fresh_docs()
+        expected = [d for d in docs
+                    if user.has_perm('wiki.change_document', d)]
+        result = self.backend.filter_permitted(
+            user, 'wiki.change_document', self._fresh_docs())
+        eq_([d.pk for d in expected], [d.pk for d in result])
+        ok_(len(result) > 0)
+
+
+class RequestCacheTests(TestCaseBase):
+
+    def tearDown(self):
+        end_request_cache()
+        super(RequestCacheTests, self).tearDown()
+
+    def test_request_cache_survives_refetch(self):
+        """Perms should be resolved once per request, even across instances"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='request_cached_doc')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        start_request_cache()
+        eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+
+        # Sneak around the signals, and a fresh instance should still yield
+        # the perms resolved earlier in the request.
+        Policy.objects.filter(pk=policy.pk).update(anonymous=False)
+        doc = Document.objects.get(pk=doc.pk)
+        with self.assertNumQueries(0):
+            eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+
+        # Once the request is over, the change should be visible.
+        end_request_cache()
+        doc = Document.objects.get(pk=doc.pk)
+        eq_(set(), user.get_all_permissions(doc))
+
+    def test_request_cache_cleared_on_change(self):
+        """Changes made during a request should be seen by later checks"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='request_cached_doc_2')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        start_request_cache()
+        eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+        policy.add_permissions_by_name(('hello',))
+        doc = Document.objects.get(pk=doc.pk)
+        eq_(set(('wiki.frob', 'wiki.hello')), user.get_all_permissions(doc))
+
+    def test_unsaved_objects_not_shared(self):
+        """Unsaved objects shouldn't share permissions through the caches"""
+        user = AnonymousUser()
+        backend = TeamworkBackend()
+        start_request_cache()
+        with override_settings(TEAMWORK_CACHE='default'):
+            backend.get_all_permissions(user, Document(name='unsaved_1'))
+            eq_(None, backend._get_cached_permissions(
+                backend._get_user_pk(user), Document(name='unsaved_2')))
+
+
+class InstrumentationTests(TestCaseBase):
+
+    def tearDown(self):
+        end_stats()
+        end_request_cache()
+        super(InstrumentationTests, self).tearDown()
+
+    def test_stages_and_cache_hits(self):
+        """Checks should be counted by stage, and by cache hit or miss"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='instrumented_doc')
+        child = Document.objects.create(name='instrumented_child',
+                                        parent=doc)
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        stats = start_stats()
+        start_request_cache()
+        user.has_perm('wiki.frob', doc)
+        user.has_perm('wiki.frob', child)
+        user.has_perm('wiki.frob', Document.objects.get(pk=doc.pk))
+
+        eq_(3, stats.checks)
+        eq_(2, stats.cache_misses)
+        eq_(1, stats.cache_hits)
+        eq_(1, stats.stages['object'])
+        eq_(1, stats.stages['parent'])
+        ok_(stats.queries > 0)
+        eq_(stats, end_stats())
+
+    def test_superuser_stage(self):
+        """Superuser checks should be counted as such"""
+        stats = start_stats()
+        doc = Document.objects.create(name='instrumented_admin_doc')
+        # User.has_perm() answers for active superusers without asking
+        # any backend, so go to the backend directly.
+        TeamworkBackend().has_perm(self.users['admin'], 'wiki.frob', doc)
+        eq_(1, stats.stages['superuser'])
+
+    def test_bulk_checks(self):
+        """Bulk checks should be counted, along with their queries"""
+        user = AnonymousUser()
+        docs = [Document.objects.create(name='instrumented_bulk_%s' % idx)
+                for idx in range(0, 3)]
+        backend = TeamworkBackend()
+
+        stats = start_stats()
+        start_request_cache()
+        backend.get_all_permissions_bulk(user, docs)
+        eq_(3, stats.checks)
+        eq_(3, stats.cache_misses)
+        ok_(stats.queries > 0)
+
+        queries = stats.queries
+        backend.filter_permitted(
+            user, 'wiki.frob', [Document.objects.get(pk=doc.pk)
+                                for doc in docs])
+        eq_(6, stats.checks)
+        eq_(3, stats.cache_hits)
+        eq_(queries, stats.queries)
+
+        backend.resolve_subtree(user, docs[0], 'wiki.frob')
+        eq_(7, stats.checks)
+        eq_(4, stats.cache_misses)
+        ok_(stats.queries > queries)
+
+    def test_server_timing_header(self):
+        """The middleware should describe checks in a Server-Timing header"""
+        middleware = InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        doc = Document.objects.create(name='instrumented_header_doc')
+
+        with override_settings(TEAMWORK_SERVER_TIMING=True):
+            middleware.process_request(request)
+            AnonymousUser().has_perm('wiki.frob', doc)
+            response = middleware.process_response(request, HttpResponse())
+        ok_(response['Server-Timing'].startswith('teamwork;dur='))
+        ok_('1 checks' in response['Server-Timing'])
+        eq_(1, request.teamwork_stats.checks)
+
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse())
+        ok_(not response.has_header('Server-Timing'))
+
+
+class MetricsTests(TestCaseBase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        self.override = override_settings(
+            TEAMWORK_METRICS_BACKEND='teamwork.metrics.MemoryMetrics')
+        self.override.enable()
+        self.metrics = get_metrics()
+        self.metrics.reset()
+
+    def tearDown(self):
+        self.override.disable()
+        end_request_cache()
+        super(MetricsTests, self).tearDown()
+
+    def test_disabled_by_default(self):
+        """No metrics backend should be configured by default"""
+        self.override.disable()
+        eq_(None, get_metrics())
+        self.override.enable()
+
+    def test_stage_timings_and_depth(self):
+        """Stages should be timed, and parent traversal depth observed"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='metrics_doc')
+        child = Document.objects.create(name='metrics_child', parent=doc)
+        grandchild = Document.objects.create(name='metrics_grandchild',
+                                             parent=child)
+        backend = TeamworkBackend()
+        backend.get_all_permissions(user, grandchild)
+
+        ok_(isinstance(self.metrics, MemoryMetrics))
+        eq_(1, len(self.metrics.samples['teamwork.object']))
+        eq_(1, len(self.metrics.samples['teamwork.site']))
+
+        # Bulk checks load and traverse the whole chain of parents, timing
+        # each stage along the way
+        self.metrics.reset()
+        grandchild = Document.objects.get(pk=grandchild.pk)
+        backend.get_all_permissions_bulk(user, [grandchild])
+        eq_([2], self.metrics.samples['teamwork.parent_depth'])
+        for name in ('teamwork.object', 'teamwork.site', 'teamwork.settings'):
+            ok_(name not in self.metrics.samples)
+            ok_(self.metrics.samples.get(name + '_bulk'))
+
+    def test_indexed_depth(self):
+        """Jumps through the ancestor index should be observed as depth"""
+        user = AnonymousUser()
+        folder = Folder.objects.create(name='metrics_indexed')
+        policy = Policy.objects.create(content_object=folder, anonymous=True)
+        policy.add_permissions_by_name(('change_folder',))
+        child = Folder.objects.create(name='metrics_indexed_child',
+                                      parent=folder)
+        grandchild = Folder.objects.create(
+            name='metrics_indexed_grandchild', parent=child)
+        TeamworkBackend().get_all_permissions(user, grandchild)
+        eq_([1], self.metrics.samples['teamwork.parent_depth'])
+
+    def test_explain_not_reported(self):
+        """Explanations should leave the metrics alone"""
+        doc = Document.objects.create(name='metrics_explained')
+        TeamworkBackend().explain(AnonymousUser(), 'wiki.frob', doc)
+        eq_(dict(), self.metrics.samples)
+        ok_(get_metrics() is self.metrics)
+
+    def test_cache_hit_ratio(self):
+        """Cache hits and misses should be counted"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='metrics_cached_doc')
+        start_request_cache()
+        backend = TeamworkBackend()
+        backend.get_all_permissions(user, doc)
+        backend.get_all_permissions(user, Document.objects.get(pk=doc.pk))
+        backend.get_all_permissions(user, doc)
+        backend.get_all_permissions(user, Document.objects.get(pk=doc.pk))
+        eq_(0.75, self.metrics.get_cache_hit_ratio())
+
+    def test_histogram(self):
+        """Samples should be counted into buckets"""
+        for value in (1, 2, 2, 5, 40):
+            self.metrics.observe('teamwork.parent_depth', value)
+        eq_([1, 2, 1, 1],
+            self.metrics.get_histogram('teamwork.parent_depth', [1, 2, 10]))
+
+
+class ExplainTests(TestCaseBase):
+
+    def test_explain_inherited(self):
+        """Explanations should show the ancestor and Policy that answered"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='explained_doc')
+        child = Document.objects.create(name='explained_child', parent=doc)
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+
+        result = TeamworkBackend().explain(user, 'wiki.frob', child)
+        ok_(result['allowed'])
+        eq_('parent', result['stage'])
+        eq_(doc.pk, result['ancestor'].pk)
+        eq_(user.get_all_permissions(child), result['permissions'])
+
+        eq_('object', result['steps'][0]['stage'])
+        eq_(None, result['steps'][0]['permissions'])
+        answer = result['steps'][-1]
+        eq_([policy.pk], [p.pk for p in answer['policies']])
+        eq_(set(('wiki.frob',)), answer['permissions'])
+        eq_(result['queries'], sum(step['queries']
+                                   for step in result['steps']))
+
+    def test_explain_filtered(self):
+        """Explanations should show what filter_permissions changed"""
+        quux_user = self.user_model.objects.create_user(
+            'quux3', 'quux3@example.com', 'quux3')
+        doc = Document.objects.create(name='explained_filtered_doc')
+
+        result = TeamworkBackend().explain(quux_user, 'wiki.quux', doc)
+        ok_(result['allowed'])
+        eq_('object', result['stage'])
+        eq_(set(('wiki.quux',)), result['steps'][0]['added'])
+        eq_(set(), result['steps'][0]['removed'])
+        eq_([], result['steps'][0]['policies'])
+
+
+class BasePolicyTests(TestCaseBase):
+
+    def tearDown(self):
+        end_request_cache()
+        super(BasePolicyTests, self).tearDown()
+
+    def test_compiled_once(self):
+        """Base policy should be compiled once, and again when it changes"""
+        policies = dict(anonymous=['wiki.view_document'])
+        with override_settings(TEAMWORK_BASE_POLICIES=policies):
+            compiled = get_base_policy()
+            ok_(compiled is get_base_policy())
+            eq_(frozenset(['wiki.view_document']), compiled.anonymous)
+        other_policies = dict(anonymous=['wiki.frob'])
+        with override_settings(TEAMWORK_BASE_POLICIES=other_policies):
+            ok_(compiled is not get_base_policy())
+            eq_(frozenset(['wiki.frob']), get_base_policy().anonymous)
+        with override_settings(TEAMWORK_BASE_POLICIES=None):
+            eq_(None, get_base_policy())
+
+    def test_groups_fetched_once_per_request(self):
+        """Group membership should be fetched once per user per request"""
+        user = self.users['randomguy5']
+        group = Group.objects.create(name='base_policy_group')
+        user.groups.add(group)
+        policies = dict(groups={'base_policy_group': ['wiki.hello']})
+        with override_settings(TEAMWORK_BASE_POLICIES=policies):
+            start_request_cache()
+            compiled = get_base_policy()
+            eq_(frozenset(['wiki.hello']),
+                compiled.get_user_permissions(user))
+            with self.assertNumQueries(0):
+                eq_(frozenset(['wiki.hello']),
+                    compiled.get_user_permissions(user))
+
+    def test_permissions_mutable(self):
+        """Permissions from the base policy should be the caller's own set"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='base_policy_mutable_doc')
+        backend = TeamworkBackend()
+        policies = dict(anonymous=['wiki.view_document'])
+        with override_settings(TEAMWORK_BASE_POLICIES=policies):
+            results = [backend.get_all_permissions(user),
+                       backend.get_all_permissions(user, doc)]
+            doc = Document.objects.get(pk=doc.pk)
+            results.extend(backend.get_all_permissions_bulk(user, [doc]))
+            for perms in results:
+                eq_(set(['wiki.view_document']), perms)
+                ok_(isinstance(perms, set))
+                perms.add('wiki.base_mutable')
+            eq_(frozenset(['wiki.view_document']),
+                get_base_policy().get_user_permissions(user))
+
+
+class SitePolicyTests(TestCaseBase):
+
+    def setUp(self):
+        super(SitePolicyTests, self).setUp()
+        cache.clear()
+
+    def tearDown(self):
+        end_request_cache()
+        super(SitePolicyTests, self).tearDown()
+
+    def test_site_policy_bundle(self):
+        """Compiled Site policy should grant perms like Policy queries do"""
+        site = Site.objects.get_current()
+        group = Group.objects.create(name='site_bundle_group')
+        group_user = self.users['randomguy5']
+        group_user.groups.add(group)
+        listed_user = self.users['randomguy3']
+
+        anon_policy = Policy.objects.create(content_object=site,
+                                            anonymous=True)
+        group_policy = Policy.objects.create(content_object=site)
+        group_policy.groups.add(group)
+        group_policy.add_permissions_by_name(('wiki.hello',), Document)
+        user_policy = Policy.objects.create(content_object=site)
+        user_policy.users.add(listed_user)
+        user_policy.add_permissions_by_name(('wiki.frob',), Document)
+
+        bundle = get_site_policy(site)
+        eq_(frozenset(), bundle.get_permissions(AnonymousUser()))
+        eq_(set(('wiki.add_document', 'wiki.hello')),
+            bundle.get_permissions(group_user))
+        eq_(set(('wiki.add_document', 'wiki.frob')),
+            bundle.get_permissions(listed_user))
+
+    def test_site_policy_invalidated(self):
+        """Changes to a Site Policy should replace the cached bundle"""
+        site = Site.objects.get_current()
+        user = self.users['randomguy1']
+        with override_settings(TEAMWORK_CACHE='default'):
+            eq_(set(('wiki.add_document',)), user.get_all_permissions())
+
+            start_request_cache()
+            with self.assertNumQueries(0):
+                get_site_policy(site)
+                get_site_policy(site)
+            end_request_cache()
+
+            policy = Policy.objects.get(content_type__model='site',
+                                        object_id=site.pk)
+            policy.add_permissions_by_name(('wiki.xyzzy',), Document)
+            eq_(set(('wiki.add_document', 'wiki.xyzzy')),
+                user.get_all_permissions())
+
+    def test_site_permissions_mutable(self):
+        """Permissions from the Site should be a set of the caller's own"""
+        user = self.users['randomguy1']
+        doc = Document.objects.create(name='site_mutable_doc')
+        backend = TeamworkBackend()
+        for perms in (backend.get_all_permissions(user),
+                      backend.get_all_permissions(user, doc)):
+            ok_(isinstance(perms, set))
+            perms.add('wiki.site_mutable')
+        ok_('wiki.site_mutable' not in get_site_policy(
+            Site.objects.get_current()).get_permissions(user))
+
+
+class SuperuserPermissionsTests(TestCaseBase):
+
+    def test_superuser_perms_without_queries(self):
+        """Superuser perms should come from memory in steady state"""
+        admin = self.users['admin']
+        backend = TeamworkBackend()
+        docs = list(Document.objects.filter(team__isnull=True))
+        backend.get_all_permissions(admin, docs[0])
+        expected = set(
+            u"wiki.%s" % codename for codename in
+            Permission.objects.filter(content_type=self.doc_ct)
+                              .values_list('codename', flat=True))
+        with self.assertNumQueries(0):
+            for doc in docs[1:]:
+                eq_(expected, backend.get_all_permissions(admin, doc))
+
+    def test_superuser_perms_see_new_permissions(self):
+        """Added Permissions should show up for superusers"""
+        admin = self.users['admin']
+        doc = Document.objects.create(name='superuser_doc')
+        TeamworkBackend().get_all_permissions(admin, doc)
+        Permission.objects.create(content_type=self.doc_ct,
+                                  codename='superuser_test',
+                                  name='Can test superusers')
+        doc = Document.objects.get(pk=doc.pk)
+        ok_('wiki.superuser_test' in
+            TeamworkBackend().get_all_permissions(admin, doc))
@@ -0,0 +1,61 @@
+from nose.tools import eq_, ok_
+
+from teamwork.backends import TeamworkBackend
+
+from teamwork_example.benchmarks.generate import generate_dataset
+from teamwork_example.benchmarks.runner import (run_benchmarks, percentile,
+                                                format_results, get_paths,
+                                                verify_paths, PATH_STAGES,
+                                                PERM, BASE_POLICIES)
+
+from . import TestCaseBase, override_settings
+
+
+class BenchmarkTests(TestCaseBase):
+
+    def test_percentile(self):
+        """Percentiles should use the nearest rank"""
+        values = range(1, 101)
+        eq_(50, percentile(values, 50))
+        eq_(99, percentile(values, 99))
+        eq_(100, percentile(values, 100))
+        eq_(7, percentile([7], 90))
+
+    def generate(self):
+        return generate_dataset(seed=1, users=6, teams=2, roles_per_team=1,
+                                groups=2, trees=4, depth=3, breadth=2,
+                                policies=2)
+
+    def test_small_run(self):
+        """A tiny dataset should exercise every path, or skip it"""
+        data = self.generate()
+        results = run_benchmarks(data, iterations=3, seed=1)
+        eq_(set(PATH_STAGES.keys()),
+            set(results['paths'].keys()) | set(results['skipped']))
+        ok_('superuser' in results['paths'])
+        for summary in results['paths'].values():
+            eq_(3, summary['count'])
+            ok_(summary['p50_ms'] <= summary['max_ms'])
+        ok_('superuser' in format_results(results))
+
+    @override_settings(TEAMWORK_BASE_POLICIES=BASE_POLICIES)
+    def test_verified_paths(self):
+        """Every benchmarked subject should resolve at its path's stage"""
+        data = self.generate()
+        backend = TeamworkBackend()
+        paths, skipped = verify_paths(backend, get_paths(data))
+        ok_(paths)
+        for name, subjects in paths:
+            ok_(name not in skipped)
+            for user, doc in subjects:
+                eq_(PATH_STAGES[name],
+                    backend.explain(user, PERM, doc)['stage'])
+
+    def test_mislabelled_skipped(self):
+        """Subjects that resolve at some other stage should be dropped"""
+        data = self.generate()
+        backend = TeamworkBackend()
+        paths, skipped = verify_paths(backend, [
+            ('site', [(data.superuser, doc) for doc in data.plain_docs])])
+        eq_([], paths)
+        eq_(['site'], skipped)
@@ -4,6 +4,8 @@ import time
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Permission, Group
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed
 
 from nose.tools import (assert_equal, assert_items_equal, with_setup,
                         assert_false, eq_, ok_)
@@ -11,9 +13,10 @@ from nose.plugins.attrib import attr
 
 from teamwork_example.wiki.models import Document
 
-from ..models import Team, Role, Policy
+from ..models import Team, Role, Policy, MemberPermissions
+from ..signals import relations_changed
 
-from . import TestCaseBase
+from . import TestCaseBase, override_settings
 
 
 class TeamTests(TestCaseBase):
@@ -101,3 +104,185 @@ class RoleTests(TestCaseBase):
         role.users.add(user1)
         eq_(True, role.is_granted_to(user1))
         eq_(False, role.is_granted_to(user2))
+
+
+class MemberPermissionsTests(TestCaseBase):
+
+    def setUp(self):
+        super(MemberPermissionsTests, self).setUp()
+        self.settings_override = override_settings(
+            TEAMWORK_MEMBER_PERMISSIONS_TABLE=True)
+        self.settings_override.enable()
+        MemberPermissions.objects.rebuild()
+
+        self.team = Team.objects.create(name='materialized')
+        self.role = Role.objects.create(team=self.team, name='editor')
+        self.frob = Permission.objects.get(content_type=self.doc_ct,
+                                           codename='frob')
+        self.hello = Permission.objects.get(content_type=self.doc_ct,
+                                            codename='hello')
+        self.user = self.users['randomguy1']
+
+    def tearDown(self):
+        self.settings_override.disable()
+        super(MemberPermissionsTests, self).tearDown()
+
+    def assert_materialized(self):
+        """The table should match what the Roles say"""
+        expected = list(MemberPermissions.objects
+                                         .values_list('user', 'team',
+                                                      'permission_ids')
+                                         .order_by('user', 'team'))
+        MemberPermissions.objects.rebuild()
+        eq_(list(MemberPermissions.objects
+                                  .values_list('user', 'team',
+                                               'permission_ids')
+                                  .order_by('user', 'team')), expected)
+
+    def get_ids(self):
+        return MemberPermissions.objects.get_permission_ids(self.user,
+                                                            self.team.pk)
+
+    def test_role_changes(self):
+        """Adding and removing users and permissions should be tracked"""
+        eq_(None, self.get_ids())
+        self.role.users.add(self.user)
+        eq_([], self.get_ids())
+        ok_(self.team.has_user(self.user))
+
+        self.role.permissions.add(self.frob, self.hello)
+        eq_(sorted([self.frob.pk, self.hello.pk]), self.get_ids())
+        self.assert_materialized()
+
+        self.hello.role_set.clear()
+        eq_([self.frob.pk], self.get_ids())
+
+        self.user.role_set.remove(self.role)
+        eq_(None, self.get_ids())
+        ok_(not self.team.has_user(self.user))
+        self.assert_materialized()
+
+    def test_role_moved_and_deleted(self):
+        """Roles moving between and leaving Teams should be tracked"""
+        self.role.users.add(self.user)
+        self.role.permissions.add(self.frob)
+        other = Team.objects.create(name='materialized_other')
+        self.role.team = other
+        self.role.save()
+        eq_(None, self.get_ids())
+        eq_([self.frob.pk], MemberPermissions.objects.get_permission_ids(
+            self.user, other.pk))
+
+        self.role.delete()
+        eq_(None, MemberPermissions.objects.get_permission_ids(
+            self.user, other.pk))
+        self.assert_materialized()
+
+    def test_member_checks(self):
+        """Checks on Team objects should agree with and without the table"""
+        self.role.users.add(self.user)
+        self.role.permissions.add(self.frob)
+        doc = Document.objects.create(name='materialized_doc',
+                                      team=self.team)
+        eq_(set(['wiki.frob']),
+            self.user.get_all_permissions(Document.objects.get(pk=doc.pk)))
+        with override_settings(TEAMWORK_MEMBER_PERMISSIONS_TABLE=False):
+            eq_(set(['wiki.frob']),
+                self.user.get_all_permissions(
+                    Document.objects.get(pk=doc.pk)))
+
+
+class BulkRelationTests(TestCaseBase):
+
+    def setUp(self):
+        super(BulkRelationTests, self).setUp()
+        cache.clear()
+        self.team = Team.objects.create(name='bulk')
+        self.roles = [Role.objects.create(team=self.team, name='bulk%s' % i)
+                      for i in range(3)]
+        self.role_ids = [role.pk for role in self.roles]
+        self.user_ids = [self.users[name].pk for name in
+                         ('randomguy1', 'randomguy2', 'randomguy3')]
+        self.sent = []
+        relations_changed.connect(self.on_relations_changed)
+        m2m_changed.connect(self.on_relations_changed)
+
+    def tearDown(self):
+        relations_changed.disconnect(self.on_relations_changed)
+        m2m_changed.disconnect(self.on_relations_changed)
+        super(BulkRelationTests, self).tearDown()
+
+    def on_relations_changed(self, sender, **kwargs):
+        self.sent.append(sender)
+
+    def get_memberships(self):
+        return set(Role.users.through.objects
+                   .filter(role__in=self.role_ids)
+                   .values_list('role', 'user'))
+
+    def test_bulk_grant_and_revoke(self):
+        """Roles should be granted and revoked in bulk, with one signal"""
+        Role.objects.bulk_grant(self.role_ids[:1], self.user_ids[:1])
+        self.sent = []
+
+        changed = Role.objects.bulk_grant(self.role_ids, self.user_ids)
+        eq_(dict(users=set(self.user_ids)), changed)
+        eq_(set((r, u) for r in self.role_ids for u in self.user_ids),
+            self.get_memberships())
+        eq_([Role], self.sent)
+
+        changed = Role.objects.bulk_revoke(self.role_ids[1:],
+                                           self.user_ids[1:])
+        eq_(dict(users=set(self.user_ids[1:])), changed)
+        eq_(set((r, u) for r in self.role_ids for u in self.user_ids
+                if r == self.role_ids[0] or u == self.user_ids[0]),
+            self.get_memberships())
+        eq_([Role, Role], self.sent)
+
+        # Nothing to change means nothing to say
+        eq_(dict(), Role.objects.bulk_revoke(self.role_ids[1:],
+                                             self.user_ids[1:]))
+        eq_([Role, Role], self.sent)
+
+    def test_sync_users(self):
+        """Syncing should add and remove just the difference"""
+        role = self.roles[0]
+        role.users.add(*self.user_ids[:2])
+        changed = role.sync_users(self.user_ids[1:])
+        eq_(dict(users=set((self.user_ids[0], self.user_ids[2]))), changed)
+        eq_(set(self.user_ids[1:]),
+            set(role.users.values_list('pk', flat=True)))
+
+    def test_member_permissions_refreshed(self):
+        """Bulk grants should keep the member permissions table current"""
+        frob = Permission.objects.get(content_type=self.doc_ct,
+                                      codename='frob')
+        self.roles[0].permissions.add(frob)
+        with override_settings(TEAMWORK_MEMBER_PERMISSIONS_TABLE=True):
+            MemberPermissions.objects.rebuild()
+            Role.objects.bulk_grant(self.role_ids, self.user_ids)
+            user = self.users['randomguy2']
+            eq_([frob.pk], MemberPermissions.objects.get_permission_ids(
+                user, self.team.pk))
+
+    def test_policy_sync_invalidates_cache(self):
+        """Bulk Policy changes should invalidate cached permissions"""
+        user = self.users['randomguy1']
+        doc = Document.objects.create(name='bulk_policy_doc')
+        policy = Policy.objects.create(content_object=doc)
+        perm_ids = list(Permission.objects
+                                  .filter(content_type=self.doc_ct,
+                                          codename__in=('frob', 'hello'))
+                                  .values_list('pk', flat=True))
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            ok_('wiki.frob' not in user.get_all_permissions(doc))
+            Policy.objects.bulk_grant([policy.pk], users=[user.pk],
+                                      permissions=perm_ids)
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(set(('wiki.frob', 'wiki.hello')),
+                user.get_all_permissions(doc))
+
+            policy.sync_permissions(perm_ids[:1])
+            doc = Document.objects.get(pk=doc.pk)
+            eq_(1, len(user.get_all_permissions(doc)))
@@ -0,0 +1,105 @@
+from django.contrib.auth.models import AnonymousUser, Group
+
+from nose.tools import eq_, ok_, raises
+
+from teamwork_example.wiki.models import Document
+
+from ..models import Team, Role, Policy
+from ..backends import TeamworkBackend
+from ..query import (get_permitted_q, PermissionQueryUnsupported,
+                     PermittedQueryBuilder)
+
+from . import TestCaseBase, override_settings
+
+
+class PermittedQueryTests(TestCaseBase):
+
+    def setUp(self):
+        super(PermittedQueryTests, self).setUp()
+        self.backend = TeamworkBackend()
+
+        # Add a deeper tree with policies partway down, plus an owner policy
+        owner = self.users['randomguy7']
+        parent = self.docs['Public sub sub 1']
+        for idx in range(0, 4):
+            parent = Document.objects.create(name='query_tree_%s' % idx,
+                                             parent=parent, creator=owner)
+            if idx == 1:
+                policy = Policy.objects.create(content_object=parent,
+                                               apply_to_owners=True)
+                policy.add_permissions_by_name(('frob', 'view_document'))
+
+        group = Group.objects.create(name='query_group')
+        self.users['randomguy5'].groups.add(group)
+        policy = Policy.objects.create(
+            content_object=self.docs['Sub-section 2'])
+        policy.groups.add(group)
+        policy.add_permissions_by_name(('hello',))
+
+        quux_user = self.user_model.objects.create_user(
+            'quux3', 'quux3@example.com', 'quux3')
+        self.check_users = ([AnonymousUser(), quux_user] +
+                            list(self.users.values()))
+
+    def assert_matches_backend(self, perms):
+        for user in self.check_users:
+            for perm in perms:
+                expected = set(
+                    d.pk for d in Document.objects.all()
+                    if user.has_perm(perm, d))
+                result = set(Document.objects.permitted(user, perm)
+                                             .values_list('pk', flat=True))
+                eq_(expected, result,
+                    "%s for %s should be %s, was %s" %
+                    (perm, user, sorted(expected), sorted(result)))
+
+    def test_permitted_matches_backend(self):
+        """permitted() should select exactly the objects has_perm allows"""
+        self.assert_matches_backend(('wiki.view_document', 'wiki.frob',
+                                     'wiki.hello', 'wiki.quux',
+                                     'wiki.add_document'))
+
+    def test_permitted_with_base_policy(self):
+        """permitted() should account for the base policy in settings"""
+        base_policies = dict(
+            anonymous=['wiki.view_document'],
+            authenticated=['wiki.view_document', 'wiki.xyzzy'],
+            apply_to_owners=['wiki.hello'])
+        with override_settings(TEAMWORK_BASE_POLICIES=base_policies):
+            self.assert_matches_backend(('wiki.view_document', 'wiki.xyzzy',
+                                         'wiki.hello'))
+
+    @raises(PermissionQueryUnsupported)
+    def test_unsupported_hooks(self):
+        """Models with undescribed Python hooks should be refused"""
+        get_permitted_q(self.users['randomguy1'], 'teamwork.view_team', Team)
+
+    @raises(PermissionQueryUnsupported)
+    def test_too_deep(self):
+        """Hierarchies deeper than the configured limit should be refused"""
+        with override_settings(TEAMWORK_QUERY_MAX_DEPTH=2):
+            get_permitted_q(self.users['randomguy1'], 'wiki.view_document',
+                            Document)
+
+    def test_levels_follow_tree_depth(self):
+        """The filter should only join as many levels as the tree has"""
+        def get_depth(doc):
+            depth = 0
+            while doc.parent_id:
+                doc, depth = doc.parent, depth + 1
+            return depth
+
+        user = self.users['randomguy1']
+        builder = PermittedQueryBuilder(user, 'wiki.view_document', Document)
+        depth = max(get_depth(doc) for doc in Document.objects.all())
+        eq_(depth + 1, len(builder._get_levels()))
+        shallow_sql = str(Document.objects.permitted(
+            user, 'wiki.view_document').query)
+
+        deepest = [doc for doc in Document.objects.all()
+                   if get_depth(doc) == depth][0]
+        Document.objects.create(name='query_deeper', parent=deepest)
+        eq_(depth + 2, len(builder._get_levels()))
+        deep_sql = str(Document.objects.permitted(
+            user, 'wiki.view_document').query)
+        ok_(len(shallow_sql) < len(deep_sql))
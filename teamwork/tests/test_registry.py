@@ -0,0 +1,74 @@
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+
+from nose.tools import eq_, ok_
+
+from teamwork_example.wiki.models import Document
+
+from ..registry import registry
+
+from . import TestCaseBase
+
+
+class PermissionRegistryTests(TestCaseBase):
+
+    def test_names_and_ids(self):
+        """Registry should map Permission IDs to names and back"""
+        perm = Permission.objects.get(content_type=self.doc_ct,
+                                      codename='frob')
+        eq_(u'wiki.frob', registry.get_name(perm.id))
+        eq_(perm.id, registry.get_id('wiki.frob'))
+        eq_(None, registry.get_id('wiki.no_such_perm'))
+
+    def test_lookups_without_queries(self):
+        """Loaded registry should answer without touching the database"""
+        perm_ids = list(Permission.objects.filter(content_type=self.doc_ct)
+                                          .values_list('id', flat=True))
+        registry.load()
+        with self.assertNumQueries(0):
+            names = registry.get_names(perm_ids)
+        ok_(u'wiki.view_document' in names)
+
+    def test_refreshed_on_permission_save(self):
+        """New and renamed Permissions should be picked up"""
+        registry.load()
+        perm = Permission.objects.create(content_type=self.doc_ct,
+                                         codename='registry_test',
+                                         name='Can test the registry')
+        eq_(u'wiki.registry_test', registry.get_name(perm.id))
+        perm.codename = 'registry_renamed'
+        perm.save()
+        eq_(u'wiki.registry_renamed', registry.get_name(perm.id))
+        eq_(None, registry.get_id('wiki.registry_test'))
+
+    def test_masks(self):
+        """Sets of names should survive a round trip through a bitmask"""
+        names = set([u'wiki.frob', u'wiki.view_document', u'not.a_perm'])
+        mask, extra, layout = registry.get_mask(names)
+        eq_(frozenset([u'not.a_perm']), extra)
+        ok_(registry.has_bit(mask, u'wiki.frob'))
+        ok_(not registry.has_bit(mask, u'wiki.hello'))
+        eq_(names, registry.get_names_for_mask(mask, extra, layout))
+
+    def test_masks_dense(self):
+        """Masks should need a bit per Permission, however large the IDs"""
+        perm = Permission.objects.create(content_type=self.doc_ct,
+                                         codename='mask_dense',
+                                         name='Can test dense masks')
+        Permission.objects.filter(pk=perm.pk).update(id=1000000)
+        registry.reset()
+        mask = registry.get_mask([u'wiki.mask_dense'])[0]
+        ok_(mask.bit_length() <= Permission.objects.count())
+
+    def test_masks_stale_after_delete(self):
+        """Masks from before a Permission was deleted should be refused"""
+        perm = Permission.objects.create(content_type=self.doc_ct,
+                                         codename='mask_test',
+                                         name='Can test masks')
+        packed = registry.get_mask([u'wiki.mask_test', u'wiki.frob'])
+        perm.delete()
+        eq_(None, registry.get_names_for_mask(*packed))
+
+        # Having been found stale once, it's refused without reloading
+        with self.assertNumQueries(0):
+            eq_(None, registry.get_names_for_mask(*packed))
@@ -8,8 +8,10 @@ from nose.plugins.attrib import attr
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Permission, Group
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.http import Http404
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from django.core.exceptions import PermissionDenied
 
@@ -17,7 +19,9 @@ from teamwork_example.wiki.models import Document
 
 from ..models import Team, Role, Policy
 from ..backends import TeamworkBackend
-from ..shortcuts import get_object_or_404_or_403, get_permission_by_name
+from ..registry import registry
+from ..shortcuts import (get_object_or_404_or_403, get_permission_by_name,
+                         get_permissions_by_names, build_policy_admin_links)
 
 from . import TestCaseBase
 
@@ -39,6 +43,24 @@ class GetObjectOr403Or404Tests(TestCaseBase):
                                        Document, name='shortcut_test')
         eq_(self.obj.pk, obj.pk)
 
+    def test_permissions_kept(self):
+        """Permissions from the check should be kept on the object"""
+        obj = get_object_or_404_or_403('hello', self.user, Document,
+                                       name='shortcut_test')
+        with self.assertNumQueries(0):
+            ok_('wiki.hello' in self.user.get_all_permissions(obj))
+
+    def test_owner_not_fetched(self):
+        """Owner policies should be checked without fetching the owner"""
+        obj = Document.objects.create(name='shortcut_owned',
+                                      creator=self.user)
+        policy = Policy.objects.create(content_object=obj,
+                                       apply_to_owners=True)
+        policy.add_permissions_by_name(('frob',))
+        obj = get_object_or_404_or_403('frob', self.user, Document,
+                                       name='shortcut_owned')
+        ok_(not hasattr(obj, '_creator_cache'))
+
     def test_short_codename_get(self):
         """get_object_or_404_or_403 shortcut should accept a short codename"""
         obj = get_object_or_404_or_403('hello', self.user,
@@ -83,3 +105,69 @@ class GetPermissionByNameTests(TestCaseBase):
     def test_bad_name(self):
         """get_permission_by_name should raise exception on codename"""
         get_permission_by_name('thisisbad')
+
+    @raises(Permission.DoesNotExist)
+    def test_missing_name(self):
+        """get_permission_by_name should raise exception on a missing name"""
+        get_permission_by_name('wiki.no_such_perm')
+
+    def test_batch_get(self):
+        """get_permissions_by_names should fetch many names in one query"""
+        codenames = ('frob', 'hello', 'quux', self.codename)
+        expected = [Permission.objects.get(content_type=self.ct,
+                                           codename=codename)
+                    for codename in codenames]
+        registry.load()
+        with self.assertNumQueries(1):
+            eq_(expected, get_permissions_by_names(codenames, self.obj))
+        with self.assertNumQueries(1):
+            eq_(expected, get_permissions_by_names(
+                ['wiki.%s' % codename for codename in codenames]))
+
+    def test_new_permission(self):
+        """Names of Permissions created elsewhere should be found"""
+        registry.load()
+        perm = Permission.objects.create(content_type=self.ct,
+                                         codename='shortcut_new',
+                                         name='Can test shortcuts')
+        registry.load()
+        Permission.objects.filter(pk=perm.pk).update(codename='renamed')
+        eq_(perm.pk, get_permission_by_name('wiki.renamed').pk)
+
+    def add_folder_frob(self):
+        folder_ct = ContentType.objects.get_by_natural_key('wiki', 'folder')
+        Permission.objects.create(content_type=folder_ct, codename='frob',
+                                  name='Can frob folders')
+
+    @raises(Permission.MultipleObjectsReturned)
+    def test_ambiguous_name(self):
+        """Codenames shared by models in one app should be refused"""
+        self.add_folder_frob()
+        get_permission_by_name('wiki.frob')
+
+    @raises(Permission.MultipleObjectsReturned)
+    def test_ambiguous_object_name(self):
+        """Shared codenames should be refused when given an object, too"""
+        self.add_folder_frob()
+        get_permission_by_name('frob', self.obj)
+
+
+class BuildPolicyAdminLinksTests(TestCaseBase):
+
+    def count_queries(self, user, doc):
+        with CaptureQueriesContext(connection) as context:
+            build_policy_admin_links(user, doc)
+        return len(context.captured_queries)
+
+    def test_batched(self):
+        """Policies should be checked in a fixed number of queries"""
+        user = self.users['randomguy1']
+        doc = Document.objects.create(name='policy_links_doc')
+        Policy.objects.create(content_object=doc)
+        Policy.objects.create(content_object=doc)
+        build_policy_admin_links(user, doc)
+        expected = self.count_queries(user, doc)
+
+        for idx in range(10):
+            Policy.objects.create(content_object=doc)
+        eq_(expected, self.count_queries(user, doc))
@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from nose.tools import eq_, ok_, assert_raises
+
+from teamwork_example.wiki.models import Document
+
+from ..models import Policy
+from ..precompute import get_chunks, chunk_key, load_state, run_precompute
+from ..warming import get_warm_users, iter_batches, warm_permissions
+
+from . import TestCaseBase, override_settings
+
+
+class WarmingTests(TestCaseBase):
+
+    def setUp(self):
+        super(WarmingTests, self).setUp()
+        cache.clear()
+
+    def test_warm_users(self):
+        """Users should be selected by name, Team, and class"""
+        users = get_warm_users(anonymous=True, usernames=['randomguy1'])
+        ok_(users[0].is_anonymous())
+        eq_(['randomguy1'], [u.username for u in users[1:]])
+
+        team = self.teams['Section 1 Team']
+        members = get_warm_users(teams=[team.name])
+        ok_(members)
+        ok_(all(team.has_user(user) for user in members))
+
+    def test_batches(self):
+        """Objects should be loaded in batches, in pk order"""
+        queryset = Document.objects.all()
+        batches = list(iter_batches(queryset, 3))
+        ok_(all(len(batch) <= 3 for batch in batches))
+        eq_(list(queryset.order_by('pk').values_list('pk', flat=True)),
+            [doc.pk for batch in batches for doc in batch])
+
+    def test_warm_permissions(self):
+        """Warmed permissions should be found in the shared cache"""
+        user = AnonymousUser()
+        doc = Document.objects.create(name='warmed_doc')
+        policy = Policy.objects.create(content_object=doc, anonymous=True)
+        policy.add_permissions_by_name(('frob',))
+        progress = []
+
+        with override_settings(TEAMWORK_CACHE='default'):
+            queryset = Document.objects.filter(pk=doc.pk)
+            eq_(1, warm_permissions([user], queryset,
+                                    progress=lambda *a: progress.append(a)))
+            eq_([(1, 1)], progress)
+
+            doc = Document.objects.get(pk=doc.pk)
+            with self.assertNumQueries(0):
+                eq_(set(('wiki.frob',)), user.get_all_permissions(doc))
+
+    def test_command_needs_cache(self):
+        """The command should refuse to run without a shared cache"""
+        assert_raises(CommandError, call_command, 'teamwork_warm',
+                      'wiki.document', anonymous=True)
+
+
+class PrecomputeTests(TestCaseBase):
+
+    def setUp(self):
+        super(PrecomputeTests, self).setUp()
+        cache.clear()
+        self.doc_ct = ContentType.objects.get_for_model(Document)
+        handle, self.state_path = tempfile.mkstemp()
+        os.close(handle)
+        os.unlink(self.state_path)
+
+    def tearDown(self):
+        if os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+        super(PrecomputeTests, self).tearDown()
+
+    def test_chunks(self):
+        """Chunks should cover fixed ranges of IDs holding objects"""
+        chunks = get_chunks(self.doc_ct, 5)
+        for ct_id, first_pk, last_pk in chunks:
+            eq_(0, first_pk % 5)
+            eq_(first_pk + 4, last_pk)
+        eq_(Document.objects.count(),
+            sum(Document.objects.filter(pk__gte=first, pk__lte=last).count()
+                for ct_id, first, last in chunks))
+
+    def test_resume(self):
+        """Finished chunks should be recorded, and skipped on a rerun"""
+        user = AnonymousUser()
+        progress = []
+        with override_settings(TEAMWORK_CACHE='default'):
+            pairs = run_precompute(
+                [self.doc_ct], [user], chunk_size=5, processes=0,
+                state_path=self.state_path,
+                progress=lambda *a: progress.append(a))
+            eq_(Document.objects.count(), pairs)
+            chunks = get_chunks(self.doc_ct, 5)
+            eq_(len(chunks), len(progress))
+            eq_(set(chunk_key(chunk) for chunk in chunks),
+                load_state(self.state_path))
+
+            doc = Document.objects.all()[0]
+            with self.assertNumQueries(0):
+                user.get_all_permissions(doc)
+
+            eq_(0, run_precompute([self.doc_ct], [user], chunk_size=5,
+                                  processes=0, state_path=self.state_path))
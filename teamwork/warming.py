@@ -0,0 +1,78 @@
+"""
+Pre-resolving permissions into the shared cache, so that the first wave of
+traffic after a deploy or a cache flush doesn't pay for all of them at once.
+"""
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+
+from .backends import TeamworkBackend
+from .cache import get_permission_cache
+from .models import Role, Team
+
+
+def get_warm_users(usernames=(), anonymous=False, authenticated=False,
+                   teams=()):
+    """
+    Get the users to warm permissions for, as a list: anonymous, all active
+    users if authenticated, members of the named Teams, and named users.
+    """
+    user_model = get_user_model()
+    users = []
+    if anonymous:
+        users.append(AnonymousUser())
+    if authenticated:
+        users.extend(user_model.objects.filter(is_active=True)
+                                       .order_by('pk'))
+    else:
+        selected = user_model.objects.none()
+        if usernames:
+            selected = user_model.objects.filter(username__in=usernames)
+        if teams:
+            team_ids = Team.objects.filter(name__in=teams).values('pk')
+            member_ids = (Role.users.through.objects
+                              .filter(role__team__in=team_ids)
+                              .values('user'))
+            selected = selected | user_model.objects.filter(pk__in=member_ids)
+        users.extend(selected.distinct().order_by('pk'))
+    return users
+
+
+def iter_batches(queryset, batch_size):
+    """Iterate over a QuerySet in lists of up to batch_size, by pk"""
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(pks), batch_size):
+        chunk = pks[start:start + batch_size]
+        objs = queryset.model._default_manager.in_bulk(chunk)
+        yield [objs[pk] for pk in chunk if pk in objs]
+
+
+def warm_permissions(users, queryset, batch_size=100, rate=None,
+                     progress=None):
+    """
+    Resolve permissions for each user on each object of a QuerySet, storing
+    them in the shared cache. Objects are resolved in batches, with at most
+    rate (user, object) pairs per second if given. After each batch,
+    progress is called with the number of objects done and the total, if
+    given. Returns the number of (user, object) pairs resolved.
+    """
+    if get_permission_cache() is None:
+        raise ValueError('TEAMWORK_CACHE is not configured')
+    backend = TeamworkBackend()
+    total = queryset.count()
+    done = pairs = 0
+    start = time.time()
+    for objects in iter_batches(queryset, batch_size):
+        for user in users:
+            backend.get_all_permissions_bulk(user, objects)
+            pairs += len(objects)
+            if rate:
+                # Sleep off any time ahead of the rate limit
+                ahead = float(pairs) / rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        done += len(objects)
+        if progress is not None:
+            progress(done, total)
+    return pairs
@@ -0,0 +1,12 @@
+"""
+Benchmarks for teamwork permission checks, against synthetic data.
+
+``generate`` builds an organization of users, groups, Teams, Roles, Policies
+and Document trees at a configurable scale. ``runner`` times each path
+through the backend on that data, reporting latency percentiles and query
+counts. Run both with::
+
+    ./manage.py teamwork_benchmark --users=1000 --depth=10 --output=run.json
+
+Generated data is written to the configured database, so use a scratch one.
+"""
@@ -0,0 +1,213 @@
+"""
+Generator for synthetic organizations, at a configurable scale.
+"""
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.sites.models import Site
+
+from teamwork.ancestors import rebuild_ancestor_index, uses_ancestor_index
+from teamwork.models import Team, Role, Policy, MemberPermissions
+
+from teamwork_example.wiki.models import Document
+
+
+PREFIX = 'bench'
+
+DEFAULT_SCALE = dict(
+    users=200,
+    teams=10,
+    roles_per_team=3,
+    groups=10,
+    trees=8,
+    depth=8,
+    breadth=2,
+    policies=50,
+)
+
+ROLE_PERMISSIONS = (
+    ('view_document', 'add_document_child'),
+    ('view_document', 'frob'),
+    ('view_document', 'frob', 'xyzzy', 'hello'),
+)
+
+POLICY_PERMISSIONS = (
+    ('view_document',),
+    ('view_document', 'hello'),
+    ('frob',),
+)
+
+
+class Dataset(object):
+    """Generated objects, with the subjects of each benchmarked path"""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.users = []
+        self.groups = []
+        self.teams = []
+        self.roots = dict()
+        self.trees = dict()
+        self.team_docs = []
+        self.policy_docs = []
+        self.leaves = []
+        self.inheriting_docs = []
+        self.plain_docs = []
+        self.superuser = None
+        self.site_user = None
+        self.settings_user = None
+        self.members = dict()
+        self.policy_users = dict()
+
+
+def clear_dataset():
+    """Delete everything generated by an earlier run"""
+    Policy.objects.filter(description__startswith=PREFIX).delete()
+    Document.objects.filter(name__startswith=PREFIX).delete()
+    Team.objects.filter(name__startswith=PREFIX).delete()
+    Group.objects.filter(name__startswith=PREFIX).delete()
+    get_user_model().objects.filter(username__startswith=PREFIX).delete()
+
+
+def generate_dataset(seed=None, **scale):
+    """
+    Generate an organization at the given scale, replacing any generated
+    before. See DEFAULT_SCALE for the available measures; there need to be
+    at least two users and one group.
+    """
+    scale = dict(DEFAULT_SCALE, **scale)
+    rand = random.Random(seed)
+    data = Dataset(scale)
+    clear_dataset()
+
+    user_model = get_user_model()
+    user_model.objects.bulk_create([
+        user_model(username='%s_user_%s' % (PREFIX, idx),
+                   email='%s_user_%s@example.com' % (PREFIX, idx))
+        for idx in range(0, scale['users'])])
+    data.users = list(user_model.objects
+                                .filter(username__startswith=PREFIX)
+                                .order_by('pk'))
+    data.superuser = user_model.objects.create(
+        username='%s_superuser' % PREFIX, is_superuser=True)
+
+    Group.objects.bulk_create([
+        Group(name='%s_group_%s' % (PREFIX, idx))
+        for idx in range(0, scale['groups'])])
+    data.groups = list(Group.objects.filter(name__startswith=PREFIX))
+    for user in data.users:
+        user.groups.add(*rand.sample(data.groups,
+                                     min(2, len(data.groups))))
+
+    _generate_teams(data, rand)
+    _generate_documents(data, rand)
+    _generate_policies(data, rand)
+
+    if uses_ancestor_index(Document):
+        rebuild_ancestor_index(Document)
+    MemberPermissions.objects.rebuild()
+    return data
+
+
+def _generate_teams(data, rand):
+    scale = data.scale
+    for team_idx in range(0, scale['teams']):
+        team = Team.objects.create(name='%s_team_%s' % (PREFIX, team_idx))
+        data.teams.append(team)
+        for role_idx in range(0, scale['roles_per_team']):
+            role = Role.objects.create(team=team,
+                                       name='%s_role_%s' % (PREFIX, role_idx))
+            perms = ROLE_PERMISSIONS[role_idx % len(ROLE_PERMISSIONS)]
+            role.add_permissions_by_name(perms, Document)
+            members = rand.sample(data.users, min(5, len(data.users)))
+            role.users.add(*members)
+            data.members.setdefault(team.pk, []).extend(members)
+
+
+def _generate_documents(data, rand):
+    """
+    Build trees of documents, a level at a time. A quarter of the trees
+    belong to Teams, half carry Policies, and the rest have no opinions.
+    """
+    scale = data.scale
+    kinds = dict()
+    roots = []
+    for tree_idx in range(0, scale['trees']):
+        kind = ('team', 'policy', 'policy', 'plain')[tree_idx % 4]
+        team = None
+        if kind == 'team' and data.teams:
+            team = rand.choice(data.teams)
+        name = '%s_doc_%s' % (PREFIX, tree_idx)
+        kinds[name] = kind
+        roots.append(Document(name=name, team=team))
+    Document.objects.bulk_create(roots)
+    roots = list(Document.objects.filter(name__startswith=PREFIX,
+                                         parent__isnull=True))
+
+    trees = dict((root.pk, [root]) for root in roots)
+    tree_of = dict((root.pk, root.pk) for root in roots)
+    level = roots
+    for depth in range(1, scale['depth']):
+        children = [
+            Document(name='%s_%s' % (parent.name, idx), parent=parent)
+            for parent in level for idx in range(0, scale['breadth'])]
+        Document.objects.bulk_create(children)
+        level = list(Document.objects.filter(
+            parent__in=[parent.pk for parent in level]))
+        for doc in level:
+            tree_of[doc.pk] = tree_of[doc.parent_id]
+            trees[tree_of[doc.pk]].append(doc)
+
+    root_kinds = dict((root.pk, kinds[root.name]) for root in roots)
+    for root in roots:
+        data.roots.setdefault(root_kinds[root.pk], []).append(root)
+    data.team_docs = [root for root in data.roots.get('team', [])
+                      if root.team_id]
+    data.trees = trees
+    data.leaves = level
+    data.plain_docs = [doc for doc in level
+                       if root_kinds[tree_of[doc.pk]] == 'plain']
+    data.inheriting_docs = [doc for doc in level
+                            if root_kinds[tree_of[doc.pk]] == 'policy']
+
+
+def _generate_policies(data, rand):
+    """
+    Attach Policies to the root of every policy tree, to random documents
+    within those trees, and to the Site
+    """
+    scale = data.scale
+    roots = data.roots.get('policy', [])
+    for root in roots:
+        policy = Policy.objects.create(
+            content_object=root, authenticated=True,
+            description='%s_root_policy_%s' % (PREFIX, root.pk))
+        policy.add_permissions_by_name(('view_document',), Document)
+
+    leaf_pks = set(doc.pk for doc in data.leaves)
+    candidates = [doc for root in roots for doc in data.trees[root.pk][1:]
+                  if doc.pk not in leaf_pks]
+    targets = rand.sample(candidates, min(scale['policies'], len(candidates)))
+    for idx, doc in enumerate(targets):
+        policy = Policy.objects.create(
+            content_object=doc, description='%s_policy_%s' % (PREFIX, idx))
+        users = rand.sample(data.users, min(3, len(data.users)))
+        policy.users.add(*users)
+        if data.groups:
+            policy.groups.add(rand.choice(data.groups))
+        policy.add_permissions_by_name(
+            POLICY_PERMISSIONS[idx % len(POLICY_PERMISSIONS)], Document)
+        data.policy_docs.append(doc)
+        data.policy_users[doc.pk] = users
+
+    # Site policy for one group, so other users fall through to settings
+    site_group = data.groups[0]
+    policy = Policy.objects.create(
+        content_object=Site.objects.get_current(),
+        description='%s_site_policy' % PREFIX)
+    policy.groups.add(site_group)
+    policy.add_permissions_by_name(('view_document',), Document)
+    data.site_user, data.settings_user = data.users[0], data.users[-1]
+    data.site_user.groups.add(site_group)
+    data.settings_user.groups.remove(site_group)
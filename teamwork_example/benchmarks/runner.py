@@ -0,0 +1,155 @@
+"""
+Timing of each path through the backend, on a generated dataset.
+"""
+import json
+import math
+import platform
+import random
+import time
+
+import django
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from teamwork.backends import TeamworkBackend
+from teamwork.cache import clear_request_cache
+
+from teamwork_example.wiki.models import Document
+
+
+PERM = 'wiki.view_document'
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Base policy in effect while benchmarking, for the settings paths
+BASE_POLICIES = dict(
+    anonymous=['wiki.view_document'],
+    authenticated=['wiki.view_document', 'wiki.add_document'],
+)
+
+# Stage that explain() should report for the subjects of each path
+PATH_STAGES = dict(
+    superuser='superuser',
+    team='team',
+    policy='object',
+    parent='parent',
+    site='site',
+    settings='settings',
+    anonymous='settings',
+)
+
+
+def get_paths(data):
+    """
+    List (name, [(user, doc), ...]) pairs for each path through the
+    backend, as exercised by a generated dataset
+    """
+    anon = AnonymousUser()
+    members = [(user, doc) for doc in data.team_docs
+               for user in data.members.get(doc.team_id, [])[:1]]
+    policies = [(users[0], doc) for doc, users in
+                ((doc, data.policy_users[doc.pk])
+                 for doc in data.policy_docs) if users]
+    return [
+        ('superuser', [(data.superuser, doc) for doc in data.leaves]),
+        ('team', members),
+        ('policy', policies),
+        ('parent', [(data.settings_user, doc)
+                    for doc in data.inheriting_docs]),
+        ('site', [(data.site_user, doc) for doc in data.plain_docs]),
+        ('settings', [(data.settings_user, doc) for doc in data.plain_docs]),
+        ('anonymous', [(anon, doc) for doc in data.plain_docs]),
+    ]
+
+
+def verify_paths(backend, paths):
+    """
+    Keep only the subjects of each path that the backend resolves at the
+    path's stage, as reported by explain(), so that a benchmark row never
+    measures some other path. Returns the verified paths, and the names of
+    those left with no subjects.
+    """
+    verified, skipped = [], []
+    for name, subjects in paths:
+        subjects = [(user, doc) for user, doc in subjects
+                    if backend.explain(user, PERM, doc)['stage'] ==
+                    PATH_STAGES[name]]
+        if subjects:
+            verified.append((name, subjects))
+        else:
+            skipped.append(name)
+    return verified, skipped
+
+
+def run_benchmarks(data, iterations=100, seed=None):
+    """
+    Time permission checks along each path, each against a freshly fetched
+    document so that nothing is cached on the instance. Paths whose
+    subjects don't resolve at the expected stage are listed as skipped.
+    Returns a dict of results, ready to be saved as JSON.
+    """
+    rand = random.Random(seed)
+    backend = TeamworkBackend()
+    results = dict(
+        django=django.get_version(),
+        python=platform.python_version(),
+        timestamp=int(time.time()),
+        scale=data.scale,
+        iterations=iterations,
+        paths=dict(),
+    )
+    with override_settings(TEAMWORK_BASE_POLICIES=BASE_POLICIES):
+        paths, results['skipped'] = verify_paths(backend, get_paths(data))
+        for name, subjects in paths:
+            timings, queries = [], []
+            for idx in range(0, iterations):
+                user, doc = rand.choice(subjects)
+                doc = Document.objects.get(pk=doc.pk)
+                clear_request_cache()
+                with CaptureQueriesContext(connection) as context:
+                    start = time.time()
+                    backend.has_perm(user, PERM, doc)
+                    timings.append((time.time() - start) * 1000.0)
+                queries.append(len(context.captured_queries))
+            results['paths'][name] = summarize(timings, queries)
+    return results
+
+
+def summarize(timings, queries):
+    """Summarize lists of timings (in ms) and query counts"""
+    timings = sorted(timings)
+    summary = dict(
+        count=len(timings),
+        mean_ms=sum(timings) / len(timings),
+        max_ms=timings[-1],
+        mean_queries=float(sum(queries)) / len(queries),
+        max_queries=max(queries),
+    )
+    for pct in PERCENTILES:
+        summary['p%s_ms' % pct] = percentile(timings, pct)
+    return summary
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def format_results(results):
+    """Format results as a plain text table"""
+    columns = ['p%s_ms' % pct for pct in PERCENTILES]
+    lines = ['%-10s %8s ' % ('path', 'queries') +
+             ' '.join('%9s' % col for col in columns)]
+    for name, summary in sorted(results['paths'].items()):
+        lines.append('%-10s %8.1f ' % (name, summary['mean_queries']) +
+                     ' '.join('%9.3f' % summary[col] for col in columns))
+    for name in results.get('skipped', []):
+        lines.append('%-10s %8s' % (name, 'skipped'))
+    return '\n'.join(lines)
+
+
+def save_results(results, path):
+    with open(path, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
@@ -107,6 +107,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'teamwork.middleware.RequestCacheMiddleware',
     'teamwork_example.base.middleware.UserListMiddleware',
 )
 
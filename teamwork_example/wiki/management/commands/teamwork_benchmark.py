@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from teamwork_example.benchmarks.generate import (generate_dataset,
+                                                  DEFAULT_SCALE)
+from teamwork_example.benchmarks.runner import (run_benchmarks,
+                                                format_results, save_results)
+
+
+class Command(BaseCommand):
+    help = ('Generate a synthetic organization, and time teamwork '
+            'permission checks against it')
+
+    option_list = BaseCommand.option_list + tuple(
+        make_option('--%s' % name.replace('_', '-'), dest=name, type='int',
+                    default=default,
+                    help='Dataset %s (default %s)' % (name, default))
+        for name, default in sorted(DEFAULT_SCALE.items())
+    ) + (
+        make_option('--iterations', dest='iterations', type='int',
+                    default=100, help='Checks timed per path'),
+        make_option('--seed', dest='seed', type='int', default=None,
+                    help='Random seed, for repeatable datasets'),
+        make_option('--output', dest='output', default=None,
+                    help='Save results to this JSON file'),
+    )
+
+    def handle(self, *args, **options):
+        scale = dict((name, options[name]) for name in DEFAULT_SCALE)
+        self.stdout.write('Generating dataset...\n')
+        data = generate_dataset(seed=options['seed'], **scale)
+        results = run_benchmarks(data, iterations=options['iterations'],
+                                 seed=options['seed'])
+        self.stdout.write(format_results(results) + '\n')
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write('Saved results to %s\n' % options['output'])
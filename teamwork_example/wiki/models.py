@@ -1,13 +1,16 @@
 from django.conf import settings
 from django.db import models, transaction
+from django.db.models import Q
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import Permission
 from django.contrib.sites.models import Site, get_current_site
 
+from teamwork.ancestors import get_ancestors
 from teamwork.models import Team, Role
+from teamwork.query import PermittedManager
 
 
-class DocumentManager(models.Manager):
+class DocumentManager(PermittedManager):
     pass
 
 
@@ -21,6 +24,10 @@ class Document(models.Model):
 
     objects = DocumentManager()
 
+    # Describe permission hooks for Document.objects.permitted()
+    permission_parent_field = 'parent'
+    permission_owner_field = 'creator'
+
     class Meta:
         permissions = (
             ('view_document', 'Can view document'),
@@ -49,13 +56,39 @@ class Document(models.Model):
             permissions.add('wiki.quux')
         return permissions
 
+    @classmethod
+    def filter_permissions_q(cls, user, perm, prefix, decided, granted):
+        """Filter permissions with custom logic, as Q objects"""
+        if ('quux' in user.username):
+            # Every document settles permissions for quux users
+            decided = Q(**{'%spk__isnull' % prefix: False})
+            if perm == 'wiki.quux':
+                granted = decided
+        return decided, granted
+
     def get_permission_parents(self):
         """Build a list of parents from self to root"""
-        curr, parents = self, []
-        while curr.parent:
-            curr = curr.parent
-            parents.append(curr)
-        return parents
+        return get_ancestors(self)
 
     def get_children(self):
         return Document.objects.filter(parent=self).all()
+
+
+class Folder(models.Model):
+    """
+    A tree of folders, which keeps an index of the nearest ancestor carrying
+    a Policy or Team. Unlike Document, it has no filter_permissions(), which
+    the index would skip for ancestors in between.
+    """
+    name = models.CharField(max_length=80, unique=True)
+    team = models.ForeignKey(Team, blank=True, null=True)
+    parent = models.ForeignKey('self', blank=True, null=True)
+
+    permission_parent_field = 'parent'
+    permission_ancestor_index = True
+
+    def __unicode__(self):
+        return self.name
+
+    def get_permission_parents(self):
+        return get_ancestors(self)